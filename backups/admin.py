@@ -1,8 +1,16 @@
 from django.contrib import admin
-from .models import Backup
+from .models import Backup, BackupManifestEntry
 
 @admin.register(Backup)
 class BackupAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "course", "backup_type", "status", "started_at", "completed_at")
     list_filter = ("backup_type", "status", "started_at", "completed_at")
     search_fields = ("user__username", "course__name", "backup_type", "status")
+
+
+@admin.register(BackupManifestEntry)
+class BackupManifestEntryAdmin(admin.ModelAdmin):
+    list_display = ("id", "backup", "path", "size", "stored_in")
+    list_filter = ("backup__backup_type",)
+    search_fields = ("path", "digest")
+    raw_id_fields = ("backup", "stored_in", "file")
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from backups.models import Backup
+from backups.rclone import restore_backup
+from backups.telegram import TelegramError, restore_telegram
+
+
+class Command(BaseCommand):
+    help = ('Restore a backup from its manifest: every file is fetched from the backup that stored it, '
+            'so incremental backups restore completely.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backup', type=int, required=True, help='Backup to restore')
+        parser.add_argument('--target', required=True, help='Directory (or rclone destination) to restore into')
+        parser.add_argument('--no-verify', action='store_true', help='Skip hashing the restored files')
+
+    def handle(self, *args, **options):
+        try:
+            backup = Backup.objects.select_related('user').get(pk=options['backup'])  # type: ignore[attr-defined]
+        except Backup.DoesNotExist:  # type: ignore[attr-defined]
+            raise CommandError(f"Unknown backup: {options['backup']}")
+        if not backup.manifest.exists():
+            raise CommandError(f'Backup {backup.pk} has no manifest to restore from')
+        try:
+            if backup.backup_type == 'telegram':
+                restored, failed = restore_telegram(backup, options['target'], verify=not options['no_verify'])
+            else:
+                restored, failed = restore_backup(backup, options['target'], verify=not options['no_verify'])
+        except TelegramError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(f'Restored {restored} files into {options["target"]}')
+        if failed:
+            raise CommandError(f'{len(failed)} files could not be restored: ' + ', '.join(failed[:20]))
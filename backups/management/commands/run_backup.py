@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Course
+from backups.models import Backup
+from backups.rclone import DEFAULT_CHECKERS, DEFAULT_TRANSFERS, RcloneBackup, RcloneError
+from backups.telegram import DEFAULT_PARALLEL, TelegramBackup, TelegramError
+
+
+class Command(BaseCommand):
+    help = ('Back up the downloaded files of a course with rclone copy or to a Telegram chat, or run (resume) '
+            'an existing Backup. Progress is written to Backup.extra_data while it runs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backup', type=int, help='Run this existing Backup')
+        parser.add_argument('--type', choices=['rclone', 'telegram'], default='rclone', help='Backup type')
+        parser.add_argument('--user', help='Username whose download tree is backed up')
+        parser.add_argument('--course', type=int, help='Course internal_id')
+        parser.add_argument('--target', help='rclone destination ("remote:katomart" or a local directory), '
+                                             'or the Telegram chat id')
+        parser.add_argument('--transfers', type=int, help=f'Parallel transfers (rclone default {DEFAULT_TRANSFERS}, '
+                                                          f'telegram default {DEFAULT_PARALLEL})')
+        parser.add_argument('--checkers', type=int, default=DEFAULT_CHECKERS, help='Parallel rclone checkers')
+        parser.add_argument('--no-checksum', action='store_true', help='rclone: compare by size/modtime instead of hash')
+        parser.add_argument('--chunk-size', type=int, help='Telegram: bytes per uploaded document')
+        parser.add_argument('--full', action='store_true',
+                            help='Send every file instead of only those changed since the last successful backup')
+
+    def handle(self, *args, **options):
+        if options['backup']:
+            try:
+                backup = Backup.objects.select_related('user', 'course').get(  # type: ignore[attr-defined]
+                    pk=options['backup'])
+            except Backup.DoesNotExist:  # type: ignore[attr-defined]
+                raise CommandError(f"Unknown backup: {options['backup']}")
+        else:
+            if not (options['user'] and options['course'] and (options['target'] or options['type'] == 'telegram')):
+                raise CommandError('Either --backup or all of --user, --course and --target are required')
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+                course = Course.objects.get(pk=options['course'])  # type: ignore[attr-defined]
+            except (get_user_model().DoesNotExist, Course.DoesNotExist) as exc:  # type: ignore[attr-defined]
+                raise CommandError(str(exc))
+            backup = Backup.objects.create(  # type: ignore[attr-defined]
+                user=user, course=course, backup_type=options['type'], backup_location=options['target'])
+        try:
+            if backup.backup_type == 'telegram':
+                runner = TelegramBackup(backup, chunk_size=options['chunk_size'],
+                                        parallel=options['transfers'] or DEFAULT_PARALLEL,
+                                        incremental=not options['full'])
+            else:
+                runner = RcloneBackup(backup, transfers=options['transfers'] or DEFAULT_TRANSFERS,
+                                      checkers=options['checkers'], checksum=not options['no_checksum'],
+                                      incremental=not options['full'])
+            runner.run()
+        except (RcloneError, TelegramError) as exc:
+            raise CommandError(str(exc))
+        progress = backup.extra_data.get('progress') or {}
+        self.stdout.write(f"Backup {backup.pk}: {backup.status}, {backup.extra_data.get('changed', 0)} of "
+                          f"{backup.extra_data.get('files', 0)} files sent, {progress.get('bytes', 0)} bytes")
+        if backup.status == 'failed':
+            raise CommandError(backup.error_message or 'Backup failed')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from backups.telegram_mock import FakeBotAPI
+
+
+class Command(BaseCommand):
+    help = ('Serve a local fake Telegram Bot API for offline backup tests. Point TELEGRAM_API_BASE at the '
+            'printed URL and use the same --token as TELEGRAM_BOT_TOKEN.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--token', default='test')
+        parser.add_argument('--data-dir', help='Where uploaded documents are kept (default: a temp dir)')
+        parser.add_argument('--flood-every', type=int, default=0, help='Answer every n-th upload with 429')
+        parser.add_argument('--fail-every', type=int, default=0, help='Answer every n-th upload with 500')
+
+    def handle(self, *args, **options):
+        server = FakeBotAPI(token=options['token'], port=options['port'], data_dir=options['data_dir'],
+                            flood_every=options['flood_every'], fail_every=options['fail_every'])
+        self.stdout.write(f'Fake Bot API on {server.url} (token {options["token"]}), documents in {server.data_dir}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
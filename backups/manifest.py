@@ -0,0 +1,145 @@
+import os
+import subprocess
+import tempfile
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.db import transaction
+
+from core.hashing import file_digests, hash_file
+from core.models import File
+from core.paths import PathPlanner
+from .models import Backup, BackupManifestEntry
+
+DESTINATION_KEY = 'destination'  # Backup.extra_data: where an rclone backup wrote its files
+
+
+@dataclass
+class ManifestItem:
+    path: str  # relative to the download root, '/' separated
+    size: int
+    mtime_ns: int
+    digest: str
+    file_id: int | None = None
+    stored_in_id: int | None = None  # set for files an earlier backup already holds
+
+
+def build_manifest(user, course):
+    """
+    The downloaded files of `course` as (download root, [ManifestItem]). Paths
+    come from PathPlanner, hashes from the FileDigest cache; files missing on
+    disk are left out.
+    """
+    planner = PathPlanner(user, course)
+    file_ids = list(File.objects.filter(  # type: ignore[attr-defined]
+        lesson__module__course=course, is_downloaded=True).values_list('internal_id', flat=True))
+    if not file_ids:
+        return planner.base_path, []
+    planned = planner.plan(file_ids=file_ids, create_base=False)
+    digests = file_digests(planned)
+    items = [
+        ManifestItem(planned[file_id].relative_to(planner.base_path).as_posix(), size, mtime_ns, digest, file_id)
+        for file_id, (size, mtime_ns, digest) in digests.items()
+    ]
+    return planner.base_path, sorted(items, key=lambda item: item.path)
+
+
+def last_successful_backup(backup):
+    """
+    The newest earlier successful backup of the same user, course, type and
+    location that has a manifest; a backup to a new location starts over
+    """
+    return Backup.objects.filter(  # type: ignore[attr-defined]
+        user_id=backup.user_id, course_id=backup.course_id, backup_type=backup.backup_type,
+        backup_location=backup.backup_location, status='success', manifest__isnull=False,
+    ).exclude(pk=backup.pk).order_by('-started_at', '-pk').distinct().first()
+
+
+def diff_manifest(items, previous):
+    """
+    Split `items` against the `previous` backup's manifest: returns (changed,
+    unchanged, removed paths). Unchanged items get `stored_in_id` pointing at
+    the backup that holds their bytes.
+    """
+    if previous is None:
+        return list(items), [], []
+    known = {entry.path: entry for entry in BackupManifestEntry.objects.filter(backup=previous)}  # type: ignore[attr-defined]
+    changed, unchanged = [], []
+    for item in items:
+        entry = known.pop(item.path, None)
+        if entry is not None and entry.digest == item.digest and entry.size == item.size:
+            item.stored_in_id = entry.stored_in_id
+            unchanged.append(item)
+        else:
+            changed.append(item)
+    return changed, unchanged, sorted(known)
+
+
+def join_destination(location, name):
+    """`name` inside an rclone destination ("remote:", "remote:dir" or a local directory)"""
+    if location.endswith((':', '/', '\\')):
+        return f'{location}{name}'
+    return f'{location}/{name}'
+
+
+def backup_destination(backup):
+    """
+    Where an rclone backup keeps its files: a directory of its own under
+    backup_location, so a later backup never overwrites bytes an older
+    manifest points at. Backups made before had none and wrote to the location.
+    """
+    return (backup.extra_data or {}).get(DESTINATION_KEY) or backup.backup_location
+
+
+def save_manifest(backup, items):
+    """
+    Store the manifest of a finished backup, replacing the one of an earlier run
+    of the same backup; items without stored_in_id were sent by it
+    """
+    with transaction.atomic():
+        BackupManifestEntry.objects.filter(backup=backup).delete()  # type: ignore[attr-defined]
+        BackupManifestEntry.objects.bulk_create([  # type: ignore[attr-defined]
+            BackupManifestEntry(backup=backup, stored_in_id=item.stored_in_id or backup.pk, file_id=item.file_id,
+                                path=item.path, size=item.size, mtime_ns=item.mtime_ns, digest=item.digest)
+            for item in items
+        ], batch_size=500)
+
+
+def restore_from_manifest(backup, target, rclone_path, verify=True, extra_args=()):
+    """
+    Copy every file of `backup`'s manifest into `target` (a directory or rclone
+    destination), fetching each one from the backup that stored it. With
+    `verify` (and a local `target`) the restored files are hashed against the
+    manifest. Returns (restored count, [paths that failed]).
+    """
+    entries = list(BackupManifestEntry.objects.filter(backup=backup).select_related('stored_in'))  # type: ignore[attr-defined]
+    by_source = defaultdict(list)
+    for entry in entries:
+        by_source[backup_destination(entry.stored_in)].append(entry.path)
+    failed = []
+    for source, paths in by_source.items():
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.files', delete=False) as handle:
+            handle.write('\n'.join(paths) + '\n')
+            files_from = handle.name
+        try:
+            result = subprocess.run(
+                [rclone_path, 'copy', source, str(target), '--files-from-raw', files_from, '--no-traverse',
+                 *extra_args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+        finally:
+            os.unlink(files_from)
+        if result.returncode != 0:
+            failed.extend(paths)
+    failed_set = set(failed)
+    if verify and Path(str(target)).is_dir():
+        for entry in entries:
+            if entry.path in failed_set:
+                continue
+            path = Path(str(target), entry.path)
+            try:
+                ok = path.stat().st_size == entry.size and hash_file(path) == entry.digest
+            except OSError:
+                ok = False
+            if not ok:
+                failed.append(entry.path)
+    return len(entries) - len(failed), failed
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0001_initial'),
+        ('core', '0008_file_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupManifestEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024)),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('digest', models.CharField(max_length=128)),
+                ('backup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manifest', to='backups.backup')),
+                ('file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='backup_entries', to='core.file')),
+                ('stored_in', models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='stored_entries', to='backups.backup')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('backup', 'path'), name='backup_manifest_path_uniq')],
+            },
+        ),
+    ]
@@ -1,6 +1,6 @@
 from django.db import models
 from django.conf import settings
-from core.models import Course
+from core.models import Course, File
 
 # Create your models here.
 
@@ -33,3 +33,26 @@ class Backup(models.Model):
 
     def __str__(self):
         return f"Backup({self.user}, {self.course}, {self.backup_type}, {self.status})"
+
+
+class BackupManifestEntry(models.Model):
+    """
+    One file of a backup as it was when the backup ran. `stored_in` is the
+    backup whose run actually transferred the bytes: the backup itself for new
+    or changed files, an earlier one for files an incremental run skipped.
+    """
+    backup = models.ForeignKey(Backup, on_delete=models.CASCADE, related_name="manifest")
+    stored_in = models.ForeignKey(Backup, on_delete=models.RESTRICT, related_name="stored_entries")
+    file = models.ForeignKey(File, on_delete=models.SET_NULL, null=True, blank=True, related_name="backup_entries")
+    path = models.CharField(max_length=1024)  # relative to the download root, '/' separated
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    digest = models.CharField(max_length=128)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["backup", "path"], name="backup_manifest_path_uniq"),
+        ]
+
+    def __str__(self):
+        return f"BackupManifestEntry({self.backup_id}, {self.path})"
@@ -0,0 +1,159 @@
+import json
+import os
+import subprocess
+import tempfile
+from collections import deque
+
+from django.utils import timezone
+
+from core.models import SystemConfig
+from .manifest import (
+    DESTINATION_KEY, build_manifest, diff_manifest, join_destination, last_successful_backup, restore_from_manifest,
+    save_manifest,
+)
+from .models import Backup
+
+DEFAULT_TRANSFERS = 8
+DEFAULT_CHECKERS = 16
+STATS_INTERVAL = 1  # seconds between rclone stats lines
+MAX_LOGGED_ERRORS = 20
+
+
+class RcloneError(Exception):
+    pass
+
+
+def rclone_binary(user=None):
+    """UserConfig.rclone_path, then SystemConfig.rclone_path, then rclone on PATH"""
+    user_config = getattr(user, 'user_config', None) if user is not None and user.is_authenticated else None
+    if user_config and user_config.rclone_path:
+        return user_config.rclone_path
+    return SystemConfig.get_solo().rclone_path or 'rclone'
+
+
+class RcloneBackup:
+    """
+    Runs `rclone copy --files-from` for one Backup row and keeps the row up to
+    date from rclone's JSON stats: extra_data['progress'] carries bytes,
+    speed (bytes/s), transfers, errors and eta while it runs. `status` goes
+    in_progress -> success/failed and `completed_at` is set at the end.
+
+    `backup_location` is any rclone destination, e.g. "remote:katomart" or a
+    local directory (rclone's local backend). Each backup writes under
+    `<backup_location>/<backup pk>/`, recorded as extra_data['destination'].
+
+    With `incremental` only files that are new or changed since the last
+    successful backup to the same location are sent; the rest are recorded in
+    this backup's manifest as stored by the earlier backup.
+    """
+
+    def __init__(self, backup, rclone_path=None, transfers=DEFAULT_TRANSFERS, checkers=DEFAULT_CHECKERS,
+                 checksum=True, incremental=True, extra_args=()):
+        self.backup = backup
+        self.incremental = incremental
+        self.rclone_path = rclone_path or rclone_binary(backup.user)
+        self.transfers = transfers
+        self.checkers = checkers
+        self.checksum = checksum
+        self.extra_args = list(extra_args)
+
+    def command(self, source, destination, files_from):
+        command = [
+            self.rclone_path, 'copy', str(source), destination,
+            '--files-from-raw', files_from, '--no-traverse',
+            '--transfers', str(self.transfers), '--checkers', str(self.checkers),
+            '--use-json-log', '--stats', f'{STATS_INTERVAL}s', '--stats-log-level', 'NOTICE',
+        ]
+        if self.checksum:
+            # Compare by hash rather than size/modtime, and verify what was uploaded
+            command.append('--checksum')
+        return command + self.extra_args
+
+    def _update(self, **values):
+        for name, value in values.items():
+            setattr(self.backup, name, value)
+        Backup.objects.filter(pk=self.backup.pk).update(**values)  # type: ignore[attr-defined]
+
+    def run(self):
+        backup = self.backup
+        if not backup.backup_location:
+            raise RcloneError('Backup has no backup_location (rclone destination)')
+        self._update(status='in_progress', error_message=None, completed_at=None)
+        source, items = build_manifest(backup.user, backup.course)
+        previous = last_successful_backup(backup) if self.incremental else None
+        changed, unchanged, removed = diff_manifest(items, previous)
+        paths = [item.path for item in changed]
+        destination = join_destination(backup.backup_location, str(backup.pk))
+        extra = {
+            **backup.extra_data, DESTINATION_KEY: destination, 'files': len(items), 'changed': len(changed), 'unchanged': len(unchanged),
+            'removed': len(removed), 'base_backup': previous.pk if previous else None,
+            'total_bytes': sum(item.size for item in changed), 'progress': {},
+        }
+        self._update(extra_data=extra)
+        if not paths:
+            save_manifest(backup, items)
+            self._update(status='success', completed_at=timezone.now())
+            return backup
+
+        errors = deque(maxlen=MAX_LOGGED_ERRORS)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.files', delete=False) as handle:
+            handle.write('\n'.join(paths) + '\n')
+            files_from = handle.name
+        try:
+            process = subprocess.Popen(self.command(source, destination, files_from), stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='replace')
+        except OSError as exc:
+            os.unlink(files_from)
+            self._update(status='failed', error_message=f'Could not start rclone: {exc}', completed_at=timezone.now())
+            return backup
+        try:
+            # rclone writes its log, stats included, to stderr one JSON object per line
+            for line in process.stderr:
+                self._handle_line(line, extra, errors)
+            returncode = process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            os.unlink(files_from)
+
+        if returncode == 0:
+            # Only a complete run gets a manifest, so the next one diffs against what really got there
+            save_manifest(backup, items)
+            self._update(status='success', completed_at=timezone.now(), extra_data=extra)
+        else:
+            message = '\n'.join(errors) or f'rclone exited with {returncode}'
+            self._update(status='failed', completed_at=timezone.now(), extra_data=extra, error_message=message)
+        return backup
+
+    def _handle_line(self, line, extra, errors):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            if line.strip():
+                errors.append(line.strip())
+            return
+        if entry.get('level') in ('error', 'critical'):
+            errors.append(entry.get('msg', '').strip())
+        stats = entry.get('stats')
+        if not stats:
+            return
+        total = stats.get('totalBytes') or extra['total_bytes']
+        extra['progress'] = {
+            'bytes': stats.get('bytes', 0),
+            'total_bytes': total,
+            'percent': round(100 * stats.get('bytes', 0) / total, 1) if total else None,
+            'bytes_per_second': stats.get('speed', 0),
+            'transfers': stats.get('transfers', 0),
+            'total_transfers': stats.get('totalTransfers', 0),
+            'checks': stats.get('checks', 0),
+            'errors': stats.get('errors', 0),
+            'eta': stats.get('eta'),
+            'elapsed': stats.get('elapsedTime'),
+        }
+        self._update(extra_data=extra)
+
+
+def restore_backup(backup, target, rclone_path=None, verify=True):
+    """Restore `backup` from its manifest into `target`; see restore_from_manifest"""
+    return restore_from_manifest(backup, target, rclone_path or rclone_binary(backup.user), verify=verify)
@@ -0,0 +1,296 @@
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.utils import timezone
+
+from core.hashing import hash_file
+from .manifest import build_manifest, diff_manifest, last_successful_backup, save_manifest
+from .models import Backup, BackupManifestEntry
+
+DEFAULT_API_BASE = 'https://api.telegram.org'
+# Bots may upload 50 MB but only download 20 MB through getFile; chunks stay under the
+# smaller cap so a backup can be restored through the same API
+DEFAULT_CHUNK_SIZE = 19 * 1024 * 1024
+DEFAULT_PARALLEL = 4
+DEFAULT_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 2  # doubled per attempt
+MAX_FLOOD_WAITS = 20
+READ_SIZE = 1024 * 1024
+STATE_KEY = 'telegram'
+
+
+class TelegramError(Exception):
+    pass
+
+
+class FloodWait(TelegramError):
+    def __init__(self, retry_after):
+        super().__init__(f'Flood wait {retry_after}s')
+        self.retry_after = retry_after
+
+
+def telegram_settings(token=None, api_base=None):
+    """Bot token and API base from the arguments, the environment or settings (never from the database)"""
+    token = token or os.environ.get('TELEGRAM_BOT_TOKEN') or getattr(settings, 'KATOMART_TELEGRAM_BOT_TOKEN', None)
+    if not token:
+        raise TelegramError('A Telegram bot token is required (TELEGRAM_BOT_TOKEN)')
+    api_base = (api_base or os.environ.get('TELEGRAM_API_BASE')
+                or getattr(settings, 'KATOMART_TELEGRAM_API_BASE', None) or DEFAULT_API_BASE)
+    return token, api_base.rstrip('/')
+
+
+class BotAPI:
+    """Minimal Bot API client: one keep-alive connection per thread, multipart bodies streamed from disk"""
+
+    def __init__(self, token, api_base=DEFAULT_API_BASE, timeout=120):
+        self.token = token
+        self.timeout = timeout
+        parts = urlsplit(api_base)
+        self.scheme, self.netloc, self.prefix = parts.scheme, parts.netloc, parts.path.rstrip('/')
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.netloc, timeout=self.timeout)
+        return conn
+
+    def _send(self, method, path, body=None, headers=None, sink=None):
+        """Returns (status, body); with `sink` a 200 body is streamed into it and the length returned instead"""
+        conn = self._connection()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            if sink is None or response.status != 200:
+                return response.status, response.read()
+            written = 0
+            for data in iter(lambda: response.read(READ_SIZE), b''):
+                sink.write(data)
+                written += len(data)
+            return response.status, written
+        except Exception:
+            # Whatever failed mid-request (network, a file that shrank), the connection is unusable
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def call(self, api_method, body=None, headers=None):
+        status, data = self._send('POST', f'{self.prefix}/bot{self.token}/{api_method}', body, headers)
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            raise TelegramError(f'{api_method}: HTTP {status}, not JSON') from None
+        if payload.get('ok'):
+            return payload['result']
+        if payload.get('error_code') == 429:
+            raise FloodWait((payload.get('parameters') or {}).get('retry_after', 5))
+        error = TelegramError(f"{api_method}: {payload.get('error_code')} {payload.get('description', '')}")
+        error.status = payload.get('error_code') or status
+        raise error
+
+    def send_chunk(self, chat_id, path, offset, size, filename, caption):
+        """Upload bytes [offset, offset+size) of `path` as a document; returns (message, sha256 of the chunk)"""
+        boundary = uuid.uuid4().hex
+        fields = {'chat_id': str(chat_id), 'caption': caption[:1024], 'disable_notification': 'true'}
+        head = b''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + value.encode() + b'\r\n'
+            for name, value in fields.items())
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        hasher = hashlib.sha256()
+
+        def body():
+            yield head
+            with open(path, 'rb') as handle:
+                handle.seek(offset)
+                left = size
+                while left:
+                    data = handle.read(min(READ_SIZE, left))
+                    if not data:
+                        raise TelegramError(f'{path} shrank while uploading')
+                    hasher.update(data)
+                    left -= len(data)
+                    yield data
+            yield tail
+
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}',
+                   'Content-Length': str(len(head) + size + len(tail))}
+        message = self.call('sendDocument', body(), headers)
+        return message, hasher.hexdigest()
+
+    def download(self, file_id, handle):
+        """Write a document's bytes to `handle`; returns the number of bytes"""
+        body = json.dumps({'file_id': file_id}).encode()
+        info = self.call('getFile', body, {'Content-Type': 'application/json'})
+        status, written = self._send('GET', f"{self.prefix}/file/bot{self.token}/{info['file_path']}", sink=handle)
+        if status != 200:
+            raise TelegramError(f'Download of {file_id} failed with HTTP {status}')
+        return written
+
+
+def _with_retries(func, retries):
+    """Retry transient failures with backoff; flood waits sleep as told and don't use up attempts"""
+    attempt = floods = 0
+    while True:
+        try:
+            return func()
+        except FloodWait as exc:
+            floods += 1
+            if floods > MAX_FLOOD_WAITS:
+                raise
+            time.sleep(exc.retry_after)
+        except (OSError, http.client.HTTPException, TelegramError) as exc:
+            status = getattr(exc, 'status', None)
+            if attempt >= retries or (status is not None and 400 <= status < 500):
+                raise
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            attempt += 1
+
+
+class TelegramBackup:
+    """
+    Uploads a course's downloaded files to a Telegram chat (`backup_location`,
+    or $TELEGRAM_CHAT_ID) as documents of at most `chunk_size` bytes, read
+    straight from disk, `parallel` chunks at a time.
+
+    extra_data['telegram']['files'] maps each path to its chunks (offset, size,
+    sha256, message_id, file_id) and is saved after every chunk, so running the
+    same backup again resumes where it stopped and restore_telegram can put
+    the files back together. Like RcloneBackup it is incremental against the
+    last successful backup's manifest.
+    """
+
+    def __init__(self, backup, token=None, api_base=None, chunk_size=None, parallel=DEFAULT_PARALLEL,
+                 retries=DEFAULT_RETRIES, timeout=120, incremental=True):
+        self.backup = backup
+        token, api_base = telegram_settings(token, api_base)
+        self.api = BotAPI(token, api_base, timeout)
+        self.chat_id = backup.backup_location or os.environ.get('TELEGRAM_CHAT_ID')
+        self.chunk_size = chunk_size or getattr(settings, 'KATOMART_TELEGRAM_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+        self.parallel = parallel
+        self.retries = retries
+        self.incremental = incremental
+
+    def _update(self, **values):
+        for name, value in values.items():
+            setattr(self.backup, name, value)
+        Backup.objects.filter(pk=self.backup.pk).update(**values)  # type: ignore[attr-defined]
+
+    def _plan(self, item, files):
+        record = files.get(item.path)
+        if record and record['digest'] == item.digest and record['size'] == item.size:
+            # Same content as an interrupted run: keep the chunks that made it
+            return record
+        chunks = [{'index': index, 'offset': offset, 'size': min(self.chunk_size, item.size - offset)}
+                  for index, offset in enumerate(range(0, item.size, self.chunk_size))]
+        record = files[item.path] = {'size': item.size, 'digest': item.digest, 'chunks': chunks}
+        return record
+
+    def run(self):
+        backup = self.backup
+        if not self.chat_id:
+            raise TelegramError('Backup has no backup_location (Telegram chat id) and TELEGRAM_CHAT_ID is unset')
+        self._update(status='in_progress', error_message=None, completed_at=None)
+        source, items = build_manifest(backup.user, backup.course)
+        previous = last_successful_backup(backup) if self.incremental else None
+        changed, unchanged, removed = diff_manifest(items, previous)
+
+        extra = dict(backup.extra_data)
+        state = extra.setdefault(STATE_KEY, {})
+        if state.get('chat_id') not in (None, str(self.chat_id)) or state.get('chunk_size') not in (None, self.chunk_size):
+            # Different chat or chunking than the interrupted run: start over
+            state.clear()
+        state.update(chat_id=str(self.chat_id), chunk_size=self.chunk_size)
+        files = state.setdefault('files', {})
+        for path in set(files) - {item.path for item in changed}:
+            del files[path]
+        jobs = []
+        for item in changed:
+            record = self._plan(item, files)
+            jobs.extend((item, chunk) for chunk in record['chunks'] if not chunk.get('message_id'))
+        total = sum(chunk['size'] for _, chunk in jobs)
+        extra.update({'files': len(items), 'changed': len(changed), 'unchanged': len(unchanged),
+                      'removed': len(removed), 'base_backup': previous.pk if previous else None,
+                      'total_bytes': total, 'progress': {'bytes': 0, 'total_bytes': total}})
+        self._update(extra_data=extra)
+
+        started, done, errors = time.monotonic(), 0, []
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix='katomart-telegram') as pool:
+            futures = {pool.submit(self._upload, source, item, chunk): (item, chunk) for item, chunk in jobs}
+            for future in as_completed(futures):
+                item, chunk = futures[future]
+                try:
+                    message, sha256 = future.result()
+                except Exception as exc:  # noqa: BLE001 - collected, the other chunks go on
+                    errors.append(f"{item.path} part {chunk['index']}: {exc}")
+                    continue
+                chunk.update(message_id=message['message_id'], file_id=message['document']['file_id'],
+                             sha256=sha256)
+                done += chunk['size']
+                elapsed = max(time.monotonic() - started, 1e-6)
+                extra['progress'] = {'bytes': done, 'total_bytes': total,
+                                     'percent': round(100 * done / total, 1) if total else None,
+                                     'bytes_per_second': done / elapsed, 'errors': len(errors)}
+                self._update(extra_data=extra)
+
+        if errors:
+            self._update(status='failed', completed_at=timezone.now(), error_message='\n'.join(errors[:20]))
+        else:
+            save_manifest(backup, items)
+            self._update(status='success', completed_at=timezone.now())
+        return backup
+
+    def _upload(self, source, item, chunk):
+        filename = f"{self.backup.pk}-{item.digest[:16]}.part{chunk['index']:04d}"
+        caption = json.dumps({'backup': self.backup.pk, 'path': item.path, 'part': chunk['index']}, ensure_ascii=False)
+        return _with_retries(lambda: self.api.send_chunk(
+            self.chat_id, Path(source, item.path), chunk['offset'], chunk['size'], filename, caption), self.retries)
+
+
+def restore_telegram(backup, target, token=None, api_base=None, retries=DEFAULT_RETRIES, verify=True):
+    """
+    Rebuild every file of `backup`'s manifest in the `target` directory from
+    the chunks recorded by the backup that stored it. Returns (restored
+    count, [paths that failed]).
+    """
+    api = BotAPI(*telegram_settings(token, api_base))
+    entries = BackupManifestEntry.objects.filter(backup=backup).select_related('stored_in')  # type: ignore[attr-defined]
+    restored, failed = 0, []
+    for entry in entries:
+        record = ((entry.stored_in.extra_data.get(STATE_KEY) or {}).get('files') or {}).get(entry.path)
+        path = Path(target, entry.path)
+        partial = path.with_name(path.name + '.part')
+        try:
+            if not record or any(not chunk.get('file_id') for chunk in record['chunks']):
+                raise TelegramError('no chunk mapping')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(partial, 'wb') as handle:
+                for chunk in sorted(record['chunks'], key=lambda chunk: chunk['index']):
+                    _with_retries(lambda: _download_at(api, chunk, handle), retries)
+            if verify and (partial.stat().st_size != entry.size or hash_file(partial) != entry.digest):
+                raise TelegramError('content does not match the manifest')
+            os.replace(partial, path)
+            restored += 1
+        except (OSError, http.client.HTTPException, TelegramError):
+            partial.unlink(missing_ok=True)
+            failed.append(entry.path)
+    return restored, failed
+
+
+def _download_at(api, chunk, handle):
+    handle.seek(chunk['offset'])
+    handle.truncate()
+    api.download(chunk['file_id'], handle)
+
+
@@ -0,0 +1,151 @@
+"""
+A local stand-in for the Telegram Bot API (sendDocument, getFile and file
+downloads), so Telegram backups can be run and restored offline:
+
+    server = FakeBotAPI(token='test').start()
+    TelegramBackup(backup, token='test', api_base=server.url).run()
+
+`flood_every` answers every n-th upload with 429 and retry_after, and
+`fail_every` with a 500, to exercise the uploader's retry paths. Also
+available as `manage.py telegram_mock_server`.
+"""
+import json
+import tempfile
+import threading
+import uuid
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+MAX_UPLOAD = 50 * 1024 * 1024
+MAX_DOWNLOAD = 20 * 1024 * 1024
+
+
+class FakeBotAPI:
+    def __init__(self, token='test', host='127.0.0.1', port=0, data_dir=None, flood_every=0, fail_every=0,
+                 retry_after=1, max_upload=MAX_UPLOAD, max_download=MAX_DOWNLOAD):
+        self.token = token
+        self.data_dir = Path(data_dir or tempfile.mkdtemp(prefix='katomart-telegram-'))
+        self.flood_every = flood_every
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.max_upload = max_upload
+        self.max_download = max_download
+        self.uploads = 0
+        self.messages = {}  # message_id -> {chat_id, caption, file_id, size}
+        self.files = {}  # file_id -> file_path under data_dir
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='telegram-mock', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # -- API
+
+    def _send_document(self, handler):
+        with self._lock:
+            self.uploads += 1
+            count = self.uploads
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length)
+        if self.flood_every and count % self.flood_every == 0:
+            return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry later',
+                         'parameters': {'retry_after': self.retry_after}}
+        if self.fail_every and count % self.fail_every == 0:
+            return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+        message = BytesParser(policy=policy.HTTP).parsebytes(
+            f"Content-Type: {handler.headers['Content-Type']}\r\n\r\n".encode() + body)
+        fields, document, filename = {}, None, None
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                document, filename = part.get_payload(decode=True), part.get_filename()
+            else:
+                fields[name] = part.get_payload(decode=True).decode()
+        if document is None or not fields.get('chat_id'):
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: document and chat_id required'}
+        if len(document) > self.max_upload:
+            return 413, {'ok': False, 'error_code': 413, 'description': 'Request Entity Too Large'}
+        file_id = uuid.uuid4().hex
+        file_path = f'documents/{file_id}'
+        (self.data_dir / 'documents').mkdir(parents=True, exist_ok=True)
+        (self.data_dir / file_path).write_bytes(document)
+        with self._lock:
+            message_id = len(self.messages) + 1
+            self.messages[message_id] = {'chat_id': fields['chat_id'], 'caption': fields.get('caption'),
+                                         'file_id': file_id, 'size': len(document)}
+            self.files[file_id] = file_path
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id, 'chat': {'id': fields['chat_id']}, 'caption': fields.get('caption'),
+            'document': {'file_id': file_id, 'file_unique_id': file_id[:16], 'file_name': filename,
+                         'file_size': len(document)}}}
+
+    def _get_file(self, handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        file_id = json.loads(handler.rfile.read(length) or b'{}').get('file_id')
+        file_path = self.files.get(file_id)
+        if file_path is None:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'}
+        size = (self.data_dir / file_path).stat().st_size
+        if size > self.max_download:
+            return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: file is too big'}
+        return 200, {'ok': True, 'result': {'file_id': file_id, 'file_size': size, 'file_path': file_path}}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _json(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                prefix = f'/bot{api.token}/'
+                if not self.path.startswith(prefix):
+                    self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                    return self._json(401, {'ok': False, 'error_code': 401, 'description': 'Unauthorized'})
+                method = self.path[len(prefix):]
+                if method == 'sendDocument':
+                    return self._json(*api._send_document(self))
+                if method == 'getFile':
+                    return self._json(*api._get_file(self))
+                self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                return self._json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+
+            def do_GET(self):
+                prefix = f'/file/bot{api.token}/'
+                path = api.data_dir / self.path[len(prefix):] if self.path.startswith(prefix) else None
+                if path is None or '..' in self.path or not path.is_file():
+                    return self._json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                data = path.read_bytes()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -1,3 +1,210 @@
+import json
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
 
-# Create your tests here.
+from core.models import Course, File, Lesson, Module, Platform, SystemConfig
+from core.paths import PathPlanner
+from .manifest import backup_destination, join_destination, last_successful_backup
+from .models import Backup, BackupManifestEntry
+from .rclone import RcloneBackup, restore_backup
+from .telegram import TelegramBackup, restore_telegram
+from .telegram_mock import FakeBotAPI
+
+RCLONE = shutil.which("rclone")
+
+
+class CourseFilesMixin:
+    """A course with downloaded files on disk under a temporary download root"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        config = SystemConfig.get_solo()
+        config.download_path = str(self.tmp / "downloads")
+        config.save()
+        self.user = get_user_model().objects.create_user("owner", password="owner")
+        platform = Platform.objects.create(id="platform", name="Platform")  # type: ignore[attr-defined]
+        self.course = Course.objects.create(name="Course", platform=platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=self.course, name="Module")  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(module=module, name="Lesson")  # type: ignore[attr-defined]
+        self.files = {}
+        for name in ("intro", "notes", "video"):
+            self.add_file(name, f"{name} v1".encode() * 100)
+
+    def add_file(self, name, data):
+        file = File.objects.create(  # type: ignore[attr-defined]
+            lesson=self.lesson, name=name, file_type="bin", is_downloaded=True)
+        self.files[name] = file
+        self.write(name, data)
+
+    def path_of(self, name):
+        return PathPlanner(self.user, self.course).plan()[self.files[name].pk]
+
+    def write(self, name, data):
+        path = self.path_of(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def relative(self, name):
+        return self.path_of(name).relative_to(self.tmp / "downloads").as_posix()
+
+    def new_backup(self, backup_type, location):
+        return Backup.objects.create(  # type: ignore[attr-defined]
+            user=self.user, course=self.course, backup_type=backup_type, backup_location=location)
+
+    def stored(self, backup):
+        """{path: pk of the backup holding its bytes} of a backup's manifest"""
+        return dict(BackupManifestEntry.objects.filter(backup=backup).values_list(  # type: ignore[attr-defined]
+            "path", "stored_in_id"))
+
+
+def tree(root):
+    root = Path(root)
+    return {path.relative_to(root).as_posix(): path.read_bytes() for path in root.rglob("*") if path.is_file()}
+
+
+class BackupLocationTests(CourseFilesMixin, TestCase):
+    def test_destination_of_a_backup(self):
+        self.assertEqual(join_destination("remote:", "7"), "remote:7")
+        self.assertEqual(join_destination("remote:katomart", "7"), "remote:katomart/7")
+        self.assertEqual(join_destination("/srv/backups/", "7"), "/srv/backups/7")
+        backup = self.new_backup("rclone", "remote:katomart")
+        # Backups made before per-backup directories wrote to the location itself
+        self.assertEqual(backup_destination(backup), "remote:katomart")
+
+    def test_base_backup_is_taken_from_the_same_location(self):
+        first = self.new_backup("rclone", "remote:a")
+        Backup.objects.filter(pk=first.pk).update(status="success")  # type: ignore[attr-defined]
+        BackupManifestEntry.objects.create(  # type: ignore[attr-defined]
+            backup=first, stored_in=first, path="x", size=1, mtime_ns=1, digest="d")
+        self.assertEqual(last_successful_backup(self.new_backup("rclone", "remote:a")), first)
+        self.assertIsNone(last_successful_backup(self.new_backup("rclone", "remote:b")))
+
+
+@unittest.skipUnless(RCLONE, "rclone is not installed")
+class RcloneBackupTests(CourseFilesMixin, TestCase):
+    def run_backup(self, location, **options):
+        backup = self.new_backup("rclone", str(location))
+        RcloneBackup(backup, rclone_path=RCLONE, **options).run()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, "success", backup.error_message)
+        return backup
+
+    def test_full_then_incremental_backup(self):
+        first = self.run_backup(self.tmp / "backups")
+        self.assertEqual(first.extra_data["destination"], str(self.tmp / "backups" / str(first.pk)))
+        self.assertEqual(tree(self.tmp / "backups" / str(first.pk)), tree(self.tmp / "downloads"))
+        self.assertEqual((first.extra_data["files"], first.extra_data["changed"], first.extra_data["unchanged"]),
+                         (3, 3, 0))
+        self.assertIsNotNone(first.completed_at)
+
+        self.add_file("slides", b"slides")
+        second = self.run_backup(self.tmp / "backups")
+        self.assertEqual(set(tree(self.tmp / "backups" / str(second.pk))), {self.relative("slides")})
+        self.assertEqual((second.extra_data["files"], second.extra_data["changed"], second.extra_data["unchanged"]),
+                         (4, 1, 3))
+        self.assertEqual(second.extra_data["base_backup"], first.pk)
+
+    def test_nonzero_exit_fails_with_rclone_errors(self):
+        backup = self.new_backup("rclone", "nosuchremote:katomart")
+        RcloneBackup(backup, rclone_path=RCLONE).run()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, "failed")
+        self.assertIsNotNone(backup.completed_at)
+        # The JSON log lines' messages, errors only
+        self.assertIn("didn't find section in config file", backup.error_message)
+        self.assertNotIn('"level"', backup.error_message)
+        self.assertNotIn("not found - using defaults", backup.error_message)
+        self.assertFalse(backup.manifest.exists())
+
+    def test_new_location_gets_every_file(self):
+        first = self.run_backup(self.tmp / "a")
+        second = self.run_backup(self.tmp / "b")
+        self.assertEqual(second.extra_data["changed"], 3)
+        self.assertIsNone(second.extra_data["base_backup"])
+        self.assertEqual(set(self.stored(second).values()), {second.pk})
+        self.assertEqual(set(tree(self.tmp / "b" / str(second.pk))), set(tree(self.tmp / "a" / str(first.pk))))
+
+    def test_changed_file_does_not_overwrite_an_older_backup(self):
+        first = self.run_backup(self.tmp / "backups")
+        self.write("notes", b"notes v2")
+        second = self.run_backup(self.tmp / "backups")
+        self.assertEqual(set(tree(self.tmp / "backups" / str(second.pk))), {self.relative("notes")})
+        stored = self.stored(second)
+        self.assertEqual(stored.pop(self.relative("notes")), second.pk)
+        self.assertEqual(set(stored.values()), {first.pk})
+
+        for backup, notes in ((first, b"notes v1" * 100), (second, b"notes v2")):
+            target = self.tmp / f"restore-{backup.pk}"
+            restored, failed = restore_backup(backup, target, rclone_path=RCLONE)
+            self.assertEqual((restored, failed), (3, []))
+            self.assertEqual(tree(target)[self.relative("notes")], notes)
+
+
+class TelegramBackupTests(CourseFilesMixin, TestCase):
+    """Backups to FakeBotAPI, the local stand-in for the Bot API"""
+    chunk_size = 300
+
+    def start(self, **options):
+        server = FakeBotAPI(token="test", data_dir=self.tmp / "telegram", retry_after=0, **options).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def run_backup(self, server):
+        backup = self.new_backup("telegram", "-100123")
+        TelegramBackup(backup, token="test", api_base=server.url, chunk_size=self.chunk_size, parallel=2).run()
+        backup.refresh_from_db()
+        self.assertEqual(backup.status, "success", backup.error_message)
+        return backup
+
+    def sent(self, server, since=0):
+        """{path: parts} uploaded after message `since`"""
+        sent = {}
+        for message_id, message in server.messages.items():
+            if message_id > since:
+                caption = json.loads(message["caption"])
+                sent.setdefault(caption["path"], set()).add(caption["part"])
+        return sent
+
+    def restore(self, server, backup):
+        target = self.tmp / f"restore-{backup.pk}"
+        restored, failed = restore_telegram(backup, target, token="test", api_base=server.url)
+        self.assertEqual((restored, failed), (len(self.files), []))
+        return tree(target)
+
+    def test_full_backup(self):
+        server = self.start()
+        backup = self.run_backup(server)
+        self.assertEqual(self.sent(server), {self.relative(name): {0, 1, 2} for name in self.files})
+        self.assertEqual({message["chat_id"] for message in server.messages.values()}, {"-100123"})
+        self.assertEqual(backup.extra_data["progress"]["bytes"], 2400)
+        self.assertEqual(set(self.stored(backup).values()), {backup.pk})
+
+    def test_flood_waits_are_retried(self):
+        server = self.start(flood_every=2)
+        backup = self.run_backup(server)
+        self.assertEqual(len(server.messages), 9)
+        # Every other upload was turned away with a flood wait and sent again
+        self.assertGreater(server.uploads, 9)
+        self.assertEqual(self.restore(server, backup), tree(self.tmp / "downloads"))
+
+    def test_incremental_backup_and_restore(self):
+        server = self.start()
+        first = self.run_backup(server)
+        old = tree(self.tmp / "downloads")
+        self.write("notes", b"notes v2")
+        second = self.run_backup(server)
+        self.assertEqual(self.sent(server, since=9), {self.relative("notes"): {0}})
+        self.assertEqual((second.extra_data["changed"], second.extra_data["unchanged"]), (1, 2))
+        self.assertEqual(self.stored(second)[self.relative("intro")], first.pk)
+
+        self.assertEqual(self.restore(server, first), old)
+        restored = self.restore(server, second)
+        self.assertEqual(restored, tree(self.tmp / "downloads"))
+        self.assertEqual(restored[self.relative("notes")], b"notes v2")
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import VideoNote, PdfAnnotation, Rating, ViewCount
+from .models import VideoNote, PdfAnnotation, Rating, ViewCount, ContentStats
 
 @admin.register(VideoNote)
 class VideoNoteAdmin(admin.ModelAdmin):
@@ -24,3 +24,13 @@ class ViewCountAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "content_type", "object_id", "count", "last_viewed")
     list_filter = ("content_type", "last_viewed")
     search_fields = ("user__username",)
+
+@admin.register(ContentStats)
+class ContentStatsAdmin(admin.ModelAdmin):
+    list_display = ("id", "content_type", "object_id", "total_views", "unique_viewers", "rating_average", "rating_count", "updated_at")
+    list_filter = ("content_type",)
+    list_select_related = ("content_type",)
+    readonly_fields = [field.name for field in ContentStats._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
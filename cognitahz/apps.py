@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CognitahzConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cognitahz'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (keeps ContentStats in step with Rating and ViewCount)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from cognitahz.stats import get_view_buffer, refresh_stats
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the ContentStats totals (views, unique viewers, ratings) from ViewCount and Rating. '
+            'They are kept current incrementally; this repairs drift.')
+
+    def handle(self, *args, **options):
+        get_view_buffer().flush()
+        with transaction.atomic():
+            count = refresh_stats()
+        self.stdout.write(self.style.SUCCESS(f"Recomputed stats for {count} objects"))  # type: ignore[attr-defined]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:40
+
+import django.db.models.deletion
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_stats(apps, schema_editor):
+    ViewCount = apps.get_model('cognitahz', 'ViewCount')
+    Rating = apps.get_model('cognitahz', 'Rating')
+    ContentStats = apps.get_model('cognitahz', 'ContentStats')
+    stats = {}
+    for row in ViewCount.objects.order_by().values('content_type_id', 'object_id').annotate(
+            total_views=Sum('count'), unique_viewers=Count('user_id', distinct=True)):
+        stats[(row.pop('content_type_id'), row.pop('object_id'))] = row
+    for row in Rating.objects.order_by().values('content_type_id', 'object_id').annotate(
+            rating_sum=Sum('rating'), rating_count=Count('pk'),
+            **{f'rating_{stars}': Count('pk', filter=Q(rating=stars)) for stars in range(1, 6)}):
+        stats.setdefault((row.pop('content_type_id'), row.pop('object_id')), {}).update(row)
+    ContentStats.objects.bulk_create(
+        [ContentStats(content_type_id=ct, object_id=obj, **values) for (ct, obj), values in stats.items()],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cognitahz', '0001_initial'),
+        ('contenttypes', '0002_remove_content_type_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveIntegerField()),
+                ('total_views', models.PositiveBigIntegerField(default=0)),
+                ('unique_viewers', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('rating_1', models.PositiveIntegerField(default=0)),
+                ('rating_2', models.PositiveIntegerField(default=0)),
+                ('rating_3', models.PositiveIntegerField(default=0)),
+                ('rating_4', models.PositiveIntegerField(default=0)),
+                ('rating_5', models.PositiveIntegerField(default=0)),
+                ('rating_average', models.GeneratedField(db_persist=True, expression=models.ExpressionWrapper(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('rating_sum'), '*', models.Value(1.0)), '/', django.db.models.functions.comparison.NullIf(models.F('rating_count'), 0)), output_field=models.FloatField()), output_field=models.FloatField())),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['content_type', '-total_views'], name='stats_top_views_idx'), models.Index(fields=['content_type', '-unique_viewers'], name='stats_top_viewers_idx'), models.Index(fields=['content_type', '-rating_average', '-rating_count'], name='stats_top_rating_idx')],
+                'unique_together': {('content_type', 'object_id')},
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,10 @@
 from django.db import models
 from django.conf import settings
-from core.models import File, Module, Lesson
+from core.models import File, Module, Lesson, RollupTrackedMixin
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import F, FloatField, ExpressionWrapper
+from django.db.models.functions import NullIf
 
 # Create your models here.
 
@@ -35,7 +37,9 @@ class PdfAnnotation(models.Model):
     def __str__(self):
         return f"PdfAnnotation({self.file}, {self.user})"
 
-class Rating(models.Model):
+class Rating(RollupTrackedMixin, models.Model):
+    ROLLUP_TRACKED_FIELDS = ("rating", "content_type_id", "object_id")
+
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="ratings")
     rating = models.PositiveSmallIntegerField(help_text="User rating 1-5")
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -65,3 +69,38 @@ class ViewCount(models.Model):
 
     def __str__(self):
         return f"ViewCount({self.user}, {self.content_object}, {self.count})"
+
+class ContentStats(models.Model):
+    """Per-object totals over ViewCount and Rating, kept current by cognitahz.stats"""
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+    total_views = models.PositiveBigIntegerField(default=0)
+    unique_viewers = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    rating_average = models.GeneratedField(
+        expression=ExpressionWrapper(F("rating_sum") * 1.0 / NullIf(F("rating_count"), 0), output_field=FloatField()),
+        output_field=FloatField(), db_persist=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("content_type", "object_id")
+        indexes = [
+            # Top-N queries per content type read these in order and stop
+            models.Index(fields=["content_type", "-total_views"], name="stats_top_views_idx"),
+            models.Index(fields=["content_type", "-unique_viewers"], name="stats_top_viewers_idx"),
+            models.Index(fields=["content_type", "-rating_average", "-rating_count"], name="stats_top_rating_idx"),
+        ]
+
+    @property
+    def histogram(self):
+        return {stars: getattr(self, f"rating_{stars}") for stars in range(1, 6)}
+
+    def __str__(self):
+        return f"ContentStats({self.content_type_id}:{self.object_id}, {self.total_views} views)"
@@ -0,0 +1,12 @@
+from rest_framework import serializers
+from .models import ContentStats
+
+
+class ContentStatsSerializer(serializers.ModelSerializer):
+    content_type = serializers.SlugRelatedField(slug_field="model", read_only=True)
+    histogram = serializers.ReadOnlyField()
+
+    class Meta:
+        model = ContentStats
+        fields = ("id", "content_type", "object_id", "total_views", "unique_viewers", "rating_sum", "rating_count",
+                  "rating_average", "histogram", "updated_at")
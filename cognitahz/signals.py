@@ -0,0 +1,32 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.search import object_deleted, object_saved
+from .models import Rating, VideoNote, ViewCount
+from .stats import rating_deleted, rating_saved, schedule_refresh
+
+
+@receiver(post_save, sender=Rating)
+def update_stats_on_rating_save(sender, instance, created, **kwargs):
+    rating_saved(instance, created)
+
+
+@receiver(post_delete, sender=Rating)
+def update_stats_on_rating_delete(sender, instance, **kwargs):
+    rating_deleted(instance)
+
+
+@receiver([post_save, post_delete], sender=ViewCount)
+def update_stats_on_view_count_change(sender, instance, **kwargs):
+    # The view buffer writes with update()/bulk_create() and doesn't get here; direct edits do
+    schedule_refresh([(instance.content_type_id, instance.object_id)])
+
+
+@receiver(post_save, sender=VideoNote)
+def update_search_on_note_save(sender, instance, update_fields=None, **kwargs):
+    object_saved("note", instance, update_fields)
+
+
+@receiver(post_delete, sender=VideoNote)
+def update_search_on_note_delete(sender, instance, **kwargs):
+    object_deleted("note", instance)
@@ -0,0 +1,265 @@
+import atexit
+import threading
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from .models import ContentStats, Rating, ViewCount
+
+DEFAULT_FLUSH_INTERVAL = 5.0  # seconds
+DEFAULT_MAX_PENDING = 1000  # distinct (user, object) keys before a flush is forced
+CHUNK_SIZE = 500
+
+
+def content_key(obj):
+    """(content type id, object id) of a model instance"""
+    return ContentType.objects.get_for_model(obj).pk, obj.pk
+
+
+def _chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def _stats_ids(keys):
+    """{(content type id, object id): ContentStats pk}, creating the missing rows"""
+    keys = set(keys)
+    ContentStats.objects.bulk_create(  # type: ignore[attr-defined]
+        [ContentStats(content_type_id=ct, object_id=obj) for ct, obj in keys], ignore_conflicts=True,
+        batch_size=CHUNK_SIZE)
+    ids = {}
+    for ct, objects in _by_content_type(keys).items():
+        for chunk in _chunks(objects):
+            ids.update(((ct, obj), pk) for pk, obj in ContentStats.objects.filter(  # type: ignore[attr-defined]
+                content_type_id=ct, object_id__in=chunk).values_list("pk", "object_id"))
+    return ids
+
+
+def _by_content_type(keys):
+    grouped = defaultdict(list)
+    for ct, obj in keys:
+        grouped[ct].append(obj)
+    return grouped
+
+
+def _view_rows(keys):
+    """{(user id, content type id, object id): (ViewCount pk, count)} of the rows that exist for these keys"""
+    keys = set(keys)
+    by_object = defaultdict(set)
+    for user_id, ct, obj in keys:
+        by_object[(ct, obj)].add(user_id)
+    rows = {}
+    for ct, objects in _by_content_type(by_object).items():
+        users = {user_id for obj in objects for user_id in by_object[(ct, obj)]}
+        for chunk in _chunks(objects):
+            for pk, user_id, obj, count in ViewCount.objects.filter(  # type: ignore[attr-defined]
+                    content_type_id=ct, object_id__in=chunk, user_id__in=users).values_list(
+                    "pk", "user_id", "object_id", "count"):
+                if (user_id, ct, obj) in keys:
+                    rows[(user_id, ct, obj)] = pk, count
+    return rows
+
+
+def _increment(model, deltas, **extra):
+    """Apply {pk: Counter of field increments} with one UPDATE per distinct increment"""
+    groups = defaultdict(list)
+    for pk, delta in deltas.items():
+        delta = tuple(sorted((name, value) for name, value in delta.items() if value))
+        if delta:
+            groups[delta].append(pk)
+    for delta, pks in groups.items():
+        for chunk in _chunks(pks):
+            model.objects.filter(pk__in=chunk).update(  # type: ignore[attr-defined]
+                **{name: F(name) + value for name, value in delta}, **extra)
+
+
+class ViewBuffer:
+    """
+    Accumulates view increments in memory and writes them in batches: every
+    `flush_interval` seconds (from a daemon thread), once `max_pending`
+    distinct (user, object) pairs are waiting, and at exit. A flush turns the
+    increments into one UPDATE ... SET count = count + n per distinct n,
+    creates the rows of first views in bulk and carries the totals over to
+    ContentStats the same way. Views recorded since the last flush are lost
+    if the process dies; that is the trade.
+    """
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        self.flush_interval = flush_interval or getattr(settings, "KATOMART_VIEW_FLUSH_INTERVAL",
+                                                        DEFAULT_FLUSH_INTERVAL)
+        self.max_pending = max_pending or getattr(settings, "KATOMART_VIEW_BUFFER_SIZE", DEFAULT_MAX_PENDING)
+        self._pending = Counter()  # (user id, content type id, object id) -> views
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, user_id, content_type_id, object_id, views=1):
+        with self._lock:
+            self._pending[(user_id, content_type_id, object_id)] += views
+            full = len(self._pending) >= self.max_pending
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="cognitahz-views", daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return sum(self._pending.values())
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except DatabaseError:
+                # Kept for the next round, see flush()
+                pass
+
+    def flush(self):
+        """Write the buffered views; returns how many were written"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = +self._pending, Counter()
+            if not pending:
+                return 0
+            try:
+                with transaction.atomic():
+                    self._write(pending)
+            except DatabaseError:
+                with self._lock:
+                    self._pending.update(pending)
+                raise
+            return sum(pending.values())
+
+    def _write(self, pending):
+        existing = _view_rows(pending)
+        # First views get a row with count 0, incremented below with the rest. A committed flush
+        # never leaves a 0 behind, so the 0s read back are this flush's rows and the others were
+        # created by another process meanwhile (its insert won; these views are repeats)
+        ViewCount.objects.bulk_create(  # type: ignore[attr-defined]
+            [ViewCount(user_id=user_id, content_type_id=ct, object_id=obj, count=0)
+             for user_id, ct, obj in pending if (user_id, ct, obj) not in existing],
+            ignore_conflicts=True, batch_size=CHUNK_SIZE)
+        new_rows = _view_rows(key for key in pending if key not in existing)
+        inserted = {key for key, (_, count) in new_rows.items() if count == 0}
+        rows = {**existing, **new_rows}
+
+        now = timezone.now()
+        _increment(ViewCount, {rows[key][0]: {"count": views} for key, views in pending.items() if key in rows},
+                   last_viewed=now)
+
+        totals = defaultdict(Counter)
+        for (user_id, ct, obj), views in pending.items():
+            if (user_id, ct, obj) in rows:
+                totals[(ct, obj)]["total_views"] += views
+                totals[(ct, obj)]["unique_viewers"] += (user_id, ct, obj) in inserted
+        stats_ids = _stats_ids(totals)
+        _increment(ContentStats, {stats_ids[key]: delta for key, delta in totals.items()}, updated_at=now)
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_view_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = ViewBuffer()
+                atexit.register(_buffer.close)
+    return _buffer
+
+
+def record_view(user, obj, views=1):
+    """Count `views` views of `obj` (any model instance) by `user`; written in the background"""
+    ct, obj_id = content_key(obj)
+    get_view_buffer().add(getattr(user, "pk", user), ct, obj_id, views)
+
+
+def rating_delta(values, sign):
+    stars = values["rating"]
+    delta = Counter({"rating_sum": sign * stars, "rating_count": sign})
+    if 1 <= stars <= 5:
+        delta[f"rating_{stars}"] = sign
+    return delta
+
+
+def rating_saved(instance, created):
+    """post_save for Rating: move the old value out of and the new one into ContentStats"""
+    current = {name: getattr(instance, name) for name in Rating.ROLLUP_TRACKED_FIELDS}
+    loaded = getattr(instance, "_rollup_loaded", None)
+    if not created and (loaded is None or len(loaded) < len(current)):
+        # No baseline to diff against
+        refresh_stats([(instance.content_type_id, instance.object_id)])
+    elif created or loaded != current:
+        deltas = defaultdict(Counter)
+        if not created:
+            deltas[(loaded["content_type_id"], loaded["object_id"])].update(rating_delta(loaded, -1))
+        deltas[(current["content_type_id"], current["object_id"])].update(rating_delta(current, 1))
+        stats_ids = _stats_ids(deltas)
+        _increment(ContentStats, {stats_ids[key]: delta for key, delta in deltas.items()})
+    instance._rollup_loaded = current
+
+
+def rating_deleted(instance):
+    key = (instance.content_type_id, instance.object_id)
+    stats_ids = _stats_ids([key])
+    _increment(ContentStats, {stats_ids[key]: rating_delta({"rating": instance.rating}, -1)})
+
+
+_VIEW_AGGREGATES = {"total_views": Sum("count"), "unique_viewers": Count("user_id", distinct=True)}
+_RATING_AGGREGATES = {
+    "rating_sum": Sum("rating"), "rating_count": Count("pk"),
+    **{f"rating_{stars}": Count("pk", filter=Q(rating=stars)) for stars in range(1, 6)},
+}
+STATS_FIELDS = tuple(_VIEW_AGGREGATES) + tuple(_RATING_AGGREGATES)
+
+
+_pending = threading.local()
+
+
+def schedule_refresh(keys):
+    """refresh_stats() for these keys once the current transaction commits; cascades batch up until then"""
+    pending = getattr(_pending, "keys", None)
+    if pending is None:
+        pending = _pending.keys = set()
+    pending.update(keys)
+    transaction.on_commit(_flush_pending)
+
+
+def _flush_pending():
+    keys, _pending.keys = getattr(_pending, "keys", None), None
+    if keys:
+        refresh_stats(keys)
+
+
+def refresh_stats(keys=None):
+    """Recompute ContentStats from ViewCount and Rating for these (content type id, object id) keys, or all"""
+    if keys is None:
+        keys = set(ViewCount.objects.values_list("content_type_id", "object_id").distinct())  # type: ignore[attr-defined]
+        keys |= set(Rating.objects.values_list("content_type_id", "object_id").distinct())  # type: ignore[attr-defined]
+        keys |= set(ContentStats.objects.values_list("content_type_id", "object_id"))  # type: ignore[attr-defined]
+    keys = set(keys)
+    stats_ids = _stats_ids(keys)
+    for ct, objects in _by_content_type(keys).items():
+        for chunk in _chunks(objects):
+            totals = {obj: dict.fromkeys(STATS_FIELDS, 0) for obj in chunk}
+            for model, aggregates in ((ViewCount, _VIEW_AGGREGATES), (Rating, _RATING_AGGREGATES)):
+                for row in model.objects.filter(content_type_id=ct, object_id__in=chunk).order_by().values(  # type: ignore[attr-defined]
+                        "object_id").annotate(**aggregates):
+                    totals[row.pop("object_id")].update({name: value or 0 for name, value in row.items()})
+            ContentStats.objects.bulk_update(  # type: ignore[attr-defined]
+                [ContentStats(pk=stats_ids[(ct, obj)], **values) for obj, values in totals.items()], STATS_FIELDS)
+    return len(keys)
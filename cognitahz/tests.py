@@ -1,3 +1,62 @@
+from collections import Counter
+from unittest import mock
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.urls import reverse
+
+from core.models import Course, File, Lesson, Module, Platform
+from . import stats
+from .models import ContentStats, ViewCount
+
+
+class ViewStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user("viewer", password="viewer")
+        cls.other = get_user_model().objects.create_user("other", password="other")
+        platform = Platform.objects.create(id="platform", name="Platform")  # type: ignore[attr-defined]
+        course = Course.objects.create(name="Course", platform=platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=course, name="Module")  # type: ignore[attr-defined]
+        cls.lesson = Lesson.objects.create(module=module, name="Lesson")  # type: ignore[attr-defined]
+        cls.file = File.objects.create(lesson=cls.lesson, name="File")  # type: ignore[attr-defined]
+
+    def setUp(self):
+        self.buffer = stats.ViewBuffer(flush_interval=3600)
+        patcher = mock.patch.object(stats, "_buffer", self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stats_of(self, obj):
+        ct, obj_id = stats.content_key(obj)
+        return ContentStats.objects.values("total_views", "unique_viewers").get(  # type: ignore[attr-defined]
+            content_type_id=ct, object_id=obj_id)
+
+    def test_opening_a_lesson_or_file_counts_a_view(self):
+        self.client.force_login(self.user)
+        for _ in range(2):
+            self.assertEqual(self.client.get(reverse("lesson-detail", args=[self.lesson.pk])).status_code, 200)
+        self.assertEqual(self.client.get(reverse("file-detail", args=[self.file.pk])).status_code, 200)
+        self.client.get(reverse("lesson-list"))
+        self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.stats_of(self.lesson), {"total_views": 2, "unique_viewers": 1})
+        self.assertEqual(self.stats_of(self.file), {"total_views": 1, "unique_viewers": 1})
+
+    def test_row_created_by_another_process_is_not_a_new_viewer(self):
+        key = (self.user.pk, *stats.content_key(self.lesson))
+        create = ViewCount.objects.bulk_create  # type: ignore[attr-defined]
+
+        def bulk_create(objs, **kwargs):
+            # Another process flushes the same first view between our lookup and our insert
+            with mock.patch.object(ViewCount.objects, "bulk_create", create):  # type: ignore[attr-defined]
+                stats.ViewBuffer()._write(Counter({key: 3}))
+            return create(objs, **kwargs)
 
-# Create your tests here.
+        self.buffer.add(*key, views=2)
+        self.buffer.add(self.other.pk, *key[1:])
+        with mock.patch.object(ViewCount.objects, "bulk_create", bulk_create):  # type: ignore[attr-defined]
+            self.buffer.flush()
+        self.assertEqual(ViewCount.objects.get(user=self.user).count, 5)  # type: ignore[attr-defined]
+        self.assertEqual(self.stats_of(self.lesson), {"total_views": 6, "unique_viewers": 2})
+        stats.refresh_stats()
+        self.assertEqual(self.stats_of(self.lesson), {"total_views": 6, "unique_viewers": 2})
@@ -0,0 +1,10 @@
+from django.urls import path, include
+from rest_framework.routers import DefaultRouter
+from .views import ContentStatsViewSet
+
+router = DefaultRouter()
+router.register(r"stats", ContentStatsViewSet)
+
+urlpatterns = [
+    path("api/", include(router.urls)),
+]
@@ -1,3 +1,53 @@
-from django.shortcuts import render
+from django.contrib.contenttypes.models import ContentType
+from rest_framework import permissions, viewsets
+from rest_framework.exceptions import ValidationError
 
-# Create your views here.
+from .models import ContentStats
+from .serializers import ContentStatsSerializer
+
+# Content types stats can be listed for, and the ranking each `by` reads (an index each, see ContentStats.Meta)
+CONTENT_TYPES = ("course", "module", "lesson", "file")
+RANKINGS = {
+    "views": ("-total_views", "-unique_viewers"),
+    "viewers": ("-unique_viewers", "-total_views"),
+    "rating": ("-rating_average", "-rating_count"),
+}
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+class ContentStatsViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Top-N content by views, unique viewers or average rating:
+    ``?type=lesson&by=views&limit=10``. ``?object_id=`` picks one object's
+    stats and ``?min_ratings=`` drops thinly rated content from the rating
+    ranking. Answered from the ContentStats table, not by grouping views.
+    """
+    queryset = ContentStats.objects.select_related("content_type")  # type: ignore[attr-defined]
+    serializer_class = ContentStatsSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != "list":
+            return queryset
+        params = self.request.query_params
+        model = params.get("type")
+        if model not in CONTENT_TYPES:
+            raise ValidationError({"type": f"Expected one of {', '.join(CONTENT_TYPES)}"})
+        by = params.get("by", "views")
+        if by not in RANKINGS:
+            raise ValidationError({"by": f"Expected one of {', '.join(RANKINGS)}"})
+        try:
+            limit = min(int(params.get("limit", DEFAULT_LIMIT)), MAX_LIMIT)
+            min_ratings = int(params.get("min_ratings", 1))
+            object_ids = [int(value) for value in params.getlist("object_id")]
+        except ValueError:
+            raise ValidationError("limit, min_ratings and object_id must be integers")
+        queryset = queryset.filter(content_type=ContentType.objects.get_by_natural_key("core", model))
+        if object_ids:
+            queryset = queryset.filter(object_id__in=object_ids)
+        if by == "rating":
+            queryset = queryset.filter(rating_count__gte=max(min_ratings, 1))
+        return queryset.order_by(*RANKINGS[by])[:max(limit, 1)]
@@ -3,12 +3,70 @@ from django.utils.translation import gettext_lazy as _
 from django.utils.html import format_html
 from django.urls import reverse
 from django.db import models
+from django.utils import timezone
+import threading
+import time
+from .pagination import EstimatedCountPaginator
+from .tools import invalidate_tool_cache
 from .models import (
     SystemConfig, Platform, PlatformURL, PlatformAuth, 
-    Course, Module, Lesson, File, UserFormattedName, UserConfig
+    Course, Module, Lesson, File, UserFormattedName, UserConfig, DownloadJob, DownloadTask,
+    WorkerHeartbeat
 )
 
 
+FILTER_CACHE_TTL = 300  # seconds the sidebar filter choices are reused
+
+_filter_cache_lock = threading.Lock()
+_filter_cache = {}  # (model label, field path) -> (expires at, choices)
+
+
+def _cached_choices(key, compute):
+    now = time.monotonic()
+    with _filter_cache_lock:
+        cached = _filter_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    choices = list(compute())
+    with _filter_cache_lock:
+        _filter_cache[key] = (now + FILTER_CACHE_TTL, choices)
+    return choices
+
+
+class CachedRelatedFieldListFilter(admin.RelatedFieldListFilter):
+    """RelatedFieldListFilter whose choices are computed once per FILTER_CACHE_TTL"""
+
+    def field_choices(self, field, request, model_admin):
+        key = ('related', model_admin.model._meta.label, self.field_path)
+        return _cached_choices(key, lambda: admin.RelatedFieldListFilter.field_choices(self, field, request, model_admin))
+
+
+class CachedAllValuesFieldListFilter(admin.AllValuesFieldListFilter):
+    """AllValuesFieldListFilter without a SELECT DISTINCT over the whole table on every page"""
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        super().__init__(field, request, params, model, model_admin, field_path)
+        # lookup_choices is still a lazy queryset here
+        self.lookup_choices = _cached_choices(('values', model._meta.label, field_path), lambda: self.lookup_choices)
+
+
+class CatalogAdminMixin:
+    """Changelist settings for the big catalog tables"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False  # skips the extra unfiltered COUNT(*) when filtering
+
+
+class DownloadProgressMixin:
+    """Progress column read from the rollup fields (see core.rollups), so no per-row aggregation"""
+
+    @admin.display(description=_('Progress'), ordering='downloaded_count')
+    def download_progress(self, obj):
+        return _('%(done)s of %(total)s files, %(done_gb).1f of %(total_gb).1f GB') % {
+            'done': f'{obj.downloaded_count:,}', 'total': f'{obj.file_count:,}',
+            'done_gb': obj.downloaded_bytes / 1e9, 'total_gb': obj.total_bytes / 1e9,
+        }
+
+
 @admin.register(SystemConfig)
 class SystemConfigAdmin(admin.ModelAdmin):
     """Admin interface for System Configuration"""
@@ -27,11 +85,21 @@ class SystemConfigAdmin(admin.ModelAdmin):
                 "chromedriver_available", "chromedriver_path",
                 "mkvtoolnix_available", "mkvtoolnix_path",
                 "rclone_available", "rclone_path",
+                "tool_versions",
             ),
         }),
     )
     list_filter = ('debug', 'ffmpeg_available', 'bento4_available', 'aria2c_available', 'geckodriver_available', 'chromedriver_available')
-    readonly_fields = ('ffmpeg_available', 'bento4_available', 'aria2c_available', 'geckodriver_available', 'chromedriver_available', 'mkvtoolnix_available', 'rclone_available')
+    readonly_fields = ('ffmpeg_available', 'bento4_available', 'aria2c_available', 'geckodriver_available', 'chromedriver_available', 'mkvtoolnix_available', 'rclone_available', 'tool_versions')
+    actions = ['reprobe_tools']
+
+    @admin.action(description=_('Re-detect external tools'))
+    def reprobe_tools(self, request, queryset):
+        invalidate_tool_cache()
+        for config in queryset:
+            config.auto_detect_tools(force=True)
+            config.save()
+        self.message_user(request, _('External tools re-detected.'))
     
     def has_add_permission(self, request):
         # Only allow one SystemConfig instance
@@ -79,6 +147,7 @@ class PlatformURLAdmin(admin.ModelAdmin):
     
     list_display = ('platform', 'url_kind', 'url', 'is_active', 'has_f_string', 'visitation_count', 'created_at')
     list_filter = ('platform', 'url_kind', 'is_active', 'has_f_string', 'needs_specific_headers', 'has_visitation_limit', 'created_at')
+    list_select_related = ('platform',)
     search_fields = ('platform__name', 'url_kind', 'url', 'f_string_params')
     readonly_fields = ('created_at', 'updated_at', 'visitation_count')
     list_editable = ('is_active',)
@@ -109,6 +178,7 @@ class PlatformAuthAdmin(admin.ModelAdmin):
     
     list_display = ('platform', 'username', 'user', 'token_type', 'expires_at', 'created_at')
     list_filter = ('platform', 'token_type', 'expires_at', 'created_at')
+    list_select_related = ('platform', 'user')
     search_fields = ('platform__name', 'username', 'user__username')
     readonly_fields = ('created_at', 'updated_at')
     
@@ -135,13 +205,15 @@ class PlatformAuthAdmin(admin.ModelAdmin):
 
 
 @admin.register(Course)
-class CourseAdmin(admin.ModelAdmin):
+class CourseAdmin(CatalogAdminMixin, DownloadProgressMixin, admin.ModelAdmin):
     """Admin interface for Courses"""
     
-    list_display = ('name', 'teacher', 'platform', 'price', 'is_active', 'is_downloaded', 'has_drm', 'created_at')
-    list_filter = ('platform', 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'course_expires', 'created_at')
+    list_display = ('name', 'teacher', 'platform', 'price', 'is_active', 'is_downloaded', 'download_progress', 'has_drm', 'created_at')
+    list_filter = (('platform', CachedRelatedFieldListFilter), 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'course_expires', 'created_at')
+    list_select_related = ('platform',)
     search_fields = ('name', 'teacher', 'description', 'external_id')
-    readonly_fields = ('created_at', 'updated_at', 'katomart_id')
+    autocomplete_fields = ('platform', 'auth')
+    readonly_fields = ('created_at', 'updated_at', 'katomart_id', 'download_progress')
     list_editable = ('is_active', 'is_downloaded')
     
     fieldsets = (
@@ -155,7 +227,7 @@ class CourseAdmin(admin.ModelAdmin):
             'fields': ('is_active', 'is_locked', 'unlocks_at', 'is_content_listed', 'content_list_date', 'content_list_type')
         }),
         (_('Download Information'), {
-            'fields': ('is_downloaded', 'download_date', 'download_type', 'download_path')
+            'fields': ('is_downloaded', 'download_progress', 'download_date', 'download_type', 'download_path')
         }),
         (_('Platform & Authentication'), {
             'fields': ('platform', 'auth')
@@ -175,13 +247,15 @@ class CourseAdmin(admin.ModelAdmin):
 
 
 @admin.register(Module)
-class ModuleAdmin(admin.ModelAdmin):
+class ModuleAdmin(CatalogAdminMixin, DownloadProgressMixin, admin.ModelAdmin):
     """Admin interface for Modules"""
     
-    list_display = ('name', 'course', 'order', 'is_active', 'is_downloaded', 'has_drm', 'created_at')
-    list_filter = ('course__platform', 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'created_at')
+    list_display = ('name', 'course', 'order', 'is_active', 'is_downloaded', 'download_progress', 'has_drm', 'created_at')
+    list_filter = (('course__platform', CachedRelatedFieldListFilter), 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'created_at')
+    list_select_related = ('course',)
     search_fields = ('name', 'description', 'external_id')
-    readonly_fields = ('created_at', 'updated_at', 'katomart_id')
+    autocomplete_fields = ('course',)
+    readonly_fields = ('created_at', 'updated_at', 'katomart_id', 'download_progress')
     list_editable = ('order', 'is_active', 'is_downloaded')
     
     fieldsets = (
@@ -195,7 +269,7 @@ class ModuleAdmin(admin.ModelAdmin):
             'fields': ('is_active', 'is_locked', 'unlocks_at', 'is_content_listed', 'content_list_date', 'content_list_type')
         }),
         (_('Download Information'), {
-            'fields': ('should_download', 'is_downloaded', 'download_date', 'download_type')
+            'fields': ('should_download', 'is_downloaded', 'download_progress', 'download_date', 'download_type')
         }),
         (_('Course'), {
             'fields': ('course',)
@@ -215,12 +289,14 @@ class ModuleAdmin(admin.ModelAdmin):
 
 
 @admin.register(Lesson)
-class LessonAdmin(admin.ModelAdmin):
+class LessonAdmin(CatalogAdminMixin, admin.ModelAdmin):
     """Admin interface for Lessons"""
     
     list_display = ('name', 'module', 'is_active', 'is_downloaded', 'has_drm', 'created_at')
-    list_filter = ('module__course__platform', 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'created_at')
+    list_filter = (('module__course__platform', CachedRelatedFieldListFilter), 'is_active', 'is_downloaded', 'has_drm', 'is_locked', 'created_at')
+    list_select_related = ('module',)
     search_fields = ('name', 'description', 'external_id')
+    autocomplete_fields = ('module',)
     readonly_fields = ('created_at', 'updated_at', 'katomart_id')
     list_editable = ('is_active', 'is_downloaded')
     
@@ -255,12 +331,14 @@ class LessonAdmin(admin.ModelAdmin):
 
 
 @admin.register(File)
-class FileAdmin(admin.ModelAdmin):
+class FileAdmin(CatalogAdminMixin, admin.ModelAdmin):
     """Admin interface for Files"""
     
     list_display = ('name', 'lesson', 'order', 'is_primary_content', 'is_extra_content', 'file_type', 'file_size', 'is_downloaded', 'has_drm', 'created_at')
-    list_filter = ('lesson__module__course__platform', 'is_primary_content', 'is_extra_content', 'file_type', 'is_downloaded', 'has_drm', 'is_decrypted', 'created_at')
+    list_filter = (('lesson__module__course__platform', CachedRelatedFieldListFilter), 'is_primary_content', 'is_extra_content', ('file_type', CachedAllValuesFieldListFilter), 'is_downloaded', 'has_drm', 'is_decrypted', 'created_at')
+    list_select_related = ('lesson',)
     search_fields = ('name', 'description', 'external_id')
+    raw_id_fields = ('lesson',)  # a select of every lesson is unusable at this size
     readonly_fields = ('created_at', 'updated_at', 'katomart_id')
     list_editable = ('order', 'is_primary_content', 'is_extra_content', 'is_downloaded')
     
@@ -303,6 +381,7 @@ class UserFormattedNameAdmin(admin.ModelAdmin):
     
     list_display = ('user', 'content_type', 'object_id', 'formatted_name')
     list_filter = ('content_type',)
+    list_select_related = ('user',)
     search_fields = ('user__username', 'formatted_name')
     readonly_fields = ()
     
@@ -318,6 +397,7 @@ class UserConfigAdmin(admin.ModelAdmin):
     """Admin interface for User Configuration"""
     
     list_display = ('user', 'download_path', 'ffmpeg_path', 'bento4_path', 'aria2c_path')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'download_path')
     readonly_fields = ()
     
@@ -328,9 +408,64 @@ class UserConfigAdmin(admin.ModelAdmin):
         (_('Paths'), {
             'fields': ('download_path', 'ffmpeg_path', 'bento4_path', 'aria2c_path', 'geckodriver_path', 'chromedriver_path', 'mkvtoolnix_path', 'rclone_path')
         }),
+        (_('Streams'), {
+            'fields': ('stream_max_height', 'stream_quality')
+        }),
     )
 
 
+@admin.register(DownloadJob)
+class DownloadJobAdmin(admin.ModelAdmin):
+    """Admin interface for Download Jobs"""
+
+    list_display = ('id', 'user', 'course', 'backend', 'state', 'created_at', 'finished_at')
+    list_filter = ('state', 'backend')
+    list_select_related = ('user', 'course')
+    search_fields = ('user__username', 'course__name')
+    raw_id_fields = ('course',)
+    readonly_fields = ('created_at', 'updated_at', 'finished_at')
+
+
+@admin.register(DownloadTask)
+class DownloadTaskAdmin(admin.ModelAdmin):
+    """Admin interface for Download Tasks"""
+
+    list_display = ('id', 'job', 'file', 'state', 'bytes_done', 'bytes_total', 'attempts', 'lease_owner', 'lease_expires')
+    list_filter = ('state',)
+    list_select_related = ('job__user', 'file')
+    search_fields = ('file__name', 'lease_owner', 'last_error')
+    raw_id_fields = ('job', 'file')
+    readonly_fields = ('lease_owner', 'lease_expires', 'created_at', 'updated_at')
+
+
+@admin.register(WorkerHeartbeat)
+class WorkerHeartbeatAdmin(admin.ModelAdmin):
+    """Admin interface for Download Workers (live status reported by run_workers)"""
+
+    list_display = ('worker_id', 'hostname', 'pid', 'state', 'is_alive', 'active_tasks', 'throughput',
+                    'tasks_done', 'tasks_failed', 'downloaded', 'last_seen')
+    list_filter = ('state', 'hostname')
+    search_fields = ('worker_id', 'hostname')
+    readonly_fields = ('worker_id', 'hostname', 'pid', 'state', 'started_at', 'last_seen', 'active_tasks',
+                       'tasks_done', 'tasks_failed', 'bytes_downloaded', 'bytes_per_second')
+
+    @admin.display(boolean=True, description=_('Alive'))
+    def is_alive(self, obj):
+        # Workers beat every few seconds; a row that went quiet belongs to a dead process
+        return obj.state != 'stopped' and (timezone.now() - obj.last_seen).total_seconds() < 60
+
+    @admin.display(description=_('Throughput'), ordering='bytes_per_second')
+    def throughput(self, obj):
+        return f'{obj.bytes_per_second / 1024 / 1024:.1f} MiB/s'
+
+    @admin.display(description=_('Downloaded'), ordering='bytes_downloaded')
+    def downloaded(self, obj):
+        return f'{obj.bytes_downloaded / 1024 / 1024 / 1024:.2f} GiB'
+
+    def has_add_permission(self, request):
+        return False
+
+
 # Customize admin site
 admin.site.site_header = _('KatoMart Administration')
 admin.site.site_title = _('KatoMart Admin Portal')
@@ -12,4 +12,4 @@ class CoreConfig(AppConfig):
     def ready(self):
         # No database queries or integrity checks here per Django best practices.
         # All integrity checks should be run via a management command or at runtime, not at import/startup.
-        pass
+        from . import signals  # noqa: F401  (connects the cache invalidation receivers)
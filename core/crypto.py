@@ -0,0 +1,191 @@
+import base64
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from django.conf import settings
+
+# Credential envelope: k1$<kdf spec>$<salt>$<fernet token>, e.g.
+#   k1$scrypt:32768:8:1$<salt>$<token>   or   k1$pbkdf2:600000$<salt>$<token>
+# Anything without the prefix is a legacy token encrypted with get_fernet().
+ENVELOPE_VERSION = 'k1'
+SALT_BYTES = 16
+
+DEFAULT_KDF = {'algorithm': 'scrypt', 'n': 2 ** 15, 'r': 8, 'p': 1}
+DEFAULT_KEY_CACHE_SIZE = 256
+DEFAULT_KEY_CACHE_TTL = 600  # seconds
+
+
+def get_fernet(passphrase: str) -> Fernet:
+    # Legacy derivation (pad/truncate), only kept to read rows written before the envelope
+    key = base64.urlsafe_b64encode((passphrase * 32)[:32].encode())
+    return Fernet(key)
+
+
+def current_kdf_spec() -> str:
+    """The KDF spec new values are written with, from settings.KATOMART_KDF"""
+    params = {**DEFAULT_KDF, **getattr(settings, 'KATOMART_KDF', {})}
+    if params['algorithm'] == 'scrypt':
+        return f"scrypt:{int(params['n'])}:{int(params['r'])}:{int(params['p'])}"
+    if params['algorithm'] == 'pbkdf2':
+        return f"pbkdf2:{int(params.get('iterations', 600_000))}"
+    raise ValueError(f"Unsupported KDF algorithm: {params['algorithm']}")
+
+
+def _derive_key(spec: str, salt: bytes, passphrase: str) -> bytes:
+    algorithm, *args = spec.split(':')
+    if algorithm == 'scrypt':
+        n, r, p = (int(arg) for arg in args)
+        kdf = Scrypt(salt=salt, length=32, n=n, r=r, p=p)
+    elif algorithm == 'pbkdf2':
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=int(args[0]))
+    else:
+        raise ValueError(f'Unsupported KDF spec: {spec}')
+    return base64.urlsafe_b64encode(kdf.derive(passphrase.encode()))
+
+
+class DerivedKeyCache:
+    """
+    LRU of derived Fernet keys keyed by (kdf spec, salt, sha256(passphrase)).
+    The passphrase itself is never stored; entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize=DEFAULT_KEY_CACHE_SIZE, ttl=DEFAULT_KEY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(spec, salt, passphrase):
+        return spec, salt, hashlib.sha256(passphrase.encode()).digest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            fernet, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return fernet
+
+    def put(self, key, fernet):
+        with self._lock:
+            self._entries[key] = (fernet, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def wipe(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+key_cache = DerivedKeyCache(
+    maxsize=getattr(settings, 'KATOMART_KEY_CACHE_SIZE', DEFAULT_KEY_CACHE_SIZE),
+    ttl=getattr(settings, 'KATOMART_KEY_CACHE_TTL', DEFAULT_KEY_CACHE_TTL),
+)
+
+
+def wipe_key_cache():
+    """Drop every derived key held in memory (e.g. on logout or passphrase change)"""
+    key_cache.wipe()
+
+
+def derive_fernet(passphrase: str, salt: bytes, spec: str) -> Fernet:
+    key = DerivedKeyCache.cache_key(spec, salt, passphrase)
+    fernet = key_cache.get(key)
+    if fernet is None:
+        fernet = Fernet(_derive_key(spec, salt, passphrase))
+        key_cache.put(key, fernet)
+    return fernet
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def is_legacy_token(token: str) -> bool:
+    return not token.startswith(f'{ENVELOPE_VERSION}$')
+
+
+def parse_envelope(token: str):
+    """Split an envelope into (kdf spec, salt, fernet token); raises InvalidToken if malformed"""
+    try:
+        version, spec, salt, payload = token.split('$', 3)
+        if version != ENVELOPE_VERSION:
+            raise ValueError(version)
+        return spec, _b64decode(salt), payload
+    except ValueError:
+        raise InvalidToken('Malformed credential envelope')
+
+
+def encrypt_many(values, passphrase: str, salt: bytes = None):
+    """
+    Encrypt several values of one record under a single fresh salt, so the record
+    costs one key derivation to write and one to read back. None stays None.
+    """
+    salt = salt or os.urandom(SALT_BYTES)
+    spec = current_kdf_spec()
+    fernet = derive_fernet(passphrase, salt, spec)
+    header = f'{ENVELOPE_VERSION}${spec}${_b64encode(salt)}$'
+    return [None if value is None else header + fernet.encrypt(value.encode()).decode() for value in values]
+
+
+def encrypt_value(value: str, passphrase: str) -> str:
+    return encrypt_many([value], passphrase)[0]
+
+
+def decrypt_value(token: str, passphrase: str) -> str:
+    if is_legacy_token(token):
+        return get_fernet(passphrase).decrypt(token.encode()).decode()
+    spec, salt, payload = parse_envelope(token)
+    return derive_fernet(passphrase, salt, spec).decrypt(payload.encode()).decode()
+
+
+def decrypt_many(tokens, passphrase: str, max_workers: int = 4):
+    """
+    Decrypt a batch of tokens (possibly from many records). Each distinct salt is
+    derived once, in parallel, before decrypting; values that are empty or fail
+    to decrypt come back as None.
+    """
+    tokens = list(tokens)
+    pending = {}
+    for token in tokens:
+        if token and not is_legacy_token(token):
+            try:
+                spec, salt, _ = parse_envelope(token)
+            except InvalidToken:
+                continue
+            if key_cache.get(DerivedKeyCache.cache_key(spec, salt, passphrase)) is None:
+                pending[(spec, salt)] = None
+    if len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(lambda item: derive_fernet(passphrase, item[1], item[0]), pending))
+    results = []
+    for token in tokens:
+        if not token:
+            results.append(None)
+            continue
+        try:
+            results.append(decrypt_value(token, passphrase))
+        except (InvalidToken, ValueError):
+            results.append(None)
+    return results
@@ -0,0 +1,18 @@
+from .base import DownloadBackend, DownloadRequest, DownloadResult, DownloadStateWriter
+from .http import BandwidthLimiter, DownloadError, HttpDownloader
+from .aria2 import Aria2Backend, Aria2Daemon, Aria2Error
+from .manifests import ManifestError, Segment, Track, Variant, VariantPolicy
+from .streams import StreamDownloader
+from .engine import build_requests, download_files, get_backend
+from .pipeline import DiskBudget, DownloadPipeline
+from .tasks import TaskQueue, TaskWorker, enqueue_files, refresh_job_state
+
+__all__ = [
+    'DownloadBackend', 'DownloadRequest', 'DownloadResult', 'DownloadStateWriter',
+    'BandwidthLimiter', 'DownloadError', 'HttpDownloader',
+    'Aria2Backend', 'Aria2Daemon', 'Aria2Error',
+    'ManifestError', 'Segment', 'Track', 'Variant', 'VariantPolicy', 'StreamDownloader',
+    'build_requests', 'download_files', 'get_backend',
+    'DiskBudget', 'DownloadPipeline',
+    'TaskQueue', 'TaskWorker', 'enqueue_files', 'refresh_job_state',
+]
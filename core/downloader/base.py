@@ -0,0 +1,110 @@
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional
+
+from core.models import File
+
+# File.extra_data keys the platform scrapers fill in for downloadable content
+URL_KEY = 'url'
+HEADERS_KEY = 'headers'
+URL_PARAMS_KEY = 'url_params'  # fills the platform's 'download' PlatformURL template when there is no url
+DOWNLOAD_URL_KIND = 'download'
+DRM_KEYS_KEY = 'drm_keys'  # {kid: key} (hex) or a list of 'kid:key' strings, for mp4decrypt
+
+
+@dataclass
+class DownloadRequest:
+    file_id: int
+    url: str
+    path: Path
+    headers: dict = field(default_factory=dict)
+    expected_size: Optional[int] = None
+    host_key: Optional[str] = None  # overrides the URL host for per-host connection limits
+    session: Any = None  # PlatformSession of the course's PlatformAuth, supplies the auth headers
+
+    @property
+    def part_path(self) -> Path:
+        return self.path.with_name(self.path.name + '.part')
+
+    def current_headers(self) -> dict:
+        """`headers` over the session's auth headers, read (and refreshed if expiring) per HTTP request"""
+        if self.session is None:
+            return dict(self.headers)
+        return {**self.session.fresh_auth_headers(), **self.headers}
+
+    def reauthenticate(self) -> bool:
+        """Refresh the session's token after a 401; False when there is nothing to refresh"""
+        return self.session is not None and self.session.reauthenticate()
+
+
+@dataclass
+class DownloadResult:
+    file_id: int
+    path: Path
+    ok: bool
+    bytes_written: int = 0
+    error: Optional[str] = None
+    file_size: Optional[int] = None  # size of the finished file, stored on File
+    duration: Optional[int] = None  # seconds, when the backend knows it
+
+
+class DownloadBackend:
+    """
+    Interface shared by every transfer backend (in-process HTTP, aria2c, ...).
+    `download` blocks until every request finished or failed and yields results
+    as they complete; `progress(file_id, done, total)` may be called from any thread.
+    """
+    name = 'base'
+
+    def download(self, requests, progress=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DownloadStateWriter:
+    """Buffers finished/failed files and writes them back to File in batches"""
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self._done = []
+        self._failed = {}
+        self._metadata = []
+
+    def add(self, result: DownloadResult):
+        if result.ok:
+            self._done.append(result.file_id)
+            if result.file_size is not None or result.duration is not None:
+                self._metadata.append(result)
+        else:
+            self._failed[result.file_id] = result.error
+        if len(self._done) + len(self._failed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._done:
+            File.objects.filter(pk__in=self._done).update(  # type: ignore[attr-defined]
+                is_downloaded=True, download_date=int(time.time()))
+            self._done = []
+        if self._metadata:
+            for fields in (['file_size'], ['duration']):
+                rows = [File(pk=result.file_id, **{fields[0]: getattr(result, fields[0])})
+                        for result in self._metadata if getattr(result, fields[0]) is not None]
+                if rows:
+                    File.objects.bulk_update(rows, fields)  # type: ignore[attr-defined]
+            self._metadata = []
+        if self._failed:
+            # extra_data is per row, so failures can't be a single UPDATE; they are rare anyway
+            files = File.objects.filter(pk__in=list(self._failed)).only('internal_id', 'extra_data')  # type: ignore[attr-defined]
+            for file in files:
+                file.extra_data = {**(file.extra_data or {}), 'download_error': self._failed[file.pk]}
+            File.objects.bulk_update(files, ['extra_data'])  # type: ignore[attr-defined]
+            self._failed = {}
@@ -0,0 +1,101 @@
+from collections import defaultdict
+
+from core.models import Course, File
+from core.paths import PathPlanner
+from core.registry import get_platform_registry
+from core.sessions import SessionError, get_session_pool
+from .base import DownloadRequest, DownloadStateWriter, DOWNLOAD_URL_KIND, HEADERS_KEY, URL_KEY, URL_PARAMS_KEY
+from .http import HttpDownloader
+from .aria2 import Aria2Backend
+from .manifests import VariantPolicy
+from .streams import StreamDownloader
+
+
+def get_backend(name='http', user=None, **options):
+    """
+    Build a DownloadBackend by name. The user's own binaries (UserConfig.aria2c_path,
+    UserConfig.ffmpeg_path) win over the system-wide ones, and the stream backend
+    follows the user's rendition policy.
+    """
+    user_config = getattr(user, 'user_config', None) if user is not None and user.is_authenticated else None
+    if name == HttpDownloader.name:
+        return HttpDownloader(**options)
+    if name == Aria2Backend.name:
+        if user_config and user_config.aria2c_path and 'aria2c_path' not in options:
+            options['aria2c_path'] = user_config.aria2c_path
+        return Aria2Backend(**options)
+    if name == StreamDownloader.name:
+        if user_config and user_config.ffmpeg_path and 'ffmpeg_path' not in options:
+            options['ffmpeg_path'] = user_config.ffmpeg_path
+        options.setdefault('policy', VariantPolicy.for_user(user))
+        return StreamDownloader(**options)
+    raise ValueError(f'Unknown download backend: {name}')
+
+
+def build_requests(files, user):
+    """
+    Turn File rows into DownloadRequests, planning the target paths course by
+    course with PathPlanner. The platform's active 'download' PlatformURL (from
+    the PlatformRegistry) supplies default headers and, for files that only
+    carry extra_data['url_params'], the URL. Requests of a course with a
+    PlatformAuth carry its PlatformSession (from the process-wide SessionPool),
+    which the backends ask for current auth headers; without a passphrase to
+    decrypt the credentials they go out with the plain headers only.
+    Files without a source URL are skipped.
+    """
+    registry = get_platform_registry()
+    files = list(files)
+    course_of = dict(File.objects.filter(pk__in=[file.pk for file in files]).values_list(  # type: ignore[attr-defined]
+        'internal_id', 'lesson__module__course_id'))
+    by_course = defaultdict(list)
+    for file in files:
+        by_course[course_of.get(file.pk)].append(file)
+    by_course.pop(None, None)
+    courses = Course.objects.in_bulk(list(by_course))  # type: ignore[attr-defined]
+
+    sessions = {}
+    for auth_id in {course.auth_id for course in courses.values() if course.auth_id}:
+        try:
+            sessions[auth_id] = get_session_pool().get(auth_id)
+        except SessionError:
+            pass
+
+    requests = []
+    for course_id, course_files in by_course.items():
+        paths = PathPlanner(user, courses[course_id]).plan(file_ids=[file.pk for file in course_files])
+        session = sessions.get(courses[course_id].auth_id)
+        templates = registry.get_all(courses[course_id].platform_id, DOWNLOAD_URL_KIND)
+        template = templates[0] if templates else None
+        for file in course_files:
+            extra = file.extra_data or {}
+            url = extra.get(URL_KEY)
+            if not url and template is not None and isinstance(extra.get(URL_PARAMS_KEY), dict):
+                try:
+                    url = template.build(**extra[URL_PARAMS_KEY])
+                except KeyError:
+                    url = None
+            if not url or file.pk not in paths:
+                continue
+            headers = dict(template.headers) if template is not None else {}
+            headers.update(extra.get(HEADERS_KEY) or {})
+            requests.append(DownloadRequest(
+                file_id=file.pk, url=url, path=paths[file.pk], headers=headers, expected_size=file.file_size,
+                session=session))
+    return requests
+
+
+def download_files(files, user, backend, progress=None, batch_size=100):
+    """
+    Download `files` with `backend` and record the outcome on File in batches
+    (is_downloaded/download_date, or extra_data['download_error']).
+    Returns the list of DownloadResults.
+    """
+    writer = DownloadStateWriter(batch_size=batch_size)
+    results = []
+    try:
+        for result in backend.download(build_requests(files, user), progress=progress):
+            writer.add(result)
+            results.append(result)
+    finally:
+        writer.flush()
+    return results
@@ -0,0 +1,390 @@
+import http.client
+import json
+import os
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlsplit
+
+from .base import DownloadBackend, DownloadResult
+
+CHUNK_SIZE = 256 * 1024
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+USER_AGENT = 'katomart'
+MAX_REDIRECTS = 5
+DRAIN_LIMIT = 64 * 1024  # unread bytes worth reading to keep a connection alive
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every connection; rate is in bytes per second"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount or self._tokens >= self.capacity:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+
+class _PooledResponse:
+    """
+    An http.client response that gives its connection back to the pool once
+    read to the end (or nearly: a short remainder is drained) and closes it
+    otherwise. Usable as a context manager, like urlopen's responses.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+        response, connection = self._response, self._connection
+        if connection is None:
+            return
+        self._connection = None
+        reusable = not response.will_close
+        if reusable and not response.isclosed():
+            try:
+                if response.length is not None and response.length <= DRAIN_LIMIT:
+                    response.read()
+            except (http.client.HTTPException, OSError):
+                reusable = False
+            reusable = reusable and response.isclosed()
+        if reusable:
+            self._pool._release(self._key, connection)
+        else:
+            response.close()
+            connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections per host, so the segments of a file and the
+    files of a batch share TCP/TLS connections instead of opening one per
+    request. Redirects are followed; error statuses raise urllib's HTTPError
+    like urlopen does. URLs that go through a configured proxy use urlopen.
+    """
+
+    def __init__(self, timeout=30, max_idle_per_host=8):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = defaultdict(list)  # (scheme, netloc) -> idle connections
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context()
+        self._proxies = urllib.request.getproxies()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _request(self, key, target, headers):
+        while True:
+            with self._lock:
+                connection = self._idle[key].pop() if self._idle[key] else None
+            reused = connection is not None
+            connection = connection or self._connect(*key)
+            try:
+                connection.request('GET', target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server dropped the idle connection; try the next one, or a fresh one
+
+    def open(self, url, headers):
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise urllib.error.URLError(f'Unsupported URL scheme: {parts.scheme}')
+            if self._proxies.get(parts.scheme) and not urllib.request.proxy_bypass(parts.hostname or ''):
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+            key = (parts.scheme, parts.netloc)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            connection, response = self._request(key, target, headers)
+            pooled = _PooledResponse(self, key, connection, response)
+            if response.status in REDIRECT_CODES and response.headers.get('Location'):
+                pooled.close()
+                url = urljoin(url, response.headers['Location'])
+                continue
+            if response.status >= 400:
+                pooled.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+            return pooled
+        raise urllib.error.URLError(f'Too many redirects for {url}')
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class _PartState:
+    """
+    Completed byte ranges of a .part file, persisted next to it as .part.json so an
+    interrupted download resumes with only the missing segments.
+    """
+
+    def __init__(self, path, size, validator):
+        self.path = path
+        self.size = size
+        self.validator = validator
+        self.done = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, size, validator):
+        state = cls(path, size, validator)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return state
+        # A different size or ETag means the remote file changed: start over
+        if data.get('size') == size and data.get('validator') == validator:
+            state.done = {tuple(segment) for segment in data.get('done', [])}
+        return state
+
+    def mark(self, segment):
+        with self._lock:
+            self.done.add(segment)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            tmp.write_text(json.dumps({'size': self.size, 'validator': self.validator, 'done': sorted(self.done)}))
+            os.replace(tmp, self.path)
+
+    def discard(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class HttpDownloader(DownloadBackend):
+    """
+    In-process downloader using HTTP range requests.
+
+    Files larger than `segment_size` are split into segments fetched in parallel
+    over a bounded thread pool, at most `per_host_connections` at a time per
+    host and under an optional global `bandwidth_limit` (bytes/s). Connections
+    are kept alive and reused per host (ConnectionPool). Data lands in
+    `<name>.part` and is renamed into place once complete.
+    """
+    name = 'http'
+
+    def __init__(self, max_connections=8, max_files=4, per_host_connections=4, segment_size=DEFAULT_SEGMENT_SIZE,
+                 bandwidth_limit=None, retries=3, timeout=30):
+        self.max_connections = max_connections
+        self.max_files = max_files
+        self.per_host_connections = per_host_connections
+        self.segment_size = segment_size
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.retries = retries
+        self.timeout = timeout
+        self._host_slots = {}
+        self._host_lock = threading.Lock()
+        self._segments = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix='katomart-segment')
+        self._connections = ConnectionPool(timeout=timeout, max_idle_per_host=per_host_connections)
+
+    def close(self):
+        self._segments.shutdown(wait=True)
+        self._connections.close()
+
+    def download(self, requests, progress=None):
+        with ThreadPoolExecutor(max_workers=self.max_files, thread_name_prefix='katomart-file') as files:
+            futures = {files.submit(self._download_file, request, progress): request for request in requests}
+            for future in as_completed(futures):
+                request = futures[future]
+                try:
+                    yield future.result()
+                except Exception as exc:  # noqa: BLE001 - reported per file, the batch goes on
+                    yield DownloadResult(request.file_id, request.path, False, error=str(exc) or type(exc).__name__)
+
+    # -- HTTP helpers
+
+    def _host_slot(self, request):
+        key = request.host_key or urlsplit(request.url).netloc
+        with self._host_lock:
+            if key not in self._host_slots:
+                self._host_slots[key] = threading.BoundedSemaphore(self.per_host_connections)
+            return self._host_slots[key]
+
+    def _open(self, request, start=None, end=None):
+        for retried in (False, True):
+            headers = {'User-Agent': USER_AGENT, **request.current_headers()}
+            if start is not None:
+                headers['Range'] = f'bytes={start}-{"" if end is None else end}'
+            try:
+                return self._connections.open(request.url, headers)
+            except urllib.error.HTTPError as exc:
+                # A token rejected before its expiry: refresh it once and ask again
+                if exc.code != 401 or retried or not request.reauthenticate():
+                    raise
+
+    def _probe(self, request):
+        """Return (size or None, supports ranges, validator) using a one-byte range request"""
+        try:
+            with self._host_slot(request), self._open(request, 0, 0) as response:
+                validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+                if response.status == 206:
+                    content_range = response.headers.get('Content-Range', '')
+                    total = content_range.rpartition('/')[2]
+                    return (int(total) if total.isdigit() else None), True, validator
+                length = response.headers.get('Content-Length')
+                return (int(length) if length and length.isdigit() else None), False, validator
+        except urllib.error.HTTPError as exc:
+            if exc.code != 416:
+                raise
+            # Not even byte 0 exists: an empty file (Content-Range: bytes */0), or, without a total,
+            # something the plain GET will tell
+            total = (exc.headers.get('Content-Range') or '').rpartition('/')[2]
+            return (int(total) if total.isdigit() else None), False, None
+
+    def _copy(self, response, handle, counter, expected=None):
+        written = 0
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if self.limiter:
+                self.limiter.consume(len(chunk))
+            handle.write(chunk)
+            written += len(chunk)
+            counter(len(chunk))
+        if expected is not None and written != expected:
+            raise DownloadError(f'Short read: got {written} of {expected} bytes')
+        return written
+
+    def _with_retries(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except urllib.error.HTTPError as exc:
+                # Client errors other than throttling will not fix themselves
+                if 400 <= exc.code < 500 and exc.code not in (408, 429):
+                    raise DownloadError(f'HTTP {exc.code}') from exc
+                if attempt == self.retries:
+                    raise DownloadError(f'HTTP {exc.code}') from exc
+            except (urllib.error.URLError, OSError, DownloadError) as exc:
+                if attempt == self.retries:
+                    raise DownloadError(str(exc)) from exc
+            time.sleep(min(2 ** attempt, 30))
+
+    # -- transfers
+
+    def _download_file(self, request, progress):
+        request.path.parent.mkdir(parents=True, exist_ok=True)
+        size, ranged, validator = self._with_retries(self._probe, request)
+        if size is None and request.expected_size:
+            size = request.expected_size
+        done = [0]
+        done_lock = threading.Lock()
+
+        def counter(amount):
+            with done_lock:
+                done[0] += amount
+                current = done[0]
+            if progress:
+                progress(request.file_id, current, size)
+
+        if size == 0:
+            request.part_path.write_bytes(b'')
+        elif ranged and size:
+            self._download_segmented(request, size, validator, done, counter)
+        else:
+            self._with_retries(self._download_stream, request, counter)
+        os.replace(request.part_path, request.path)
+        return DownloadResult(request.file_id, request.path, True, bytes_written=done[0],
+                              file_size=request.path.stat().st_size)
+
+    def _download_stream(self, request, counter):
+        # Without range support there is nothing to resume from: rewrite the .part
+        with self._host_slot(request), self._open(request) as response, open(request.part_path, 'wb') as handle:
+            self._copy(response, handle, counter)
+
+    def _download_segmented(self, request, size, validator, done, counter):
+        state = _PartState.load(request.path.with_name(request.path.name + '.part.json'), size, validator)
+        part = request.part_path
+        if not state.done or not part.exists():
+            state.done = set()
+            with open(part, 'wb') as handle:
+                handle.truncate(size)
+        segments = [(start, min(start + self.segment_size, size) - 1) for start in range(0, size, self.segment_size)]
+        pending = [segment for segment in segments if segment not in state.done]
+        done[0] = sum(end - start + 1 for start, end in state.done)
+
+        def fetch(segment):
+            start, end = segment
+            written = [0]
+
+            def segment_counter(amount):
+                written[0] += amount
+                counter(amount)
+
+            try:
+                with self._host_slot(request), self._open(request, start, end) as response:
+                    if response.status != 206:
+                        raise DownloadError('Server ignored the Range header')
+                    with open(part, 'r+b') as handle:
+                        handle.seek(start)
+                        self._copy(response, handle, segment_counter, expected=end - start + 1)
+            except Exception:
+                # The retry rewrites the whole segment, so take its bytes back off the total
+                counter(-written[0])
+                raise
+            state.mark(segment)
+
+        futures = [self._segments.submit(self._with_retries, fetch, segment) for segment in pending]
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            # Finished segments stay recorded in .part.json for the next attempt
+            raise errors[0]
+        if part.stat().st_size != size:
+            raise DownloadError(f'Size mismatch: expected {size} bytes')
+        state.discard()
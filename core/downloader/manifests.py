@@ -0,0 +1,362 @@
+import math
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import Optional
+from urllib.parse import urljoin
+
+
+class ManifestError(Exception):
+    pass
+
+
+@dataclass
+class Segment:
+    url: str
+    duration: float = 0.0
+    byte_range: Optional[tuple] = None  # (first byte, last byte), inclusive
+    key_url: Optional[str] = None  # HLS AES-128
+    iv: Optional[bytes] = None
+
+
+@dataclass
+class Track:
+    kind: str  # 'video', 'audio' or 'muxed'
+    segments: list
+    init: Optional[Segment] = None
+
+    @property
+    def duration(self):
+        return sum(segment.duration for segment in self.segments)
+
+
+@dataclass
+class Variant:
+    """
+    One selectable rendition. DASH variants carry their Tracks already; HLS ones
+    point at the media playlists (`uri`, `audio_uri`) the Tracks are read from.
+    """
+    bandwidth: int = 0
+    width: Optional[int] = None
+    height: Optional[int] = None
+    codecs: str = ''
+    uri: Optional[str] = None  # HLS media playlist
+    audio_uri: Optional[str] = None  # HLS alternative audio playlist
+    tracks: list = field(default_factory=list)  # DASH: already resolved
+
+
+@dataclass
+class VariantPolicy:
+    """
+    Which rendition to download: the best (or smallest) one within `max_height`
+    and `max_bandwidth`. When nothing fits, the smallest rendition is used.
+    """
+    max_height: Optional[int] = None
+    max_bandwidth: Optional[int] = None
+    prefer: str = 'best'
+
+    @classmethod
+    def for_user(cls, user):
+        config = getattr(user, 'user_config', None) if user is not None and user.is_authenticated else None
+        if config is None:
+            return cls()
+        return cls(max_height=config.stream_max_height, prefer=config.stream_quality or 'best')
+
+    def choose(self, variants):
+        if not variants:
+            raise ManifestError('Manifest has no variants')
+        ranked = sorted(variants, key=lambda variant: (variant.height or 0, variant.bandwidth))
+        fitting = [
+            variant for variant in ranked
+            if (not self.max_height or not variant.height or variant.height <= self.max_height)
+            and (not self.max_bandwidth or variant.bandwidth <= self.max_bandwidth)
+        ]
+        if not fitting:
+            return ranked[0]
+        return fitting[0] if self.prefer == 'smallest' else fitting[-1]
+
+
+def sniff(text):
+    """'hls', 'dash' or None"""
+    head = text.lstrip('\ufeff \r\n\t')[:512]
+    if head.startswith('#EXTM3U'):
+        return 'hls'
+    if '<MPD' in head:
+        return 'dash'
+    return None
+
+
+# -- HLS
+
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _attributes(text):
+    return {key: value.strip('"') for key, value in _ATTR_RE.findall(text)}
+
+
+def _byte_range(spec, next_offset):
+    length, _, offset = spec.partition('@')
+    start = int(offset) if offset else next_offset
+    return start, start + int(length) - 1
+
+
+def parse_hls_master(text, base_url):
+    """Variants of a master playlist; a media playlist yields a single variant pointing at itself"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not any(line.startswith('#EXT-X-STREAM-INF') for line in lines):
+        return [Variant(uri=base_url)]
+    audio = {}
+    for line in lines:
+        if line.startswith('#EXT-X-MEDIA:'):
+            attrs = _attributes(line.partition(':')[2])
+            if attrs.get('TYPE') == 'AUDIO' and attrs.get('URI'):
+                group = attrs.get('GROUP-ID')
+                # The DEFAULT rendition of each group wins, else the first one listed
+                if group not in audio or attrs.get('DEFAULT') == 'YES':
+                    audio[group] = urljoin(base_url, attrs['URI'])
+    variants = []
+    for index, line in enumerate(lines):
+        if not line.startswith('#EXT-X-STREAM-INF:'):
+            continue
+        attrs = _attributes(line.partition(':')[2])
+        uri = next((candidate for candidate in lines[index + 1:] if not candidate.startswith('#')), None)
+        if uri is None:
+            continue
+        width, _, height = attrs.get('RESOLUTION', '').partition('x')
+        variants.append(Variant(
+            bandwidth=int(attrs.get('BANDWIDTH') or 0),
+            width=int(width) if width.isdigit() else None,
+            height=int(height) if height.isdigit() else None,
+            codecs=attrs.get('CODECS', ''),
+            uri=urljoin(base_url, uri),
+            audio_uri=audio.get(attrs.get('AUDIO')),
+        ))
+    return variants
+
+
+def parse_hls_media(text, base_url, kind='muxed'):
+    if '#EXT-X-ENDLIST' not in text and '#EXT-X-PLAYLIST-TYPE:VOD' not in text:
+        raise ManifestError('Live HLS playlists are not supported')
+    segments = []
+    init = None
+    duration = 0.0
+    sequence = 0
+    next_offset = 0
+    byte_range = None
+    key_url = key_iv = None
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        tag, _, value = line.partition(':')
+        if tag == '#EXT-X-MEDIA-SEQUENCE':
+            sequence = int(value)
+        elif tag == '#EXT-X-MAP':
+            attrs = _attributes(value)
+            init = Segment(urljoin(base_url, attrs['URI']))
+            if attrs.get('BYTERANGE'):
+                init.byte_range = _byte_range(attrs['BYTERANGE'], 0)
+        elif tag == '#EXT-X-KEY':
+            attrs = _attributes(value)
+            method = attrs.get('METHOD', 'NONE')
+            if method == 'NONE':
+                key_url = key_iv = None
+            elif method == 'AES-128':
+                key_url = urljoin(base_url, attrs['URI'])
+                key_iv = bytes.fromhex(attrs['IV'][2:].rjust(32, '0')) if attrs.get('IV') else None
+            else:
+                raise ManifestError(f'Unsupported HLS encryption: {method}')
+        elif tag == '#EXTINF':
+            duration = float(value.split(',')[0] or 0)
+        elif tag == '#EXT-X-BYTERANGE':
+            byte_range = _byte_range(value, next_offset)
+        elif not line.startswith('#'):
+            segment = Segment(urljoin(base_url, line), duration, byte_range)
+            if key_url:
+                # Without an explicit IV the media sequence number is the IV
+                segment.key_url = key_url
+                segment.iv = key_iv or (sequence + len(segments)).to_bytes(16, 'big')
+            segments.append(segment)
+            if byte_range:
+                next_offset = byte_range[1] + 1
+            duration = 0.0
+            byte_range = None
+    if not segments:
+        raise ManifestError('HLS playlist has no segments')
+    return Track(kind, segments, init)
+
+
+# -- DASH
+
+_DURATION_RE = re.compile(r'P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?')
+_TEMPLATE_RE = re.compile(r'\$(RepresentationID|Number|Time|Bandwidth)(?:%0(\d+)d)?\$')
+
+
+def _iso_duration(value):
+    match = _DURATION_RE.fullmatch(value or '')
+    if not match:
+        return 0.0
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds or 0)
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def _child(element, name):
+    return next((child for child in element if _local(child.tag) == name), None)
+
+
+def _children(element, name):
+    return [child for child in element if _local(child.tag) == name]
+
+
+def _fill(template, representation_id, bandwidth, number=None, time=None):
+    values = {'RepresentationID': representation_id, 'Bandwidth': bandwidth, 'Number': number, 'Time': time}
+
+    def substitute(match):
+        value = values[match.group(1)]
+        return str(value).zfill(int(match.group(2))) if match.group(2) else str(value)
+    return _TEMPLATE_RE.sub(substitute, template).replace('$$', '$')
+
+
+def _template_segments(template, base_url, representation_id, bandwidth, period_duration):
+    timescale = int(template.get('timescale') or 1)
+    number = int(template.get('startNumber') or 1)
+    media = template.get('media')
+    if not media:
+        raise ManifestError('SegmentTemplate without @media')
+    init = None
+    if template.get('initialization'):
+        init = Segment(urljoin(base_url, _fill(template.get('initialization'), representation_id, bandwidth)))
+    segments = []
+    timeline = _child(template, 'SegmentTimeline')
+    if timeline is not None:
+        time = 0
+        entries = _children(timeline, 'S')
+        for index, entry in enumerate(entries):
+            time = int(entry.get('t', time))
+            duration = int(entry.get('d'))
+            repeat = int(entry.get('r', 0))
+            if repeat < 0:
+                # Repeat until the next S@t, or the end of the period
+                following = entries[index + 1].get('t') if index + 1 < len(entries) else None
+                end = int(following) if following is not None else period_duration * timescale
+                repeat = math.ceil((end - time) / duration) - 1
+            for _ in range(repeat + 1):
+                segments.append(Segment(
+                    urljoin(base_url, _fill(media, representation_id, bandwidth, number, time)), duration / timescale))
+                time += duration
+                number += 1
+    else:
+        duration = int(template.get('duration') or 0)
+        if not duration or not period_duration:
+            raise ManifestError('SegmentTemplate needs @duration and a known period duration')
+        count = math.ceil(period_duration * timescale / duration)
+        for index in range(count):
+            length = min(duration, period_duration * timescale - index * duration)
+            segments.append(Segment(
+                urljoin(base_url, _fill(media, representation_id, bandwidth, number + index, index * duration)),
+                length / timescale))
+    return init, segments
+
+
+def _list_segments(segment_list, base_url, period_duration):
+    timescale = int(segment_list.get('timescale') or 1)
+    duration = int(segment_list.get('duration') or 0) / timescale
+    init = None
+    initialization = _child(segment_list, 'Initialization')
+    if initialization is not None:
+        init = Segment(urljoin(base_url, initialization.get('sourceURL') or base_url))
+        if initialization.get('range'):
+            init.byte_range = tuple(int(part) for part in initialization.get('range').split('-'))
+    segments = []
+    for entry in _children(segment_list, 'SegmentURL'):
+        segment = Segment(urljoin(base_url, entry.get('media') or base_url), duration)
+        if entry.get('mediaRange'):
+            segment.byte_range = tuple(int(part) for part in entry.get('mediaRange').split('-'))
+        segments.append(segment)
+    if segments and not duration and period_duration:
+        for segment in segments:
+            segment.duration = period_duration / len(segments)
+    return init, segments
+
+
+def _merged(*elements):
+    """Inherit SegmentTemplate attributes down AdaptationSet -> Representation"""
+    merged = None
+    for element in elements:
+        if element is None:
+            continue
+        if merged is None:
+            merged = ET.Element(element.tag, dict(element.attrib))
+            merged.extend(list(element))
+        else:
+            merged.attrib.update(element.attrib)
+            if len(element):
+                for child in list(merged):
+                    merged.remove(child)
+                merged.extend(list(element))
+    return merged
+
+
+def _base(element, base_url):
+    base = _child(element, 'BaseURL')
+    return urljoin(base_url, base.text.strip()) if base is not None and base.text else base_url
+
+
+def parse_mpd(text, base_url):
+    """
+    Variants of a static MPD: one per video Representation, each paired with the
+    highest-bandwidth audio Representation. Only the first Period is used.
+    """
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError as exc:
+        raise ManifestError(f'Invalid MPD: {exc}') from exc
+    if root.get('type') == 'dynamic':
+        raise ManifestError('Live DASH manifests are not supported')
+    period = _child(root, 'Period')
+    if period is None:
+        raise ManifestError('MPD has no Period')
+    period_duration = _iso_duration(period.get('duration') or root.get('mediaPresentationDuration'))
+    period_base = _base(period, _base(root, base_url))
+
+    renditions = {'video': [], 'audio': []}
+    for adaptation in _children(period, 'AdaptationSet'):
+        adaptation_base = _base(adaptation, period_base)
+        for representation in _children(adaptation, 'Representation'):
+            mime = representation.get('mimeType') or adaptation.get('mimeType') or ''
+            kind = adaptation.get('contentType') or mime.partition('/')[0]
+            if kind not in renditions:
+                continue
+            representation_id = representation.get('id', '')
+            bandwidth = int(representation.get('bandwidth') or 0)
+            url = _base(representation, adaptation_base)
+            template = _merged(_child(adaptation, 'SegmentTemplate'), _child(representation, 'SegmentTemplate'))
+            segment_list = _child(representation, 'SegmentList')
+            if segment_list is None:
+                segment_list = _child(adaptation, 'SegmentList')
+            if template is not None:
+                init, segments = _template_segments(template, url, representation_id, bandwidth, period_duration)
+            elif segment_list is not None:
+                init, segments = _list_segments(segment_list, url, period_duration)
+            else:
+                # SegmentBase / plain BaseURL: the representation is one file
+                init, segments = None, [Segment(url, period_duration)]
+            height = representation.get('height') or adaptation.get('height')
+            width = representation.get('width') or adaptation.get('width')
+            renditions[kind].append(Variant(
+                bandwidth=bandwidth, width=int(width) if width else None, height=int(height) if height else None,
+                codecs=representation.get('codecs') or adaptation.get('codecs') or '',
+                tracks=[Track(kind, segments, init)]))
+
+    audio = max(renditions['audio'], key=lambda variant: variant.bandwidth, default=None)
+    if not renditions['video']:
+        return [audio] if audio else []
+    for variant in renditions['video']:
+        if audio:
+            variant.tracks = variant.tracks + audio.tracks
+    return renditions['video']
@@ -0,0 +1,307 @@
+import os
+import queue
+import shutil
+import subprocess
+import threading
+from dataclasses import dataclass, replace
+
+from django.db import close_old_connections, connection
+
+from core.models import File, SystemConfig, get_user_download_path
+from .base import DRM_KEYS_KEY, DownloadResult, DownloadStateWriter
+from .engine import build_requests
+from .http import DownloadError
+from .streams import CONTAINER_FORMATS
+
+DECRYPT_TIMEOUT = 3600  # seconds
+_STOP = object()
+
+
+class DiskBudget:
+    """
+    Download backpressure: downloads wait while the encrypted files queued for
+    decryption add up to more than `max_pending_bytes`, or while the target
+    filesystem has less than `min_free_bytes` left. Decrypting needs room for a
+    second copy of each file, so without this downloads could fill the disk.
+    """
+
+    def __init__(self, path, max_pending_bytes=None, min_free_bytes=None, poll_interval=1.0):
+        self.path = path
+        self.max_pending_bytes = max_pending_bytes
+        self.min_free_bytes = min_free_bytes
+        self.poll_interval = poll_interval
+        self.pending = 0
+        self._condition = threading.Condition()
+
+    def _free(self):
+        try:
+            return shutil.disk_usage(self.path).free
+        except OSError:
+            return None
+
+    def _blocked(self):
+        if self.max_pending_bytes is not None and self.pending > self.max_pending_bytes:
+            return True
+        if self.min_free_bytes is not None:
+            free = self._free()
+            return free is not None and free < self.min_free_bytes
+        return False
+
+    def wait(self):
+        with self._condition:
+            while self._blocked():
+                # Free space also changes outside the pipeline, so poll rather than wait forever
+                self._condition.wait(self.poll_interval)
+
+    def add(self, amount):
+        with self._condition:
+            self.pending += amount
+
+    def release(self, amount):
+        with self._condition:
+            self.pending = max(0, self.pending - amount)
+            self._condition.notify_all()
+
+
+class _Stage:
+    """A bounded pool of worker threads fed by its own bounded queue"""
+
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._threads = [
+            threading.Thread(target=self._run, name=f'katomart-{name}-{index}', daemon=True)
+            for index in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item):
+        # Blocks while the stage is saturated: that is the backpressure on the stage before
+        self.queue.put(item)
+
+    def close(self):
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _STOP:
+                    return
+                try:
+                    self.handler(item)
+                except Exception:  # noqa: BLE001 - handlers record their own failures
+                    # One bad item must not take the worker down and stall the stage
+                    pass
+        finally:
+            # Worker threads get their own DB connection; don't leak it
+            connection.close()
+
+
+@dataclass
+class _Job:
+    request: object
+    file: File
+    result: DownloadResult = None
+
+
+def _fsync(path):
+    # Windows refuses fsync on a read-only descriptor
+    with open(path, 'rb+') as fh:
+        os.fsync(fh.fileno())
+
+
+def _fsync_dir(path):
+    """Make a rename in `path` durable; directories can't be opened for that on Windows"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _key_args(file):
+    keys = (file.extra_data or {}).get(DRM_KEYS_KEY) or {}
+    pairs = keys.items() if isinstance(keys, dict) else (entry.split(':', 1) for entry in keys)
+    args = []
+    for kid, key in pairs:
+        args += ['--key', f'{kid.replace("-", "").lower()}:{key.lower()}']
+    return args
+
+
+def _record_error(file_id, key, message):
+    file = File.objects.filter(pk=file_id).only('internal_id', 'extra_data').first()  # type: ignore[attr-defined]
+    if file is not None:
+        file.extra_data = {**(file.extra_data or {}), key: message}
+        file.save(update_fields=['extra_data'])
+
+
+class DownloadPipeline:
+    """
+    download -> decrypt (mp4decrypt) -> optional remux (ffmpeg -c copy), each stage
+    a bounded worker pool with its own queue, so DRM files are decrypted while
+    later files are still downloading.
+
+    Decrypted output is written next to the file, fsync'd and renamed over the
+    encrypted copy before `is_decrypted` is flipped with a conditional UPDATE, so
+    the flag is never set for data that isn't on disk. Files already downloaded
+    but not decrypted (from an interrupted run) go straight to the decrypt stage.
+    """
+
+    def __init__(self, user, backend, mp4decrypt_path=None, ffmpeg_path=None, remux=False, download_drm=None,
+                 download_workers=4, decrypt_workers=2, mux_workers=1, queue_size=8,
+                 max_pending_bytes=None, min_free_bytes=None, batch_size=100):
+        config = SystemConfig.get_solo()
+        user_config = getattr(user, 'user_config', None) if user.is_authenticated else None
+        self.user = user
+        self.backend = backend
+        self.mp4decrypt_path = mp4decrypt_path or (user_config and user_config.bento4_path) or config.bento4_path
+        self.ffmpeg_path = ffmpeg_path or (user_config and user_config.ffmpeg_path) or config.ffmpeg_path
+        self.remux = remux
+        self.download_drm = config.should_download_drm_content if download_drm is None else download_drm
+        if self.download_drm and not self.mp4decrypt_path:
+            raise DownloadError('DRM content needs mp4decrypt (bento4), which is not available')
+        if remux and not self.ffmpeg_path:
+            raise DownloadError('Remuxing needs ffmpeg, which is not available')
+        self.download_workers = download_workers
+        self.decrypt_workers = decrypt_workers
+        self.mux_workers = mux_workers
+        self.queue_size = queue_size
+        self.max_pending_bytes = max_pending_bytes
+        self.min_free_bytes = min_free_bytes
+        self.batch_size = batch_size
+
+    def run(self, files, progress=None):
+        """Process `files`; returns one DownloadResult per file (the outcome of its last stage)"""
+        files = [file for file in files if self.download_drm or not file.has_drm]
+        requests = build_requests(files, self.user)
+        if not requests:
+            return []
+        by_id = {file.pk: file for file in files}
+        budget = DiskBudget(get_user_download_path(self.user), self.max_pending_bytes, self.min_free_bytes)
+        writer = DownloadStateWriter(batch_size=self.batch_size)
+        writer_lock = threading.Lock()
+        results = {}
+        results_lock = threading.Lock()
+
+        def finish(job):
+            with results_lock:
+                results[job.request.file_id] = job.result
+
+        def download(job):
+            budget.wait()
+            try:
+                result = next(iter(list(self.backend.download([job.request], progress=progress))), None)
+            except Exception as exc:  # noqa: BLE001 - e.g. the backend could not start
+                result = DownloadResult(job.request.file_id, job.request.path, False, error=str(exc))
+            if result is None:
+                result = DownloadResult(job.request.file_id, job.request.path, False, error='Backend returned nothing')
+            job.result = result
+            with writer_lock:
+                # A DRM file's size is recorded once it is decrypted, not the encrypted one
+                writer.add(replace(result, file_size=None) if job.file.has_drm else result)
+            if result.ok and job.file.has_drm:
+                budget.add(result.file_size or 0)
+                decrypt.put(job)
+            elif result.ok and self.remux:
+                mux.put(job)
+            else:
+                finish(job)
+
+        def decrypt_job(job):
+            size = job.result.file_size or 0
+            try:
+                self._decrypt(job.file, job.request.path)
+            except Exception as exc:  # noqa: BLE001 - recorded per file
+                job.result = DownloadResult(job.file.pk, job.request.path, False, error=str(exc))
+                _record_error(job.file.pk, 'decrypt_error', str(exc))
+                finish(job)
+                return
+            finally:
+                budget.release(size)
+            if self.remux:
+                mux.put(job)
+            else:
+                finish(job)
+
+        def mux_job(job):
+            try:
+                self._remux(job.request.path)
+            except Exception as exc:  # noqa: BLE001 - the file itself is fine, only the remux failed
+                _record_error(job.file.pk, 'remux_error', str(exc))
+            finish(job)
+
+        mux = _Stage('mux', mux_job, self.mux_workers, self.queue_size)
+        decrypt = _Stage('decrypt', decrypt_job, self.decrypt_workers, self.queue_size)
+        downloads = _Stage('download', download, self.download_workers, self.queue_size)
+        for stage in (mux, decrypt, downloads):
+            stage.start()
+        try:
+            for request in requests:
+                file = by_id[request.file_id]
+                job = _Job(request, file)
+                if file.has_drm and file.is_downloaded and not file.is_decrypted and request.path.exists():
+                    # Left over from an interrupted run: only the decryption is missing
+                    job.result = DownloadResult(file.pk, request.path, True, file_size=request.path.stat().st_size)
+                    decrypt.put(job)
+                elif file.is_downloaded and (not file.has_drm or file.is_decrypted) and request.path.exists():
+                    continue
+                else:
+                    downloads.put(job)
+        finally:
+            # Upstream first, so every job has reached its last stage before the next one stops
+            downloads.close()
+            decrypt.close()
+            mux.close()
+            with writer_lock:
+                writer.flush()
+            close_old_connections()
+        return [results[request.file_id] for request in requests if request.file_id in results]
+
+    def _decrypt(self, file, path):
+        key_args = _key_args(file)
+        if not key_args:
+            raise DownloadError(f"No decryption keys in extra_data['{DRM_KEYS_KEY}']")
+        output = path.with_name(path.name + '.decrypted')
+        try:
+            completed = subprocess.run([self.mp4decrypt_path, *key_args, str(path), str(output)],
+                                       capture_output=True, text=True, timeout=DECRYPT_TIMEOUT, check=False)
+        except (OSError, subprocess.SubprocessError) as exc:
+            raise DownloadError(f'mp4decrypt failed: {exc}') from exc
+        if completed.returncode != 0 or not output.exists():
+            output.unlink(missing_ok=True)
+            raise DownloadError(f'mp4decrypt failed: {(completed.stderr or completed.stdout).strip()[-500:]}')
+        # Durable before it replaces the encrypted copy and before the flag says so
+        _fsync(output)
+        os.replace(output, path)
+        _fsync_dir(path.parent)
+        File.objects.filter(pk=file.pk, is_decrypted=False).update(  # type: ignore[attr-defined]
+            is_decrypted=True, file_size=path.stat().st_size)
+
+    def _remux(self, path):
+        output = path.with_name(path.name + '.remux')
+        container = CONTAINER_FORMATS.get(path.suffix.lstrip('.').lower(), 'mp4')
+        command = [self.ffmpeg_path, '-nostdin', '-y', '-loglevel', 'error', '-i', str(path), '-map', '0',
+                   '-c', 'copy', '-f', container]
+        if container == 'mp4':
+            command += ['-movflags', '+faststart']
+        try:
+            completed = subprocess.run([*command, str(output)], capture_output=True, text=True,
+                                       timeout=DECRYPT_TIMEOUT, check=False)
+        except (OSError, subprocess.SubprocessError) as exc:
+            raise DownloadError(f'ffmpeg failed: {exc}') from exc
+        if completed.returncode != 0:
+            output.unlink(missing_ok=True)
+            raise DownloadError(f'ffmpeg failed: {completed.stderr.strip()[-500:]}')
+        _fsync(output)
+        os.replace(output, path)
+        _fsync_dir(path.parent)
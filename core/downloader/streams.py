@@ -0,0 +1,241 @@
+import functools
+import io
+import os
+import shutil
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from core.models import SystemConfig
+from .base import DownloadBackend, DownloadResult
+from .http import DownloadError, USER_AGENT
+from .manifests import ManifestError, VariantPolicy, parse_hls_master, parse_hls_media, parse_mpd, sniff
+
+# ffmpeg muxer for the extensions File.file_type usually maps to; anything else gets mp4
+CONTAINER_FORMATS = {'mp4': 'mp4', 'm4v': 'mp4', 'm4a': 'mp4', 'mov': 'mov', 'mkv': 'matroska',
+                     'webm': 'webm', 'ts': 'mpegts'}
+MUX_TIMEOUT = 3600  # seconds
+CHUNK_SIZE = 1024 * 1024
+
+
+class StreamDownloader(DownloadBackend):
+    """
+    DownloadBackend for HLS (m3u8) and DASH (MPD) manifests.
+
+    The rendition is picked by a VariantPolicy, its segments are fetched in
+    parallel (with retries) into `<name>.parts/`, concatenated per track and
+    muxed with `ffmpeg -c copy`, so nothing is re-encoded. Segments already in
+    `.parts/` are not fetched again when a download is retried.
+    """
+    name = 'stream'
+
+    def __init__(self, ffmpeg_path=None, policy=None, max_files=2, segment_workers=8, retries=3, timeout=30,
+                 keep_segments=False):
+        self.ffmpeg_path = ffmpeg_path or SystemConfig.get_solo().ffmpeg_path
+        self.policy = policy or VariantPolicy()
+        self.max_files = max_files
+        self.retries = retries
+        self.timeout = timeout
+        self.keep_segments = keep_segments
+        self._segments = ThreadPoolExecutor(max_workers=segment_workers, thread_name_prefix='katomart-stream')
+
+    def close(self):
+        self._segments.shutdown(wait=True)
+
+    def download(self, requests, progress=None):
+        with ThreadPoolExecutor(max_workers=self.max_files, thread_name_prefix='katomart-manifest') as files:
+            futures = {files.submit(self._download_stream, request, progress): request for request in requests}
+            for future in as_completed(futures):
+                request = futures[future]
+                try:
+                    yield future.result()
+                except Exception as exc:  # noqa: BLE001 - reported per file, the batch goes on
+                    yield DownloadResult(request.file_id, request.path, False, error=str(exc) or type(exc).__name__)
+
+    # -- HTTP
+
+    def _open(self, request, url, byte_range=None):
+        for retried in (False, True):
+            headers = {'User-Agent': USER_AGENT, **request.current_headers()}
+            if byte_range:
+                headers['Range'] = f'bytes={byte_range[0]}-{byte_range[1]}'
+            try:
+                return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout)
+            except urllib.error.HTTPError as exc:
+                # A token rejected before its expiry: refresh it once and ask again
+                if exc.code != 401 or retried or not request.reauthenticate():
+                    raise
+
+    def _fetch(self, request, url, byte_range=None, output=None, decrypt=None, progress=None):
+        """
+        GET `url` for `request` (or `byte_range` of it), with its current auth headers. The body is streamed into `output` in
+        chunks when given, so a whole-file DASH representation never sits in
+        memory, and returned otherwise (manifests, keys). `decrypt` builds a
+        fresh _AES128Decryptor per attempt; `progress(n)` gets the bytes
+        written, negative when a failed attempt's output is thrown away.
+        """
+        buffer = output if output is not None else io.BytesIO()
+        for attempt in range(self.retries + 1):
+            written, finished = 0, False
+            buffer.seek(0)
+            buffer.truncate()
+            try:
+                with self._open(request, url, byte_range) as response:
+                    # A server ignoring Range sends the whole body; cut the range out of it
+                    skip = byte_range[0] if byte_range and response.status != 206 else 0
+                    remaining = byte_range[1] - byte_range[0] + 1 if byte_range else None
+                    decryptor = decrypt() if decrypt else None
+                    while remaining != 0:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if skip:
+                            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if remaining is not None:
+                            chunk = chunk[:remaining]
+                            remaining -= len(chunk)
+                        if decryptor:
+                            chunk = decryptor.update(chunk)
+                        buffer.write(chunk)
+                        written += len(chunk)
+                        if progress and chunk:
+                            progress(len(chunk))
+                    if decryptor:
+                        tail = decryptor.finalize()
+                        buffer.write(tail)
+                        written += len(tail)
+                        if progress and tail:
+                            progress(len(tail))
+                finished = True
+                return None if output is not None else buffer.getvalue()
+            except urllib.error.HTTPError as exc:
+                if (400 <= exc.code < 500 and exc.code not in (408, 429)) or attempt == self.retries:
+                    raise DownloadError(f'HTTP {exc.code} for {url}') from exc
+            except (urllib.error.URLError, OSError) as exc:
+                if attempt == self.retries:
+                    raise DownloadError(f'{exc} for {url}') from exc
+            finally:
+                if progress and written and not finished:
+                    progress(-written)
+            time.sleep(min(2 ** attempt, 30))
+
+    # -- manifests
+
+    def _tracks(self, request):
+        text = self._fetch(request, request.url).decode('utf-8-sig', errors='replace')
+        kind = sniff(text)
+        if kind == 'dash':
+            return self.policy.choose(parse_mpd(text, request.url)).tracks
+        if kind != 'hls':
+            raise ManifestError('Not an HLS or DASH manifest')
+        variant = self.policy.choose(parse_hls_master(text, request.url))
+        if variant.uri != request.url:
+            text = self._fetch(request, variant.uri).decode('utf-8-sig', errors='replace')
+        tracks = [parse_hls_media(text, variant.uri, 'video' if variant.audio_uri else 'muxed')]
+        if variant.audio_uri:
+            audio = self._fetch(request, variant.audio_uri).decode('utf-8-sig', errors='replace')
+            tracks.append(parse_hls_media(audio, variant.audio_uri, 'audio'))
+        return tracks
+
+    # -- transfers
+
+    def _download_stream(self, request, progress):
+        tracks = self._tracks(request)
+        work = request.path.with_name(request.path.name + '.parts')
+        work.mkdir(parents=True, exist_ok=True)
+        keys = {}
+        keys_lock = threading.Lock()
+        done = [0]
+        done_lock = threading.Lock()
+
+        def advance(size):
+            with done_lock:
+                done[0] += size
+                current = done[0]
+            if progress:
+                progress(request.file_id, current, None)
+
+        def fetch(segment, target):
+            if target.exists():
+                advance(target.stat().st_size)
+                return
+            decrypt = None
+            if segment.key_url:
+                with keys_lock:
+                    if segment.key_url not in keys:
+                        keys[segment.key_url] = self._fetch(request, segment.key_url)
+                decrypt = functools.partial(_AES128Decryptor, keys[segment.key_url], segment.iv)
+            tmp = target.with_name(target.name + '.tmp')
+            with open(tmp, 'wb') as output:
+                self._fetch(request, segment.url, segment.byte_range, output=output, decrypt=decrypt,
+                            progress=advance)
+            os.replace(tmp, target)
+
+        track_files = []
+        for index, track in enumerate(tracks):
+            parts = ([track.init] if track.init else []) + track.segments
+            targets = [work / f'{index}-{number:06d}' for number in range(len(parts))]
+            futures = [self._segments.submit(fetch, segment, target) for segment, target in zip(parts, targets)]
+            errors = [error for error in (future.exception() for future in futures) if error is not None]
+            if errors:
+                # Fetched segments stay in .parts/ for the next attempt
+                raise errors[0]
+            track_file = work / f'track{index}{_track_extension(track)}'
+            with open(track_file, 'wb') as output:
+                for target in targets:
+                    with open(target, 'rb') as source:
+                        shutil.copyfileobj(source, output, 1024 * 1024)
+            track_files.append(track_file)
+
+        self._mux(track_files, request.part_path, request.path.suffix.lstrip('.').lower())
+        os.replace(request.part_path, request.path)
+        if not self.keep_segments:
+            shutil.rmtree(work, ignore_errors=True)
+        size = request.path.stat().st_size
+        duration = max(track.duration for track in tracks)
+        return DownloadResult(request.file_id, request.path, True, bytes_written=done[0], file_size=size,
+                              duration=int(round(duration)) if duration else None)
+
+    def _mux(self, track_files, output, extension):
+        if not self.ffmpeg_path:
+            raise DownloadError('ffmpeg is required to mux HLS/DASH streams (SystemConfig.ffmpeg_path is empty)')
+        command = [self.ffmpeg_path, '-nostdin', '-y', '-loglevel', 'error']
+        for track_file in track_files:
+            command += ['-i', str(track_file)]
+        for index in range(len(track_files)):
+            command += ['-map', str(index)]
+        command += ['-c', 'copy', '-f', CONTAINER_FORMATS.get(extension, 'mp4'), str(output)]
+        try:
+            completed = subprocess.run(command, capture_output=True, text=True, timeout=MUX_TIMEOUT, check=False)
+        except (OSError, subprocess.SubprocessError) as exc:
+            raise DownloadError(f'ffmpeg failed: {exc}') from exc
+        if completed.returncode != 0:
+            raise DownloadError(f'ffmpeg failed: {completed.stderr.strip()[-500:]}')
+
+
+def _track_extension(track):
+    if track.init:
+        return '.mp4'
+    suffix = Path(track.segments[0].url.split('?')[0]).suffix.lower()
+    return suffix if suffix in ('.ts', '.mp4', '.m4s', '.aac', '.webm') else '.ts'
+
+
+class _AES128Decryptor:
+    """Incremental AES-128-CBC decryption with PKCS7 unpadding, for HLS segments streamed in chunks"""
+
+    def __init__(self, key, iv):
+        self._decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        self._unpadder = padding.PKCS7(128).unpadder()
+
+    def update(self, data):
+        return self._unpadder.update(self._decryptor.update(data))
+
+    def finalize(self):
+        return self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
@@ -0,0 +1,288 @@
+import os
+import socket
+import threading
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import BigIntegerField, Case, Count, F, Q, Value, When
+from django.utils import timezone
+
+from core.models import DownloadJob, DownloadTask, File
+from .base import DownloadStateWriter
+from .engine import build_requests
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 30  # doubled per attempt
+MAX_RETRY_BACKOFF_SECONDS = 3600
+DEFER_SECONDS = 3600  # how long a task waits for a PlatformURL's visitation limit to be raised or reset
+ACTIVE_STATES = ('pending', 'running')
+
+
+def make_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+def enqueue_files(user, files, course=None, backend='http'):
+    """
+    Create a DownloadJob with one task per file that still has to be downloaded
+    and isn't queued already (by this or any other job). Returns the job, or
+    None when there is nothing to do.
+    """
+    file_ids = [file.pk if isinstance(file, File) else file for file in files]
+    sizes = dict(File.objects.filter(  # type: ignore[attr-defined]
+        pk__in=file_ids, should_download=True, is_downloaded=False,
+    ).exclude(download_tasks__state__in=ACTIVE_STATES).values_list('internal_id', 'file_size'))
+    if not sizes:
+        return None
+    with transaction.atomic():
+        job = DownloadJob.objects.create(user=user, course=course, backend=backend)  # type: ignore[attr-defined]
+        # A concurrent enqueue may have queued some of them meanwhile; the unique constraint skips those
+        DownloadTask.objects.bulk_create(  # type: ignore[attr-defined]
+            [DownloadTask(job=job, file_id=file_id, bytes_total=size) for file_id, size in sizes.items()],
+            batch_size=500, ignore_conflicts=True)
+        if not job.tasks.exists():
+            job.delete()
+            return None
+    return job
+
+
+def refresh_job_state(job_ids):
+    """Roll task states up into their jobs: done, failed (nothing left to run) or running"""
+    counts = defaultdict(dict)
+    rows = DownloadTask.objects.filter(job_id__in=job_ids).values('job_id', 'state').annotate(  # type: ignore[attr-defined]
+        count=Count('pk'))
+    for row in rows:
+        counts[row['job_id']][row['state']] = row['count']
+    now = timezone.now()
+    for job_id, states in counts.items():
+        if states.get('pending') or states.get('running'):
+            DownloadJob.objects.filter(pk=job_id, state='pending').update(state='running')  # type: ignore[attr-defined]
+            continue
+        state = 'failed' if states.get('failed') else 'done'
+        DownloadJob.objects.filter(pk=job_id).exclude(state='cancelled').update(  # type: ignore[attr-defined]
+            state=state, finished_at=now)
+
+
+class TaskQueue:
+    """
+    Shared queue over DownloadTask rows; safe to use from many worker processes.
+
+    Tasks are claimed in batches under a lease. On databases with
+    SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL) competing workers skip each
+    other's rows; elsewhere (SQLite) the claim is a single conditional
+    UPDATE ... WHERE pk IN (SELECT ... LIMIT n), which the database write lock
+    serialises. A worker that dies simply stops renewing its leases, and its
+    tasks become claimable again once they expire.
+    """
+
+    def __init__(self, owner=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backend=None):
+        self.owner = owner or make_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backend = backend  # only claim tasks of jobs queued for this backend
+
+    def _claimable(self, now, job_ids=None, exclude_platforms=None):
+        tasks = DownloadTask.objects.filter(  # type: ignore[attr-defined]
+            Q(state='pending') | Q(state='running', lease_expires__lt=now),
+            Q(available_at__isnull=True) | Q(available_at__lte=now),
+        ).exclude(job__state='cancelled')
+        if self.backend:
+            tasks = tasks.filter(job__backend=self.backend)
+        if job_ids:
+            tasks = tasks.filter(job_id__in=job_ids)
+        if exclude_platforms:
+            tasks = tasks.exclude(file__lesson__module__course__platform_id__in=exclude_platforms)
+        return tasks.order_by('job_id', 'pk')
+
+    def claim(self, limit=10, job_ids=None, exclude_platforms=None):
+        """
+        Lease up to `limit` tasks to this worker; returns them with `file`, `job` and
+        the file's course loaded. `exclude_platforms` skips tasks of those platforms.
+        """
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.lease_seconds)
+        # The exact expiry doubles as a claim token: it tells this claim's rows apart from
+        # rows this owner claimed before and lost
+        claim = {'state': 'running', 'lease_owner': self.owner, 'lease_expires': expires,
+                 'attempts': F('attempts') + 1}
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                claimable = self._claimable(now, job_ids, exclude_platforms)
+                ids = list(claimable.select_for_update(skip_locked=True, of=('self',)).values_list('pk', flat=True)[:limit])
+                if not ids:
+                    return []
+                DownloadTask.objects.filter(pk__in=ids).update(**claim)  # type: ignore[attr-defined]
+        else:
+            candidates = self._claimable(now, job_ids, exclude_platforms).values('pk')[:limit]
+            # Re-checking the claim conditions inside the UPDATE makes a row that another
+            # worker won in the meantime drop out instead of being claimed twice
+            if not self._claimable(now, job_ids, exclude_platforms).filter(pk__in=candidates).update(**claim):
+                return []
+        tasks = DownloadTask.objects.filter(  # type: ignore[attr-defined]
+            lease_owner=self.owner, lease_expires=expires, state='running')
+        tasks = list(tasks.select_related('file', 'file__lesson__module__course', 'job', 'job__user'))
+        DownloadJob.objects.filter(pk__in={task.job_id for task in tasks}, state='pending').update(  # type: ignore[attr-defined]
+            state='running')
+        return tasks
+
+    def _owned(self, task_ids):
+        return DownloadTask.objects.filter(pk__in=task_ids, lease_owner=self.owner, state='running')  # type: ignore[attr-defined]
+
+    def heartbeat(self, task_ids, progress=None):
+        """
+        Extend the leases on `task_ids` and store `progress` ({task id: bytes done})
+        in one UPDATE. Returns the ids still held; any other lease was lost.
+        """
+        task_ids = list(task_ids)
+        if not task_ids:
+            return set()
+        update = {'lease_expires': timezone.now() + timedelta(seconds=self.lease_seconds)}
+        if progress:
+            update['bytes_done'] = Case(
+                *[When(pk=task_id, then=Value(done)) for task_id, done in progress.items()],
+                default=F('bytes_done'), output_field=BigIntegerField())
+        self._owned(task_ids).update(**update)
+        return set(self._owned(task_ids).values_list('pk', flat=True))
+
+    def complete(self, task, bytes_done=None):
+        update = {'state': 'done', 'lease_owner': None, 'lease_expires': None, 'last_error': None}
+        if bytes_done is not None:
+            update['bytes_done'] = bytes_done
+        return bool(self._owned([task.pk]).update(**update))
+
+    def fail(self, task, error, retry=True):
+        """Record a failure; the task is retried with exponential backoff until max_attempts"""
+        if retry and task.attempts < self.max_attempts:
+            delay = min(RETRY_BACKOFF_SECONDS * 2 ** max(task.attempts - 1, 0), MAX_RETRY_BACKOFF_SECONDS)
+            update = {'state': 'pending', 'available_at': timezone.now() + timedelta(seconds=delay)}
+        else:
+            update = {'state': 'failed'}
+        return bool(self._owned([task.pk]).update(
+            last_error=str(error)[:2000], lease_owner=None, lease_expires=None, **update))
+
+    def defer(self, task, reason, seconds=DEFER_SECONDS):
+        """Put a task back for later without counting the attempt, e.g. while its platform is capped"""
+        return bool(self._owned([task.pk]).update(
+            state='pending', lease_owner=None, lease_expires=None, attempts=F('attempts') - 1,
+            available_at=timezone.now() + timedelta(seconds=seconds), last_error=str(reason)[:2000]))
+
+    def release(self, tasks):
+        """Hand tasks back untouched (e.g. on shutdown); the attempt doesn't count"""
+        return self._owned([task.pk for task in tasks]).update(
+            state='pending', lease_owner=None, lease_expires=None, attempts=F('attempts') - 1)
+
+
+def prepare_tasks(queue, tasks):
+    """
+    Build the DownloadRequests for claimed tasks, returning ({file id: task}, requests).
+    Tasks whose file got downloaded or deselected since it was queued are completed
+    right away, and files without a source URL fail for good.
+    """
+    by_file = {}
+    by_user = defaultdict(list)
+    for task in tasks:
+        if task.file.is_downloaded or not task.file.should_download:
+            queue.complete(task)
+            continue
+        by_file[task.file_id] = task
+        by_user[task.job.user].append(task.file)
+    requests = [request for user, files in by_user.items() for request in build_requests(files, user)]
+    for file_id in set(by_file) - {request.file_id for request in requests}:
+        queue.fail(by_file.pop(file_id), 'File has no source URL', retry=False)
+    return by_file, requests
+
+
+class _Heartbeat(threading.Thread):
+    def __init__(self, queue, tasks, interval):
+        super().__init__(name='katomart-heartbeat', daemon=True)
+        self.queue = queue
+        self.task_ids = {task.file_id: task.pk for task in tasks}
+        self.interval = interval
+        self.progress = {}
+        self.lost = set()
+        self._stop_event = threading.Event()
+
+    def record(self, file_id, done, total):
+        task_id = self.task_ids.get(file_id)
+        if task_id is not None:
+            self.progress[task_id] = max(done, 0)
+
+    def run(self):
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    held = self.queue.heartbeat(self.task_ids.values(), dict(self.progress))
+                except DatabaseError:
+                    # e.g. SQLite busy: the lease has slack for a missed beat, try again next time
+                    continue
+                self.lost = set(self.task_ids.values()) - held
+        finally:
+            connection.close()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class TaskWorker:
+    """
+    Claims tasks in batches and runs them through a DownloadBackend, renewing the
+    leases (and saving bytes_done) while the transfer runs. Only jobs queued for
+    that backend (DownloadJob.backend) are picked up. Partially written files
+    are resumed by the backend (.part files), so a task picked up after a crash
+    continues where the previous worker stopped.
+    """
+
+    def __init__(self, backend, queue=None, batch_size=10, progress=None):
+        self.backend = backend
+        self.queue = queue or TaskQueue(backend=backend.name)
+        self.batch_size = batch_size
+        self.progress = progress
+        self.stop_requested = threading.Event()
+
+    def run_batch(self, job_ids=None):
+        """Claim and process one batch; returns the number of tasks claimed"""
+        tasks = self.queue.claim(self.batch_size, job_ids=job_ids)
+        if not tasks:
+            return 0
+        heartbeat = _Heartbeat(self.queue, tasks, max(self.queue.lease_seconds / 3, 1))
+
+        def progress(file_id, done, total):
+            heartbeat.record(file_id, done, total)
+            if self.progress:
+                self.progress(file_id, done, total)
+
+        by_file, requests = prepare_tasks(self.queue, tasks)
+        writer = DownloadStateWriter()
+        heartbeat.start()
+        try:
+            for result in self.backend.download(requests, progress=progress):
+                writer.add(result)
+                task = by_file.pop(result.file_id)
+                if task.pk in heartbeat.lost:
+                    # Another worker owns it now; its outcome is the one that counts
+                    continue
+                if result.ok:
+                    self.queue.complete(task, result.bytes_written)
+                else:
+                    self.queue.fail(task, result.error)
+        finally:
+            heartbeat.stop()
+            writer.flush()
+            # Whatever didn't finish (interrupted, backend error) goes back to the queue
+            if by_file:
+                self.queue.release(by_file.values())
+            refresh_job_state({task.job_id for task in tasks})
+        return len(tasks)
+
+    def run(self, job_ids=None, idle_sleep=5.0, exit_when_idle=False):
+        while not self.stop_requested.is_set():
+            if not self.run_batch(job_ids) and (exit_when_idle or self.stop_requested.wait(idle_sleep)):
+                break
+
+    def stop(self):
+        self.stop_requested.set()
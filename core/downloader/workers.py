@@ -0,0 +1,285 @@
+import asyncio
+import os
+import signal
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import DatabaseError
+from django.utils import timezone
+
+from core.models import WorkerHeartbeat
+from core.progress import ProgressPublisher
+from core.ratelimit import VisitationLimitReached, get_rate_limiter
+from core.registry import URLNotRegistered, get_platform_registry
+from .base import DOWNLOAD_URL_KIND, DownloadResult, DownloadStateWriter
+from .engine import get_backend
+from .tasks import DEFAULT_LEASE_SECONDS, TaskQueue, make_worker_id, prepare_tasks, refresh_job_state
+
+DEFAULT_HEARTBEAT_INTERVAL = 5  # seconds
+
+
+class AsyncWorker:
+    """
+    One download worker process: an asyncio loop that claims DownloadTasks of
+    jobs queued for `backend_name` in batches and keeps up to `concurrency`
+    transfers running, at most
+    `platform_limits.get(platform, default_platform_limit)` of them per
+    Course.platform. The ORM and the backends are blocking, so they run in the
+    loop's thread pool; the loop only schedules. Per-file progress and state
+    changes are published to the local progress bus (see core.progress).
+
+    On SIGTERM/SIGINT it stops claiming, lets running transfers finish for up to
+    `drain_timeout` seconds, then hands whatever is left back to the queue.
+    """
+
+    def __init__(self, backend_name='http', backend_options=None, concurrency=8, batch_size=None,
+                 platform_limits=None, default_platform_limit=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, idle_sleep=2.0, drain_timeout=60, job_ids=None):
+        self.backend_name = backend_name
+        self.backend_options = backend_options or {}
+        self.concurrency = concurrency
+        self.batch_size = batch_size or concurrency
+        self.platform_limits = platform_limits or {}
+        self.default_platform_limit = default_platform_limit
+        self.heartbeat_interval = min(heartbeat_interval, max(lease_seconds / 3, 1))
+        self.idle_sleep = idle_sleep
+        self.drain_timeout = drain_timeout
+        self.job_ids = job_ids
+        self.queue = TaskQueue(owner=make_worker_id(), lease_seconds=lease_seconds, backend=backend_name)
+        self.abandoned = False  # transfers were still running when the drain timed out
+
+        self._running = {}  # task id -> (asyncio task, DownloadTask)
+        self._per_platform = defaultdict(int)
+        self._progress = {}  # task id -> bytes done
+        self._task_of_file = {}
+        self._file_meta = {}  # file id -> what progress events carry besides bytes
+        self._lost = set()
+        self._dirty_jobs = set()
+        self._writer = DownloadStateWriter()
+        self._lock = threading.Lock()  # writer, stats and dirty jobs are shared with executor threads
+        self._stats = {'tasks_done': 0, 'tasks_failed': 0, 'bytes_finished': 0}
+        self._started_at = timezone.now()
+
+    # -- plumbing
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _limit(self, platform_id):
+        return self.platform_limits.get(platform_id, self.default_platform_limit)
+
+    def _saturated(self):
+        return [platform_id for platform_id, count in self._per_platform.items()
+                if self._limit(platform_id) is not None and count >= self._limit(platform_id)]
+
+    def _record_progress(self, file_id, done, total):
+        task_id = self._task_of_file.get(file_id)
+        if task_id is not None:
+            self._progress[task_id] = max(done, 0)
+            self._publisher.progress(file_id, max(done, 0), total, **self._file_meta.get(file_id, {}))
+
+    @staticmethod
+    def _throttle(platform_id):
+        """
+        Count the visit against the platform's 'download' PlatformURL when it has a
+        visitation_limit (raising VisitationLimitReached at the cap); otherwise only
+        platforms with a configured 'download' (or '*') rate are throttled.
+        """
+        if platform_id is None:
+            return
+        limiter = get_rate_limiter()
+        try:
+            url = get_platform_registry().get(platform_id, DOWNLOAD_URL_KIND)
+        except URLNotRegistered:
+            url = None
+        if url is not None and url.has_visitation_limit:
+            limiter.acquire(url)
+        elif limiter.has_limit(platform_id, DOWNLOAD_URL_KIND):
+            limiter.acquire(platform_id=platform_id, url_kind=DOWNLOAD_URL_KIND)
+
+    def _download(self, request, platform_id=None):
+        try:
+            self._throttle(platform_id)
+            results = list(self.backend.download([request], progress=self._record_progress))
+        except VisitationLimitReached:
+            # Not the file's fault: _run_task defers the task instead of failing it
+            raise
+        except Exception as exc:  # noqa: BLE001 - reported on the task
+            return DownloadResult(request.file_id, request.path, False, error=str(exc) or type(exc).__name__)
+        if not results:
+            return DownloadResult(request.file_id, request.path, False, error='Backend returned nothing')
+        return results[0]
+
+    def _defer(self, task, url_id):
+        with self._lock:
+            self._dirty_jobs.add(task.job_id)
+        if task.pk in self._lost:
+            return
+        reason = f'Visitation limit reached for PlatformURL {url_id}'
+        self.queue.defer(task, reason)
+        self._publisher.state(task.file_id, 'deferred', error=reason, **self._file_meta.get(task.file_id, {}))
+
+    def _finish(self, task, result):
+        with self._lock:
+            self._writer.add(result)
+            self._dirty_jobs.add(task.job_id)
+        if task.pk in self._lost:
+            # Another worker took the task over; its outcome is the one that counts
+            return
+        if result.ok:
+            self.queue.complete(task, result.bytes_written)
+        else:
+            self.queue.fail(task, result.error)
+        with self._lock:
+            self._stats['tasks_done' if result.ok else 'tasks_failed'] += 1
+            self._stats['bytes_finished'] += result.bytes_written if result.ok else 0
+        meta = self._file_meta.get(task.file_id, {})
+        if result.ok:
+            self._publisher.state(task.file_id, 'done', bytes=result.bytes_written, **meta)
+        else:
+            self._publisher.state(task.file_id, 'failed', error=result.error, **meta)
+
+    # -- loop
+
+    async def _run_task(self, task, request, platform_id):
+        try:
+            try:
+                result = await self._call(self._download, request, platform_id)
+            except VisitationLimitReached as exc:
+                await self._call(self._defer, task, exc)
+            else:
+                await self._call(self._finish, task, result)
+        finally:
+            self._per_platform[platform_id] -= 1
+            self._running.pop(task.pk, None)
+            self._task_of_file.pop(task.file_id, None)
+            self._file_meta.pop(task.file_id, None)
+            self._progress.pop(task.pk, None)
+            self._slot_freed.set()
+
+    async def _feed(self):
+        while not self._stopping.is_set():
+            free = self.concurrency - len(self._running)
+            if free <= 0:
+                self._slot_freed.clear()
+                await self._wait_for(self._slot_freed, None)
+                continue
+            try:
+                tasks = await self._call(self.queue.claim, min(free, self.batch_size), self.job_ids, self._saturated())
+            except DatabaseError:
+                tasks = []
+            if not tasks:
+                await self._wait_for(self._stopping, self.idle_sleep)
+                continue
+            by_file, requests = await self._call(prepare_tasks, self.queue, tasks)
+            over = []
+            for request in requests:
+                task = by_file[request.file_id]
+                platform_id = task.file.lesson.module.course.platform_id
+                limit = self._limit(platform_id)
+                if limit is not None and self._per_platform[platform_id] >= limit:
+                    # One batch can bring more of a platform than its cap allows
+                    over.append(task)
+                    continue
+                self._per_platform[platform_id] += 1
+                self._task_of_file[task.file_id] = task.pk
+                self._file_meta[task.file_id] = meta = {
+                    'course': task.file.lesson.module.course_id, 'job': task.job_id, 'user': task.job.user_id}
+                self._publisher.state(task.file_id, 'running', **meta)
+                self._running[task.pk] = (asyncio.create_task(self._run_task(task, request, platform_id)), task)
+            if over:
+                await self._call(self.queue.release, over)
+
+    async def _wait_for(self, event, timeout):
+        waiters = [asyncio.create_task(event.wait())]
+        if event is not self._stopping:
+            waiters.append(asyncio.create_task(self._stopping.wait()))
+        _, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+
+    def _beat(self, state, rate):
+        # Renew the leases first: that is what keeps other workers off our tasks
+        task_ids = list(self._running)
+        if task_ids:
+            held = self.queue.heartbeat(task_ids, dict(self._progress))
+            self._lost |= set(task_ids) - held
+        with self._lock:
+            self._writer.flush()
+            dirty, self._dirty_jobs = self._dirty_jobs, set()
+            stats = dict(self._stats)
+        if dirty:
+            refresh_job_state(dirty)
+        get_rate_limiter().flush()
+        values = {
+            'hostname': socket.gethostname(), 'pid': os.getpid(), 'state': state,
+            'started_at': self._started_at, 'last_seen': timezone.now(),
+            'active_tasks': len(task_ids), 'tasks_done': stats['tasks_done'],
+            'tasks_failed': stats['tasks_failed'], 'bytes_downloaded': self._bytes(),
+            'bytes_per_second': rate,
+        }
+        # Plain UPDATE then INSERT rather than update_or_create: on SQLite a read-then-write
+        # transaction fails outright under contention instead of waiting for the lock
+        if not WorkerHeartbeat.objects.filter(worker_id=self.queue.owner).update(**values):  # type: ignore[attr-defined]
+            WorkerHeartbeat.objects.create(worker_id=self.queue.owner, **values)  # type: ignore[attr-defined]
+
+    def _bytes(self):
+        return self._stats['bytes_finished'] + sum(dict(self._progress).values())
+
+    async def _heartbeat_loop(self):
+        last_bytes, last_time, rate = self._bytes(), time.monotonic(), 0.0
+        while True:
+            await self._safe_beat('draining' if self._stopping.is_set() else 'running', rate)
+            await asyncio.sleep(self.heartbeat_interval)
+            now, current = time.monotonic(), self._bytes()
+            rate = max(current - last_bytes, 0) / max(now - last_time, 1e-6)
+            last_bytes, last_time = current, now
+
+    async def _safe_beat(self, state, rate):
+        try:
+            await self._call(self._beat, state, rate)
+        except DatabaseError:
+            # A missed beat is fine; leases outlive several intervals
+            pass
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Transfers, ORM calls and heartbeats all need threads; don't let transfers starve the rest
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency + 4,
+                                                     thread_name_prefix='katomart-worker'))
+        self._stopping = asyncio.Event()
+        self._slot_freed = asyncio.Event()
+        self._publisher = ProgressPublisher().start()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows: no loop signal handlers
+                signal.signal(signum, lambda *_: loop.call_soon_threadsafe(self._stopping.set))
+        self.backend = await self._call(lambda: get_backend(self.backend_name, **self.backend_options))
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            await self._feed()
+            running = [task for task, _ in self._running.values()]
+            if running:
+                await asyncio.wait(running, timeout=self.drain_timeout)
+        finally:
+            heartbeat.cancel()
+            leftover = [task for _, task in self._running.values()]
+            if leftover:
+                self.abandoned = True
+                await self._call(self.queue.release, leftover)
+                # No longer ours: the last beat neither renews nor counts them, and a late result is dropped
+                self._lost |= {task.pk for task in leftover}
+                self._running.clear()
+                for task in leftover:
+                    self._publisher.state(task.file_id, 'released', **self._file_meta.get(task.file_id, {}))
+            with self._lock:
+                self._dirty_jobs |= {task.job_id for task in leftover}
+            await self._safe_beat('stopped', 0.0)
+            self._publisher.close()
+            if not self.abandoned:
+                await self._call(self.backend.close)
@@ -0,0 +1,75 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .models import FileDigest
+
+DEFAULT_ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_WORKERS = 4
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, chunk_size=CHUNK_SIZE):
+    """Hex digest of a file, read in chunks so memory stays flat"""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digests(paths, algorithm=DEFAULT_ALGORITHM, workers=DEFAULT_WORKERS, force=False):
+    """
+    Content hashes for downloaded files: `paths` maps File internal_id -> Path.
+    Returns {file id: (size, mtime_ns, digest)}, leaving out files that are
+    missing on disk. A FileDigest whose path, size and mtime still match the
+    file is reused; everything else is hashed in `workers` threads and the
+    cache rows are upserted in one query.
+    """
+    paths = {file_id: Path(path) for file_id, path in paths.items()}
+    cached = {digest.file_id: digest for digest in FileDigest.objects.filter(  # type: ignore[attr-defined]
+        file_id__in=list(paths), algorithm=algorithm)}
+
+    def stat(item):
+        file_id, path = item
+        try:
+            info = os.stat(path)
+        except OSError:
+            return file_id, None
+        return file_id, (info.st_size, info.st_mtime_ns)
+
+    results, stale = {}, []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='katomart-hash') as pool:
+        for file_id, info in pool.map(stat, paths.items()):
+            if info is None:
+                continue
+            size, mtime_ns = info
+            digest = cached.get(file_id)
+            if (not force and digest is not None and digest.size == size and digest.mtime_ns == mtime_ns
+                    and digest.path == str(paths[file_id])):
+                results[file_id] = (size, mtime_ns, digest.digest)
+            else:
+                stale.append((file_id, size, mtime_ns))
+
+        hashed = pool.map(lambda entry: (entry, _hash_or_none(paths[entry[0]], algorithm)), stale)
+        rows = []
+        for (file_id, size, mtime_ns), digest in hashed:
+            if digest is None:
+                continue
+            results[file_id] = (size, mtime_ns, digest)
+            rows.append(FileDigest(file_id=file_id, path=str(paths[file_id]), size=size, mtime_ns=mtime_ns,
+                                   algorithm=algorithm, digest=digest))
+    if rows:
+        FileDigest.objects.bulk_create(  # type: ignore[attr-defined]
+            rows, batch_size=500, update_conflicts=True, unique_fields=['file'],
+            update_fields=['path', 'size', 'mtime_ns', 'algorithm', 'digest', 'computed_at'])
+    return results
+
+
+def _hash_or_none(path, algorithm):
+    try:
+        return hash_file(path, algorithm)
+    except OSError:
+        # Vanished between stat and read
+        return None
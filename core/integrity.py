@@ -0,0 +1,145 @@
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+
+from django.contrib.auth.models import AnonymousUser
+
+from .hashing import DEFAULT_ALGORITHM, file_digests, hash_file
+from .models import Course, File, FileDigest
+from .paths import PathPlanner
+
+DEFAULT_WORKERS = 32  # stat() is I/O bound and releases the GIL
+RESET_BATCH_SIZE = 500
+
+
+@dataclass
+class VerifyReport:
+    checked: int = 0
+    ok: int = 0
+    hashed: int = 0
+    missing: list = field(default_factory=list)  # [{file_id, path}]
+    truncated: list = field(default_factory=list)  # [{file_id, path, size, expected}]
+    size_mismatch: list = field(default_factory=list)  # larger than file_size, kept
+    corrupt: list = field(default_factory=list)  # content changed under an unchanged size/mtime/path (bit rot)
+    unverified: list = field(default_factory=list)  # no usable FileDigest to compare with; re-baselined, counted ok
+    reset: int = 0
+    elapsed: float = 0.0
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def _stat(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_size, info.st_mtime_ns
+
+
+def _rehash(item):
+    """(digest, stat after reading) of an unchanged-looking file; None if it vanished"""
+    path, algorithm = item
+    try:
+        digest = hash_file(path, algorithm)
+    except OSError:
+        return None
+    return digest, _stat(path)
+
+
+def _compare_digests(intact, stats, workers, report):
+    """
+    Re-hash the intact files of one course and return the ids of corrupt ones.
+    A file only counts as corrupt when its FileDigest still describes it (same
+    path, size, mtime and algorithm) and just the content differs: a rewrite
+    (decrypt, remux, re-download) changes the mtime, so such files and files
+    without a digest are re-baselined and reported as unverified instead. The
+    reference digest of a corrupt file is left alone, so it stays flagged.
+    """
+    cached = FileDigest.objects.in_bulk(list(intact))  # type: ignore[attr-defined]
+    check, baseline = {}, {}
+    for file_id, path in intact.items():
+        row = cached.get(file_id)
+        if (row is not None and row.algorithm == DEFAULT_ALGORITHM and row.path == str(path)
+                and (row.size, row.mtime_ns) == stats[file_id]):
+            check[file_id] = path
+        else:
+            baseline[file_id] = path
+    corrupt = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='katomart-verify-hash') as pool:
+        ids = list(check)
+        for file_id, outcome in zip(ids, pool.map(_rehash, [(check[file_id], DEFAULT_ALGORITHM) for file_id in ids])):
+            if outcome is None:
+                continue
+            digest, after = outcome
+            if after != stats[file_id]:
+                # Rewritten while we read it; that is not bit rot
+                baseline[file_id] = check[file_id]
+            elif digest != cached[file_id].digest:
+                report.corrupt.append({'file_id': file_id, 'path': str(check[file_id])})
+                corrupt.append(file_id)
+            report.hashed += 1
+    if baseline:
+        report.hashed += len(file_digests(baseline, workers=workers, force=True))
+        report.unverified += [{'file_id': file_id, 'path': str(path)} for file_id, path in baseline.items()]
+    return corrupt
+
+
+def verify_downloads(user=None, course_ids=None, hash_files=False, workers=DEFAULT_WORKERS, reset=True):
+    """
+    Check that every File with is_downloaded=True exists at the path the
+    PathPlanner gives it and has its recorded file_size. Stats run in a thread
+    pool, one course at a time. With `hash_files` the files that pass are
+    re-hashed (streamed, see core.hashing) and compared with their FileDigest;
+    see _compare_digests for what counts as corrupt.
+
+    Missing, truncated and corrupt files get is_downloaded (and is_decrypted)
+    reset in bulk unless `reset` is False, so the next download run fetches
+    them again. Returns a VerifyReport.
+    """
+    started = time.monotonic()
+    user = user or AnonymousUser()
+    report = VerifyReport()
+    rows = File.objects.filter(is_downloaded=True)  # type: ignore[attr-defined]
+    if course_ids:
+        rows = rows.filter(lesson__module__course_id__in=course_ids)
+    by_course = defaultdict(dict)
+    for file_id, size, course_id in rows.values_list('internal_id', 'file_size', 'lesson__module__course_id'):
+        if course_id is not None:
+            by_course[course_id][file_id] = size
+    courses = Course.objects.in_bulk(list(by_course))  # type: ignore[attr-defined]
+
+    bad = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='katomart-verify') as pool:
+        for course_id, expected in by_course.items():
+            paths = PathPlanner(user, courses[course_id]).plan(file_ids=list(expected), create_base=False)
+            file_ids = list(paths)
+            intact, stats = {}, {}
+            for file_id, info in zip(file_ids, pool.map(_stat, [paths[file_id] for file_id in file_ids])):
+                report.checked += 1
+                path, want = str(paths[file_id]), expected[file_id]
+                if info is None:
+                    report.missing.append({'file_id': file_id, 'path': path})
+                    bad.append(file_id)
+                elif want is not None and info[0] < want:
+                    report.truncated.append({'file_id': file_id, 'path': path, 'size': info[0], 'expected': want})
+                    bad.append(file_id)
+                else:
+                    if want is not None and info[0] != want:
+                        report.size_mismatch.append({'file_id': file_id, 'path': path, 'size': info[0], 'expected': want})
+                    intact[file_id], stats[file_id] = paths[file_id], info
+            if hash_files and intact:
+                corrupt = _compare_digests(intact, stats, min(workers, os.cpu_count() or 4), report)
+                bad += corrupt
+                for file_id in corrupt:
+                    intact.pop(file_id)
+            report.ok += len(intact)
+
+    if reset:
+        for start in range(0, len(bad), RESET_BATCH_SIZE):
+            report.reset += File.objects.filter(pk__in=bad[start:start + RESET_BATCH_SIZE]).update(  # type: ignore[attr-defined]
+                is_downloaded=False, is_decrypted=False, download_date=None)
+    report.elapsed = round(time.monotonic() - started, 3)
+    return report
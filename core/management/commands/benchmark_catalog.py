@@ -0,0 +1,123 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from core.models import Platform, Course, Module, Lesson, File
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seed a synthetic catalog and report query plans and timings for the download-state queries with and without the catalog indexes. Nothing is kept in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--courses', type=int, default=20)
+        parser.add_argument('--modules', type=int, default=20, help='Modules per course')
+        parser.add_argument('--lessons', type=int, default=15, help='Lessons per module')
+        parser.add_argument('--files', type=int, default=4, help='Files per lesson')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per query, the best one is reported')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():  # type: ignore
+                started = time.perf_counter()
+                course, module, lesson = self.seed(options)
+                self.stdout.write(f'Seeded catalog in {time.perf_counter() - started:.2f}s '
+                                  f'({File.objects.count()} files)\n')  # type: ignore[attr-defined]
+                queries = self.hot_queries(course, module, lesson)
+                with_indexes = self.measure(queries, options['repeat'], 'with indexes')
+                self.drop_catalog_indexes()
+                without_indexes = self.measure(queries, options['repeat'], 'without indexes')
+                self.report(queries, without_indexes, with_indexes)
+                # DDL and seed data are both discarded; SQLite and Postgres roll back schema changes
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+    def seed(self, options):
+        platform, _ = Platform.objects.get_or_create(id='benchmark', defaults={'name': 'Benchmark'})  # type: ignore[attr-defined]
+        courses = Course.objects.bulk_create([  # type: ignore[attr-defined]
+            Course(name=f'Course {c}', external_id=f'bench-c{c}', platform=platform, is_downloaded=c % 3 == 0)
+            for c in range(options['courses'])
+        ])
+        modules = Module.objects.bulk_create([  # type: ignore[attr-defined]
+            Module(course=course, name=f'Module {m}', order=m, external_id=f'{course.external_id}-m{m}',
+                   is_active=True, is_downloaded=m % 2 == 0)
+            for course in courses for m in range(options['modules'])
+        ], batch_size=1000)
+        lessons = Lesson.objects.bulk_create([  # type: ignore[attr-defined]
+            Lesson(module=module, name=f'Lesson {l}', order=l, external_id=f'{module.external_id}-l{l}',
+                   is_active=True, is_downloaded=l % 2 == 0)
+            for module in modules for l in range(options['lessons'])
+        ], batch_size=1000)
+        File.objects.bulk_create([  # type: ignore[attr-defined]
+            File(lesson=lesson, name=f'File {f}', order=f, external_id=f'{lesson.external_id}-f{f}',
+                 is_active=True, is_downloaded=(lesson.internal_id + f) % 10 != 0,
+                 has_drm=f == 0, is_decrypted=f == 0 and lesson.internal_id % 4 != 0,
+                 file_type='mp4', file_size=1024 * 1024)
+            for lesson in lessons for f in range(options['files'])
+        ], batch_size=2000)
+        middle = len(courses) // 2
+        return courses[middle], modules[len(modules) // 2], lessons[len(lessons) // 2]
+
+    def hot_queries(self, course, module, lesson):
+        return [
+            ('courses by platform/state', Course.objects.filter(  # type: ignore[attr-defined]
+                platform_id='benchmark', is_downloaded=False)),
+            ('course by external_id', Course.objects.filter(  # type: ignore[attr-defined]
+                platform_id='benchmark', external_id=course.external_id)),
+            ('pending modules of course', Module.objects.filter(  # type: ignore[attr-defined]
+                course=course, should_download=True, is_downloaded=False, is_active=True)),
+            ('pending lessons of module', Lesson.objects.filter(  # type: ignore[attr-defined]
+                module=module, should_download=True, is_downloaded=False, is_active=True)),
+            ('pending files of lesson', File.objects.filter(  # type: ignore[attr-defined]
+                lesson=lesson, should_download=True, is_downloaded=False)),
+            ('pending files (scheduler pass)', File.objects.filter(  # type: ignore[attr-defined]
+                should_download=True, is_downloaded=False, is_active=True).values_list('internal_id', 'lesson_id')),
+            ('files awaiting decryption', File.objects.filter(  # type: ignore[attr-defined]
+                has_drm=True, is_decrypted=False, is_downloaded=True).values_list('internal_id', flat=True)),
+            ('file by external_id', File.objects.filter(  # type: ignore[attr-defined]
+                lesson=lesson, external_id=f'{lesson.external_id}-f1')),
+        ]
+
+    def measure(self, queries, repeat, phase):
+        # Raw SQL tagged with the phase: the sqlite3 statement cache would otherwise
+        # hand back plans prepared before the indexes were dropped.
+        results = []
+        explain_prefix = connection.ops.explain_query_prefix()
+        with connection.cursor() as cursor:
+            for _, queryset in queries:
+                sql, params = queryset.query.sql_with_params()
+                sql = f'{sql} /* {phase} */'
+                best = None
+                for _ in range(max(repeat, 1)):
+                    started = time.perf_counter()
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                cursor.execute(f'{explain_prefix} {sql}', params)
+                plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+                results.append((best, plan))
+        return results
+
+    def drop_catalog_indexes(self):
+        # Plain DROP INDEX instead of the schema editor: SQLite refuses to open one inside
+        # the surrounding transaction. The conditional unique constraint is a partial index too.
+        names = []
+        for model in (Course, Module, Lesson, File):
+            names += [index.name for index in model._meta.indexes]
+            names += [constraint.name for constraint in model._meta.constraints]
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute(f'DROP INDEX {connection.ops.quote_name(name)}')
+
+    def report(self, queries, before, after):
+        for (label, _), (before_time, before_plan), (after_time, after_plan) in zip(queries, before, after):
+            self.stdout.write(self.style.MIGRATE_HEADING(label))  # type: ignore[attr-defined]
+            self.stdout.write(f'  without indexes: {before_time * 1000:8.2f} ms')
+            self.stdout.write(f'    {before_plan}'.replace('\n', '\n    '))
+            self.stdout.write(f'  with indexes:    {after_time * 1000:8.2f} ms')
+            self.stdout.write(f'    {after_plan}'.replace('\n', '\n    '))
@@ -1,4 +1,6 @@
-from django.core.management.base import BaseCommand
+import json
+from django.core.management.base import BaseCommand, CommandError
+from core.integrity import DEFAULT_WORKERS, verify_downloads
 from core.models import SystemConfig, PlatformAuth
 from django.contrib.auth import get_user_model
 import os
@@ -8,7 +10,19 @@ from django.db import models
 class Command(BaseCommand):
     help = 'Check system configuration and tool integrity, and ensure admin account if .env is present.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-downloads', action='store_true',
+                            help='Instead of the configuration checks, verify that downloaded files exist with their size')
+        parser.add_argument('--user', help='Username whose download tree is checked (default: the system download path)')
+        parser.add_argument('--course', type=int, action='append', help='Only this course internal_id (repeatable)')
+        parser.add_argument('--hash', action='store_true', help='Also re-hash files and compare with their FileDigest')
+        parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Parallel stat() calls')
+        parser.add_argument('--dry-run', action='store_true', help='Report only; leave is_downloaded alone')
+        parser.add_argument('--report', help='Write the JSON report to this file instead of stdout')
+
     def handle(self, *args, **options):
+        if options['verify_downloads']:
+            return self.verify_downloads(options)
         # --- Database integrity check ---
         config = SystemConfig.get_solo()
         required_fields = [
@@ -34,3 +48,22 @@ class Command(BaseCommand):
         invalid_auths = PlatformAuth.objects.filter(models.Q(password_encrypted__isnull=True) | models.Q(password_encrypted=''))  # type: ignore[attr-defined]
         if invalid_auths.exists():
             raise RuntimeError(f'PlatformAuth integrity error: {invalid_auths.count()} entries missing password_encrypted.')
+
+    def verify_downloads(self, options):
+        user = None
+        if options['user']:
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"Unknown user: {options['user']}")
+        report = verify_downloads(user, course_ids=options['course'], hash_files=options['hash'],
+                                  workers=options['workers'], reset=not options['dry_run'])
+        data = json.dumps(report.as_dict(), indent=2, ensure_ascii=False)
+        if options['report']:
+            Path(options['report']).write_text(data, encoding='utf-8')
+        else:
+            self.stdout.write(data)
+        summary = (f'{report.checked} files checked in {report.elapsed}s: {report.ok} ok, {len(report.missing)} missing, '
+                   f'{len(report.truncated)} truncated, {len(report.corrupt)} corrupt, '
+                   f'{len(report.unverified)} unverified, {report.reset} reset')
+        self.stderr.write(summary)
@@ -0,0 +1,30 @@
+import signal
+
+from django.core.management.base import BaseCommand
+from core.downloader import get_backend
+from core.downloader.tasks import DEFAULT_LEASE_SECONDS, TaskQueue, TaskWorker
+
+
+class Command(BaseCommand):
+    help = 'Process queued DownloadTasks. Several workers (processes or hosts) can share the queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default='http',
+                            help='Download backend name (http, aria2c, stream); only jobs queued for it are run')
+        parser.add_argument('--batch-size', type=int, default=10, help='Tasks claimed per batch')
+        parser.add_argument('--lease', type=int, default=DEFAULT_LEASE_SECONDS, help='Lease duration in seconds')
+        parser.add_argument('--job', type=int, action='append', help='Only work on this DownloadJob (repeatable)')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty instead of polling')
+
+    def handle(self, *args, **options):
+        queue = TaskQueue(lease_seconds=options['lease'], backend=options['backend'])
+        with get_backend(options['backend']) as backend:
+            worker = TaskWorker(backend, queue=queue, batch_size=options['batch_size'])
+            # Finish the current batch, then stop; unfinished tasks are released back to the queue
+            signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+            self.stdout.write(f'Worker {queue.owner} started')
+            try:
+                worker.run(job_ids=options['job'], exit_when_idle=options['once'])
+            except KeyboardInterrupt:
+                worker.stop()
+        self.stdout.write(f'Worker {queue.owner} stopped')
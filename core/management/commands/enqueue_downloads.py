@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Course, File
+from core.downloader.tasks import enqueue_files
+
+
+class Command(BaseCommand):
+    help = 'Queue the files of a course (or every course) that still have to be downloaded as a DownloadJob.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='Username the files are downloaded for')
+        parser.add_argument('--course', type=int, help='Course internal_id (default: one job per course with pending files)')
+        parser.add_argument('--backend', default='http', help='Download backend name (http, aria2c, stream)')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get(username=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError(f"Unknown user: {options['user']}")
+        courses = Course.objects.all()  # type: ignore[attr-defined]
+        if options['course']:
+            courses = courses.filter(pk=options['course'])
+        for course in courses:
+            files = File.objects.filter(  # type: ignore[attr-defined]
+                lesson__module__course=course, should_download=True, is_downloaded=False).values_list('internal_id', flat=True)
+            job = enqueue_files(user, list(files), course=course, backend=options['backend'])
+            if job:
+                self.stdout.write(f'{course}: job {job.pk} with {job.tasks.count()} tasks')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from core.models import SystemConfig
+from core.tools import TOOL_REQUIREMENTS, invalidate_tool_cache
+
+
+class Command(BaseCommand):
+    help = 'Re-detect external tools (ffmpeg, mp4decrypt, aria2c, ...) and their versions, and store the result in SystemConfig.'
+
+    def handle(self, *args, **options):
+        invalidate_tool_cache()
+        config = SystemConfig.get_solo()
+        config.auto_detect_tools(force=True)
+        config.save()
+        for name in TOOL_REQUIREMENTS:
+            path = getattr(config, f'{name}_path') or '-'
+            version = config.tool_versions.get(name, '')
+            style = self.style.SUCCESS if getattr(config, f'{name}_available') else self.style.WARNING  # type: ignore[attr-defined]
+            self.stdout.write(style(f'{name:<14} {path} {version}'.rstrip()))
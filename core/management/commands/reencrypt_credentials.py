@@ -0,0 +1,59 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from core.models import PlatformAuth
+from cryptography.fernet import InvalidToken
+from core.crypto import current_kdf_spec, encrypt_many, is_legacy_token, parse_envelope
+
+
+class Command(BaseCommand):
+    help = 'Re-encrypt PlatformAuth credentials with the current KDF envelope (legacy rows or rows using older KDF parameters).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--passphrase', help='Passphrase the credentials were encrypted with (defaults to $KATOMART_PASSPHRASE)')
+        parser.add_argument('--user', help='Only re-encrypt the accounts of this username')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without writing')
+
+    def handle(self, *args, **options):
+        passphrase = options['passphrase'] or os.environ.get('KATOMART_PASSPHRASE')
+        if not passphrase:
+            raise CommandError('A passphrase is required (--passphrase or KATOMART_PASSPHRASE)')
+        spec = current_kdf_spec()
+        auths = PlatformAuth.objects.all()  # type: ignore[attr-defined]
+        if options['user']:
+            auths = auths.filter(user__username=options['user'])
+        fields = [f'{name}_encrypted' for name in PlatformAuth.CREDENTIAL_FIELDS]
+
+        def is_current(token):
+            if not token:
+                return True
+            if is_legacy_token(token):
+                return False
+            try:
+                return parse_envelope(token)[0] == spec
+            except InvalidToken:
+                return False
+
+        stale = [auth for auth in auths if not all(is_current(getattr(auth, field)) for field in fields)]
+        credentials = PlatformAuth.get_credentials_many(stale, passphrase)
+        updated, failed = [], []
+        for auth in stale:
+            tokens = [getattr(auth, field) for field in fields]
+            values = [credentials[auth.pk][name] for name in PlatformAuth.CREDENTIAL_FIELDS]
+            if any(token and value is None for token, value in zip(tokens, values)):
+                # Wrong passphrase or corrupted value: leave the row alone
+                failed.append(auth.pk)
+                continue
+            for field, value in zip(fields, encrypt_many(values, passphrase)):
+                setattr(auth, field, value)
+            updated.append(auth)
+
+        if updated and not options['dry_run']:
+            with transaction.atomic():  # type: ignore
+                PlatformAuth.objects.bulk_update(updated, fields, batch_size=200)  # type: ignore[attr-defined]
+        verb = 'Would re-encrypt' if options['dry_run'] else 'Re-encrypted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(updated)} of {len(stale)} outdated accounts.'))  # type: ignore[attr-defined]
+        if failed:
+            self.stdout.write(self.style.WARNING(  # type: ignore[attr-defined]
+                f'{len(failed)} accounts could not be decrypted with this passphrase: {", ".join(map(str, failed))}'))
@@ -0,0 +1,129 @@
+import math
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.ratelimit import RATELIMIT_DB_ENV
+
+
+def _worker_main(options):
+    # Spawned children start from scratch, so Django has to be set up before any model import
+    import django
+    django.setup()
+    import asyncio
+    from core.downloader.workers import AsyncWorker
+
+    worker = AsyncWorker(**options)
+    asyncio.run(worker.run())
+    if worker.abandoned:
+        # Transfers that outlived the drain are still running in threads; their leases are released
+        os._exit(0)
+
+
+def _parse_platform_limits(values):
+    limits = {}
+    for value in values or []:
+        platform_id, sep, limit = value.partition('=')
+        if not sep or not limit.isdigit() or int(limit) < 1:
+            raise CommandError(f'Invalid --platform-limit {value!r}, expected PLATFORM=N')
+        limits[platform_id] = int(limit)
+    return limits
+
+
+class Command(BaseCommand):
+    help = ('Run N download worker processes sharing the DownloadTask queue. Each runs an asyncio loop with '
+            'per-platform concurrency caps and reports to WorkerHeartbeat. SIGTERM drains and stops them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            help='Worker processes (default: $KATOMART_WORKER_PROCESSES, '
+                                 'settings.KATOMART_WORKER_PROCESSES or the CPU count)')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent downloads per process')
+        parser.add_argument('--backend', default='http',
+                            help='Download backend name (http, aria2c, stream); only jobs queued for it are run')
+        parser.add_argument('--platform-limit', action='append', metavar='PLATFORM=N',
+                            help='Max concurrent downloads for a platform across all processes (repeatable)')
+        parser.add_argument('--default-platform-limit', type=int,
+                            help='Cap for platforms without their own --platform-limit')
+        parser.add_argument('--lease', type=int, default=300, help='Task lease duration in seconds')
+        parser.add_argument('--drain-timeout', type=int, default=60,
+                            help='Seconds running downloads get to finish after SIGTERM')
+        parser.add_argument('--job', type=int, action='append', help='Only work on this DownloadJob (repeatable)')
+
+    def handle(self, *args, **options):
+        processes = (options['processes'] or int(os.environ.get('KATOMART_WORKER_PROCESSES') or 0)
+                     or getattr(settings, 'KATOMART_WORKER_PROCESSES', None) or os.cpu_count() or 1)
+
+        def share(limit):
+            # The caps are global; each process enforces its share
+            return max(1, math.ceil(limit / processes))
+
+        platform_limits = {platform_id: share(limit)
+                           for platform_id, limit in _parse_platform_limits(options['platform_limit']).items()}
+        default_limit = options['default_platform_limit']
+        worker_options = {
+            'backend_name': options['backend'],
+            'concurrency': options['concurrency'],
+            'platform_limits': platform_limits,
+            'default_platform_limit': share(default_limit) if default_limit else None,
+            'lease_seconds': options['lease'],
+            'drain_timeout': options['drain_timeout'],
+            'job_ids': options['job'],
+        }
+
+        shared_store = None
+        configured = getattr(settings, 'KATOMART_RATELIMIT_DB', None) or os.environ.get(RATELIMIT_DB_ENV)
+        if processes > 1 and not configured:
+            # Per-process counters would let N processes make N times the visits a PlatformURL allows;
+            # the children share a SQLiteStore in a file of this run instead
+            handle, shared_store = tempfile.mkstemp(prefix='katomart-ratelimit-', suffix='.sqlite3')
+            os.close(handle)
+            os.environ[RATELIMIT_DB_ENV] = shared_store
+
+        # Never hand an open database connection to a forked child
+        connections.close_all()
+        context = multiprocessing.get_context()
+        state = {'stopping': False, 'signals': 0}
+
+        def start(slot):
+            process = context.Process(target=_worker_main, args=(worker_options,), name=f'katomart-worker-{slot}')
+            process.start()
+            return process
+
+        def on_signal(signum, frame):
+            state['signals'] += 1
+            state['stopping'] = True
+            for process in workers.values():
+                if process.is_alive():
+                    # The first signal asks the children to drain, a second one kills them
+                    (process.kill if state['signals'] > 1 else process.terminate)()
+
+        workers = {slot: start(slot) for slot in range(processes)}
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+        self.stdout.write(f'Started {processes} worker processes')
+        while workers:
+            for slot, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                if state['stopping'] or process.exitcode == 0:
+                    del workers[slot]
+                else:
+                    self.stderr.write(f'Worker {slot} exited with {process.exitcode}, restarting')
+                    workers[slot] = start(slot)
+            time.sleep(0.5)
+        if shared_store:
+            del os.environ[RATELIMIT_DB_ENV]
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(shared_store + suffix)
+                except OSError:
+                    pass
+        self.stdout.write('All workers stopped')
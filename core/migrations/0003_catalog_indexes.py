@@ -0,0 +1,78 @@
+# Generated by Django 5.2.4 on 2026-10-17 05:59
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def detach_duplicate_courses(apps, schema_editor):
+    # Courses sharing (platform, external_id): the oldest keeps the id, the others lose it
+    # (kept in extra_data) so the unique constraint can be added
+    Course = apps.get_model('core', 'Course')
+    duplicates = Course.objects.filter(external_id__isnull=False).order_by().values(
+        'platform_id', 'external_id').annotate(count=Count('pk'), keep=Min('pk')).filter(count__gt=1)
+    for row in duplicates:
+        courses = Course.objects.filter(platform_id=row['platform_id'], external_id=row['external_id']).exclude(
+            pk=row['keep'])
+        for course in courses:
+            course.extra_data = {**(course.extra_data or {}), 'duplicate_external_id': course.external_id}
+            course.external_id = None
+            course.save(update_fields=['extra_data', 'external_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_systemconfig_application_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='course',
+            index=models.Index(fields=['platform', 'is_downloaded'], name='course_platform_dl_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['lesson', 'should_download', 'is_downloaded'], name='file_lesson_dl_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['lesson', 'external_id'], name='file_lesson_external_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_downloaded', False), ('should_download', True)), fields=['lesson'], name='file_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(condition=models.Q(('has_drm', True), ('is_decrypted', False), ('is_downloaded', True)), fields=['lesson'], name='file_drm_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['module', 'should_download', 'is_downloaded'], name='lesson_module_dl_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['module', 'external_id'], name='lesson_module_external_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_downloaded', False), ('should_download', True)), fields=['module'], name='lesson_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='module',
+            index=models.Index(fields=['course', 'should_download', 'is_downloaded'], name='module_course_dl_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='module',
+            index=models.Index(fields=['course', 'external_id'], name='module_course_external_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='module',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_downloaded', False), ('should_download', True)), fields=['course'], name='module_pending_idx'),
+        ),
+        migrations.RunPython(detach_duplicate_courses, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='course',
+            constraint=models.UniqueConstraint(condition=models.Q(('external_id__isnull', False)), fields=('platform', 'external_id'), name='course_platform_external_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systemconfig',
+            name='tool_versions',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_systemconfig_tool_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userconfig',
+            name='stream_max_height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userconfig',
+            name='stream_quality',
+            field=models.CharField(choices=[('best', 'Best'), ('smallest', 'Smallest')], default='best', max_length=16),
+        ),
+    ]
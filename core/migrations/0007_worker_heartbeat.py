@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_download_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkerHeartbeat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker_id', models.CharField(max_length=128, unique=True)),
+                ('hostname', models.CharField(max_length=255)),
+                ('pid', models.IntegerField()),
+                ('state', models.CharField(choices=[('running', 'Running'), ('draining', 'Draining'), ('stopped', 'Stopped')], default='running', max_length=16)),
+                ('started_at', models.DateTimeField()),
+                ('last_seen', models.DateTimeField(db_index=True)),
+                ('active_tasks', models.IntegerField(default=0)),
+                ('tasks_done', models.IntegerField(default=0)),
+                ('tasks_failed', models.IntegerField(default=0)),
+                ('bytes_downloaded', models.BigIntegerField(default=0)),
+                ('bytes_per_second', models.FloatField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_worker_heartbeat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileDigest',
+            fields=[
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='digest', serialize=False, to='core.file')),
+                ('path', models.CharField(max_length=1024)),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('algorithm', models.CharField(default='sha256', max_length=16)),
+                ('digest', models.CharField(max_length=128)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
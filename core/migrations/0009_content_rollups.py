@@ -0,0 +1,99 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:37
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+ROLLUP_FIELDS = ('file_count', 'downloaded_count', 'total_bytes', 'downloaded_bytes', 'drm_count', 'total_duration')
+
+
+def backfill_rollups(apps, schema_editor):
+    File = apps.get_model('core', 'File')
+    Module = apps.get_model('core', 'Module')
+    Course = apps.get_model('core', 'Course')
+    rows = File.objects.order_by().values('lesson__module_id').annotate(
+        file_count=Count('pk'),
+        downloaded_count=Count('pk', filter=Q(is_downloaded=True)),
+        total_bytes=Sum('file_size'),
+        downloaded_bytes=Sum('file_size', filter=Q(is_downloaded=True)),
+        drm_count=Count('pk', filter=Q(has_drm=True)),
+        total_duration=Sum('duration'),
+    )
+    modules = [Module(pk=row['lesson__module_id'], **{name: row[name] or 0 for name in ROLLUP_FIELDS})
+               for row in rows if row['lesson__module_id'] is not None]
+    Module.objects.bulk_update(modules, ROLLUP_FIELDS, batch_size=500)
+    rows = Module.objects.exclude(course=None).order_by().values('course_id').annotate(
+        **{f'sum_{name}': Sum(name) for name in ROLLUP_FIELDS})
+    courses = [Course(pk=row['course_id'], **{name: row[f'sum_{name}'] or 0 for name in ROLLUP_FIELDS})
+               for row in rows]
+    Course.objects.bulk_update(courses, ROLLUP_FIELDS, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_file_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='course',
+            name='downloaded_bytes',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='downloaded_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='drm_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='file_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='total_bytes',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='course',
+            name='total_duration',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='downloaded_bytes',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='downloaded_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='drm_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='file_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='total_bytes',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='total_duration',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,135 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# The index mirrors core_searchdocument: external content FTS5 on SQLite, kept in step by triggers,
+# and a stored tsvector column with a GIN index on PostgreSQL. Other databases search with LIKE.
+SQLITE_FORWARD = [
+    """CREATE VIRTUAL TABLE core_search_fts USING fts5(
+        title, body, user_id UNINDEXED,
+        content='core_searchdocument', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER core_search_fts_ai AFTER INSERT ON core_searchdocument BEGIN
+        INSERT INTO core_search_fts(rowid, title, body, user_id) VALUES (new.id, new.title, new.body, new.user_id);
+    END""",
+    """CREATE TRIGGER core_search_fts_ad AFTER DELETE ON core_searchdocument BEGIN
+        INSERT INTO core_search_fts(core_search_fts, rowid, title, body, user_id)
+        VALUES ('delete', old.id, old.title, old.body, old.user_id);
+    END""",
+    """CREATE TRIGGER core_search_fts_au AFTER UPDATE OF title, body, user_id ON core_searchdocument BEGIN
+        INSERT INTO core_search_fts(core_search_fts, rowid, title, body, user_id)
+        VALUES ('delete', old.id, old.title, old.body, old.user_id);
+        INSERT INTO core_search_fts(rowid, title, body, user_id) VALUES (new.id, new.title, new.body, new.user_id);
+    END""",
+    # Titles weigh ten times the body in ORDER BY rank
+    """INSERT INTO core_search_fts(core_search_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')""",
+]
+SQLITE_REVERSE = [
+    'DROP TRIGGER IF EXISTS core_search_fts_au',
+    'DROP TRIGGER IF EXISTS core_search_fts_ad',
+    'DROP TRIGGER IF EXISTS core_search_fts_ai',
+    'DROP TABLE IF EXISTS core_search_fts',
+]
+POSTGRES_FORWARD = [
+    """ALTER TABLE core_searchdocument ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(body, '')), 'B')) STORED""",
+    'CREATE INDEX core_search_vector_gin ON core_searchdocument USING GIN (search_vector)',
+]
+POSTGRES_REVERSE = [
+    'DROP INDEX IF EXISTS core_search_vector_gin',
+    'ALTER TABLE core_searchdocument DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute('PRAGMA compile_options')
+            if 'ENABLE_FTS5' not in {row[0] for row in cursor.fetchall()}:
+                return
+        _run(schema_editor, SQLITE_FORWARD)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_FORWARD)
+
+
+def _join(*parts):
+    return '\n'.join(part for part in parts if part)
+
+
+def index_existing_content(apps, schema_editor):
+    """Fill the new index with the catalog and notes already there, as core.search.rebuild_index would"""
+    SearchDocument = apps.get_model('core', 'SearchDocument')
+
+    def course(pk, course_id, name, teacher, description):
+        return {'course_id': course_id, 'title': name or '', 'body': _join(teacher, description)}
+
+    def content(pk, course_id, name, description):
+        return {'course_id': course_id, 'title': name or '', 'body': description or ''}
+
+    def note(pk, course_id, user_id, file_name, text):
+        return {'course_id': course_id, 'user_id': user_id, 'title': file_name or '', 'body': text or ''}
+
+    sources = [
+        ('course', 'core.Course', ('pk', 'pk', 'name', 'teacher', 'description'), course),
+        ('module', 'core.Module', ('pk', 'course_id', 'name', 'description'), content),
+        ('lesson', 'core.Lesson', ('pk', 'module__course_id', 'name', 'description'), content),
+        ('file', 'core.File', ('pk', 'lesson__module__course_id', 'name', 'description'), content),
+        ('note', 'cognitahz.VideoNote', ('pk', 'file__lesson__module__course_id', 'user_id', 'file__name', 'text'),
+         note),
+    ]
+    for kind, model, fields, document in sources:
+        batch = []
+        for row in apps.get_model(model).objects.order_by('pk').values_list(*fields).iterator(chunk_size=500):
+            batch.append(SearchDocument(kind=kind, object_id=row[0], **document(*row)))
+            if len(batch) == 500:
+                SearchDocument.objects.bulk_create(batch)
+                batch = []
+        SearchDocument.objects.bulk_create(batch)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _run(schema_editor, SQLITE_REVERSE)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_content_rollups'),
+        ('cognitahz', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=16)),
+                ('object_id', models.IntegerField()),
+                ('title', models.TextField(blank=True, default='')),
+                ('body', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('course', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_documents', to='core.course')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='search_documents', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'object_id'), name='search_document_object_uniq')],
+            },
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        # After the FTS table and its triggers, so they index these rows too
+        migrations.RunPython(index_existing_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:55
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def cancel_duplicate_tasks(apps, schema_editor):
+    # Keep the oldest active task of each file queued more than once
+    DownloadTask = apps.get_model('core', 'DownloadTask')
+    active = DownloadTask.objects.filter(state__in=['pending', 'running'])
+    duplicates = active.order_by().values('file_id').annotate(count=Count('pk'), keep=Min('pk')).filter(count__gt=1)
+    for row in duplicates:
+        active.filter(file_id=row['file_id']).exclude(pk=row['keep']).update(
+            state='cancelled', lease_owner=None, lease_expires=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_search_document'),
+    ]
+
+    operations = [
+        migrations.RunPython(cancel_duplicate_tasks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='downloadtask',
+            constraint=models.UniqueConstraint(condition=models.Q(('state__in', ['pending', 'running'])), fields=('file',), name='download_task_active_file_uniq'),
+        ),
+    ]
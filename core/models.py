@@ -1,30 +1,23 @@
 from django.db import models
 import uuid
 from django.contrib.auth import get_user_model
-from cryptography.fernet import Fernet, InvalidToken
-import base64
 import json
 import re
 import os
 from pathlib import Path
-import shutil
+import copy
+import threading
+import time
+from django.conf import settings
+from .tools import probe_tools
+# Encryption helpers live in core.crypto; re-exported here for existing imports
+from .crypto import get_fernet, encrypt_value, decrypt_value, encrypt_many, decrypt_many  # noqa: F401
 
 User = get_user_model()
 
-# Encryption helpers
-
-def get_fernet(passphrase: str) -> Fernet:
-    # Derive a 32-byte key from the passphrase (pad/truncate for demo; use PBKDF2 in prod)
-    key = base64.urlsafe_b64encode((passphrase * 32)[:32].encode())
-    return Fernet(key)
-
-def encrypt_value(value: str, passphrase: str) -> str:
-    f = get_fernet(passphrase)
-    return f.encrypt(value.encode()).decode()
-
-def decrypt_value(token: str, passphrase: str) -> str:
-    f = get_fernet(passphrase)
-    return f.decrypt(token.encode()).decode()
+# Process-local cache for SystemConfig.get_solo()
+_solo_lock = threading.Lock()
+_solo_cache = {}
 
 class TimestampMixin(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
@@ -33,6 +26,52 @@ class TimestampMixin(models.Model):
     class Meta:
         abstract = True
 
+class ContentRollupMixin(models.Model):
+    """Denormalised totals over the files below a Course/Module, kept current by core.rollups"""
+    file_count = models.IntegerField(default=0, editable=False)
+    downloaded_count = models.IntegerField(default=0, editable=False)
+    total_bytes = models.BigIntegerField(default=0, editable=False)
+    downloaded_bytes = models.BigIntegerField(default=0, editable=False)
+    drm_count = models.IntegerField(default=0, editable=False)
+    total_duration = models.BigIntegerField(default=0, editable=False)
+
+    ROLLUP_FIELDS = ('file_count', 'downloaded_count', 'total_bytes', 'downloaded_bytes', 'drm_count', 'total_duration')
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # The instance's totals may be stale by now; only core.rollups writes them
+            kwargs['update_fields'] = [field.name for field in self._meta.concrete_fields
+                                       if not field.primary_key and field.name not in self.ROLLUP_FIELDS]
+        super().save(*args, **kwargs)
+
+class RollupTrackedMixin:
+    """Remembers the values of ROLLUP_TRACKED_FIELDS a row was loaded with, so saves can send deltas"""
+    ROLLUP_TRACKED_FIELDS = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)  # type: ignore[misc]
+        instance._rollup_loaded = {
+            name: value for name, value in zip(field_names, values) if name in cls.ROLLUP_TRACKED_FIELDS}
+        return instance
+
+class SearchIndexedQuerySet(models.QuerySet):
+    """update() bypasses post_save; this re-indexes the rows it changed (see core.search)"""
+
+    def update(self, **kwargs):
+        from .search import objects_updated, touches_index
+        kind = self.model._meta.model_name  # course, module, lesson and file are also their index kinds
+        if not touches_index(kind, kwargs):
+            return super().update(**kwargs)
+        # Taken first: the filter may no longer match once the rows are changed
+        ids = list(self.order_by().values_list('pk', flat=True))
+        rows = super().update(**kwargs)
+        objects_updated(kind, ids, kwargs)
+        return rows
+
 class SystemConfig(models.Model):
     debug = models.BooleanField(default=False)  # type: ignore[attr-defined]
     download_path = models.CharField(max_length=512)
@@ -54,12 +93,32 @@ class SystemConfig(models.Model):
     rclone_path = models.CharField(max_length=512, blank=True, null=True)
     application_key = models.CharField(max_length=128, blank=True, null=True, help_text="SHA512 hash for unlocking extra features")
 
+    tool_versions = models.JSONField(default=dict, blank=True)
+
     @classmethod
     def get_solo(cls):
-        obj, _ = cls.objects.get_or_create(pk=1)  # type: ignore[attr-defined]
+        """
+        The single config row. Served from a process-local cache that is dropped on
+        post_save/post_delete (see core.signals) and after KATOMART_CONFIG_CACHE_TTL
+        seconds, so hot paths don't hit the database. Callers get their own copy.
+        """
+        ttl = getattr(settings, 'KATOMART_CONFIG_CACHE_TTL', 30)
+        with _solo_lock:
+            cached, cached_at = _solo_cache.get('obj'), _solo_cache.get('at')
+        if cached is None or time.monotonic() - cached_at >= ttl:
+            # Not under the lock: creating the row fires post_save, which invalidates the cache
+            cached, _ = cls.objects.get_or_create(pk=1)  # type: ignore[attr-defined]
+            with _solo_lock:
+                _solo_cache.update(obj=cached, at=time.monotonic())
+        obj = copy.copy(cached)
         obj.auto_detect_tools()
         return obj
 
+    @classmethod
+    def invalidate_solo_cache(cls):
+        with _solo_lock:
+            _solo_cache.clear()
+
     @staticmethod
     def get_jwt_secret_key():
         key = os.environ.get('JWT_SECRET_KEY')
@@ -67,36 +126,13 @@ class SystemConfig(models.Model):
             raise RuntimeError('JWT_SECRET_KEY must be set in the environment (.env)')
         return key
 
-    def auto_detect_tools(self):
-        ffmpeg_path = shutil.which('ffmpeg')
-        self.ffmpeg_available = bool(ffmpeg_path)
-        self.ffmpeg_path = ffmpeg_path or ''
-
-        bento4_path = shutil.which('mp4decrypt')
-        self.bento4_available = bool(bento4_path)
-        self.bento4_path = bento4_path or ''
-
-        aria2c_path = shutil.which('aria2c')
-        self.aria2c_available = bool(aria2c_path)
-        self.aria2c_path = aria2c_path or ''
-
-        firefox_path = shutil.which('firefox')
-        geckodriver_path = shutil.which('geckodriver') if firefox_path else None
-        self.geckodriver_available = bool(geckodriver_path)
-        self.geckodriver_path = geckodriver_path or ''
-
-        chrome_path = shutil.which('chrome') or shutil.which('google-chrome')
-        chromedriver_path = shutil.which('chromedriver') if chrome_path else None
-        self.chromedriver_available = bool(chromedriver_path)
-        self.chromedriver_path = chromedriver_path or ''
-
-        mkvtoolnix_path = shutil.which('mkvmerge')
-        self.mkvtoolnix_available = bool(mkvtoolnix_path)
-        self.mkvtoolnix_path = mkvtoolnix_path or ''
-
-        rclone_path = shutil.which('rclone')
-        self.rclone_available = bool(rclone_path)
-        self.rclone_path = rclone_path or ''
+    def auto_detect_tools(self, force=False):
+        # Cheap unless the probe cache expired (or force=True): no PATH scans per call
+        tools = probe_tools(force=force)
+        for name, info in tools.items():
+            setattr(self, f'{name}_available', bool(info['path']))
+            setattr(self, f'{name}_path', info['path'])
+        self.tool_versions = {name: info['version'] for name, info in tools.items() if info['version']}
         # should_download_drm_content can only be True if bento4 is available
         if self.should_download_drm_content and not self.bento4_available:
             self.should_download_drm_content = False
@@ -162,38 +198,31 @@ class PlatformAuth(TimestampMixin):
     expires_at = models.DateTimeField(null=True, blank=True)
     extra_data = models.JSONField(default=dict, blank=True)
 
+    CREDENTIAL_FIELDS = ('password', 'token', 'session_cookie', 'refresh_token')
+
     def set_credentials(self, password, token=None, session_cookie=None, refresh_token=None, passphrase=None):
         if not passphrase:
             raise ValueError('Passphrase required for encryption')
-        self.password_encrypted = encrypt_value(password, passphrase)
-        if token:
-            self.token_encrypted = encrypt_value(token, passphrase)
-        if session_cookie:
-            self.session_cookie_encrypted = encrypt_value(session_cookie, passphrase)
-        if refresh_token:
-            self.refresh_token_encrypted = encrypt_value(refresh_token, passphrase)
+        # One salt (and so one key derivation) per record for all of its secrets
+        encrypted = encrypt_many([password, token or None, session_cookie or None, refresh_token or None], passphrase)
+        self.password_encrypted = encrypted[0]
+        for name, value in zip(self.CREDENTIAL_FIELDS[1:], encrypted[1:]):
+            if value:
+                setattr(self, f'{name}_encrypted', value)
 
     def get_credentials(self, passphrase):
-        creds = {}
-        try:
-            creds['password'] = decrypt_value(str(self.password_encrypted), passphrase)
-        except Exception:
-            creds['password'] = None
-        try:
-            creds['token'] = decrypt_value(str(self.token_encrypted), passphrase) if self.token_encrypted else None
-        except Exception:
-            creds['token'] = None
-        try:
-            creds['session_cookie'] = decrypt_value(str(self.session_cookie_encrypted), passphrase) if self.session_cookie_encrypted else None
-        except Exception:
-            creds['session_cookie'] = None
-        try:
-            creds['refresh_token'] = decrypt_value(str(self.refresh_token_encrypted), passphrase) if self.refresh_token_encrypted else None
-        except Exception:
-            creds['refresh_token'] = None
-        return creds
-
-class Course(TimestampMixin):
+        return self.get_credentials_many([self], passphrase)[self.pk]
+
+    @classmethod
+    def get_credentials_many(cls, auths, passphrase):
+        """Decrypt the credentials of many accounts at once; returns {auth.pk: credentials}"""
+        auths = list(auths)
+        fields = cls.CREDENTIAL_FIELDS
+        tokens = [getattr(auth, f'{name}_encrypted') for auth in auths for name in fields]
+        values = iter(decrypt_many(tokens, passphrase))
+        return {auth.pk: {name: next(values) for name in fields} for auth in auths}
+
+class Course(ContentRollupMixin, TimestampMixin):
     internal_id = models.AutoField(primary_key=True)
     katomart_id = models.UUIDField(null=True, blank=True, default=None)
     external_id = models.CharField(max_length=128, null=True, blank=True)
@@ -219,7 +248,22 @@ class Course(TimestampMixin):
     platform = models.ForeignKey('Platform', on_delete=models.SET_NULL, null=True, blank=True, related_name="courses")
     auth = models.ForeignKey(PlatformAuth, on_delete=models.SET_NULL, null=True, blank=True, related_name="courses")
 
-class Module(TimestampMixin):
+    objects = SearchIndexedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['platform', 'is_downloaded'], name='course_platform_dl_idx'),
+        ]
+        constraints = [
+            # Platform responses are matched on external_id, which only has to be unique within a platform
+            models.UniqueConstraint(
+                fields=['platform', 'external_id'], condition=models.Q(external_id__isnull=False),
+                name='course_platform_external_uniq'),
+        ]
+
+class Module(RollupTrackedMixin, ContentRollupMixin, TimestampMixin):
+    ROLLUP_TRACKED_FIELDS = ('course_id',)
+
     internal_id = models.AutoField(primary_key=True)
     katomart_id = models.UUIDField(null=True, blank=True, default=None)
     external_id = models.CharField(max_length=128, null=True, blank=True)
@@ -241,7 +285,20 @@ class Module(TimestampMixin):
     download_type = models.CharField(max_length=64, null=True, blank=True)
     course = models.ForeignKey('Course', on_delete=models.CASCADE, related_name="modules", null=True, blank=True)
 
-class Lesson(TimestampMixin):
+    objects = SearchIndexedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['course', 'should_download', 'is_downloaded'], name='module_course_dl_state_idx'),
+            models.Index(fields=['course', 'external_id'], name='module_course_external_idx'),
+            models.Index(
+                fields=['course'], condition=models.Q(should_download=True, is_downloaded=False, is_active=True),
+                name='module_pending_idx'),
+        ]
+
+class Lesson(RollupTrackedMixin, TimestampMixin):
+    ROLLUP_TRACKED_FIELDS = ('module_id',)
+
     internal_id = models.AutoField(primary_key=True)
     katomart_id = models.UUIDField(null=True, blank=True, default=None)
     external_id = models.CharField(max_length=128, null=True, blank=True)
@@ -263,7 +320,58 @@ class Lesson(TimestampMixin):
     download_type = models.CharField(max_length=64, null=True, blank=True)
     module = models.ForeignKey('Module', on_delete=models.CASCADE, related_name="lessons", null=True, blank=True)
 
-class File(TimestampMixin):
+    objects = SearchIndexedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['module', 'should_download', 'is_downloaded'], name='lesson_module_dl_state_idx'),
+            models.Index(fields=['module', 'external_id'], name='lesson_module_external_idx'),
+            models.Index(
+                fields=['module'], condition=models.Q(should_download=True, is_downloaded=False, is_active=True),
+                name='lesson_pending_idx'),
+        ]
+
+class FileQuerySet(SearchIndexedQuerySet):
+    """Bulk writes that bypass save() still keep the Course/Module rollups current (see core.rollups)"""
+
+    def update(self, **kwargs):
+        from .rollups import schedule_refresh, touches_rollups
+        if not touches_rollups(kwargs):
+            return super().update(**kwargs)
+        module_ids = set(self.order_by().values_list('lesson__module_id', flat=True).distinct())
+        rows = super().update(**kwargs)
+        lesson = kwargs.get('lesson', kwargs.get('lesson_id'))
+        # An expression sends each file somewhere else; recompute_rollups covers where they landed
+        lesson_ids = [] if hasattr(lesson, 'resolve_expression') else [getattr(lesson, 'pk', lesson)]
+        schedule_refresh(module_ids=module_ids, lesson_ids=lesson_ids)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        from .rollups import schedule_refresh
+        objs = super().bulk_create(objs, *args, **kwargs)
+        schedule_refresh(lesson_ids={obj.lesson_id for obj in objs})
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        from .rollups import bulk_update_scope, schedule_refresh, touches_rollups
+        if not touches_rollups(fields):
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        objs = list(objs)
+        module_ids = set()
+        if 'lesson' in fields or 'lesson_id' in fields:
+            # Files moving between lessons also leave their old module
+            module_ids = set(self.model.objects.filter(pk__in=[obj.pk for obj in objs]).order_by().values_list(
+                'lesson__module_id', flat=True).distinct())
+        with bulk_update_scope():
+            rows = super().bulk_update(objs, fields, *args, **kwargs)
+        for obj in objs:
+            obj.__dict__.pop('_rollup_loaded', None)
+        schedule_refresh(module_ids=module_ids, lesson_ids={obj.lesson_id for obj in objs})
+        return rows
+
+class File(RollupTrackedMixin, TimestampMixin):
+    ROLLUP_TRACKED_FIELDS = ('lesson_id', 'is_downloaded', 'file_size', 'has_drm', 'duration')
+
     internal_id = models.AutoField(primary_key=True)
     katomart_id = models.UUIDField(null=True, blank=True, default=None)
     external_id = models.CharField(max_length=128, null=True, blank=True)
@@ -287,6 +395,21 @@ class File(TimestampMixin):
     duration = models.IntegerField(null=True, blank=True)
     lesson = models.ForeignKey('Lesson', on_delete=models.CASCADE, related_name="files", null=True, blank=True)
 
+    objects = FileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['lesson', 'should_download', 'is_downloaded'], name='file_lesson_dl_state_idx'),
+            models.Index(fields=['lesson', 'external_id'], name='file_lesson_external_idx'),
+            # Partial indexes only hold the rows the download scheduler is still interested in
+            models.Index(
+                fields=['lesson'], condition=models.Q(should_download=True, is_downloaded=False, is_active=True),
+                name='file_pending_idx'),
+            models.Index(
+                fields=['lesson'], condition=models.Q(has_drm=True, is_decrypted=False, is_downloaded=True),
+                name='file_drm_pending_idx'),
+        ]
+
 class UserFormattedName(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='formatted_names')
     content_type = models.CharField(max_length=32)  # 'course', 'module', 'lesson', 'file'
@@ -307,11 +430,143 @@ class UserConfig(models.Model):
     mkvtoolnix_path = models.CharField(max_length=512, blank=True, null=True)
     rclone_path = models.CharField(max_length=512, blank=True, null=True)
 
+    # HLS/DASH rendition choice, see core.downloader.manifests.VariantPolicy
+    STREAM_QUALITY_CHOICES = [('best', 'Best'), ('smallest', 'Smallest')]
+    stream_max_height = models.PositiveIntegerField(null=True, blank=True)
+    stream_quality = models.CharField(max_length=16, choices=STREAM_QUALITY_CHOICES, default='best')
+
     def get_download_path(self):
         if self.download_path:
             return Path(str(self.download_path))
         return None
 
+class DownloadJob(TimestampMixin):
+    """A batch of files a user asked to download; its tasks are the unit of work (see core.downloader.tasks)"""
+    STATE_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='download_jobs')
+    course = models.ForeignKey('Course', on_delete=models.SET_NULL, related_name='download_jobs', null=True, blank=True)
+    backend = models.CharField(max_length=32, default='http')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default='pending')
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'DownloadJob({self.pk}, {self.user}, {self.state})'
+
+class DownloadTask(TimestampMixin):
+    """
+    One file of a DownloadJob. A worker owns a running task only while its lease
+    (lease_owner/lease_expires) is valid; expired leases are claimed again, so a
+    crashed worker's tasks resume elsewhere.
+    """
+    STATE_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    job = models.ForeignKey(DownloadJob, on_delete=models.CASCADE, related_name='tasks')
+    file = models.ForeignKey('File', on_delete=models.CASCADE, related_name='download_tasks')
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default='pending')
+    bytes_done = models.BigIntegerField(default=0)
+    bytes_total = models.BigIntegerField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    available_at = models.DateTimeField(null=True, blank=True)  # retry backoff
+    lease_owner = models.CharField(max_length=128, null=True, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'file'], name='download_task_job_file_uniq'),
+            # A file is queued at most once at a time, whatever job it came from
+            models.UniqueConstraint(
+                fields=['file'], condition=models.Q(state__in=['pending', 'running']),
+                name='download_task_active_file_uniq'),
+        ]
+        indexes = [
+            # Only pending/running rows are ever claimed, so the claim index stays small
+            models.Index(
+                fields=['state', 'lease_expires', 'available_at'],
+                condition=models.Q(state__in=['pending', 'running']), name='download_task_claim_idx'),
+            models.Index(fields=['job', 'state'], name='download_task_job_state_idx'),
+        ]
+
+    def __str__(self):
+        return f'DownloadTask({self.pk}, file={self.file_id}, {self.state})'
+
+class WorkerHeartbeat(models.Model):
+    """Live status of a download worker process, refreshed every few seconds by run_workers"""
+    STATE_CHOICES = [
+        ('running', 'Running'),
+        ('draining', 'Draining'),
+        ('stopped', 'Stopped'),
+    ]
+
+    worker_id = models.CharField(max_length=128, unique=True)
+    hostname = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    state = models.CharField(max_length=16, choices=STATE_CHOICES, default='running')
+    started_at = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+    active_tasks = models.IntegerField(default=0)
+    tasks_done = models.IntegerField(default=0)
+    tasks_failed = models.IntegerField(default=0)
+    bytes_downloaded = models.BigIntegerField(default=0)
+    bytes_per_second = models.FloatField(default=0)
+
+    def __str__(self):
+        return f'WorkerHeartbeat({self.worker_id}, {self.state})'
+
+class FileDigest(models.Model):
+    """
+    Content hash of a downloaded File, reused while the file on disk keeps the
+    same path, size and mtime (see core.hashing)
+    """
+    file = models.OneToOneField(File, on_delete=models.CASCADE, primary_key=True, related_name='digest')
+    path = models.CharField(max_length=1024)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    algorithm = models.CharField(max_length=16, default='sha256')
+    digest = models.CharField(max_length=128)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'FileDigest({self.file_id}, {self.algorithm}:{self.digest[:12]})'
+
+class SearchDocument(models.Model):
+    """
+    One searchable catalog object (course, module, lesson, file) or video note,
+    denormalised for the full-text index: an FTS5 table on SQLite, a generated
+    tsvector column with a GIN index on PostgreSQL (see core.search and
+    migration 0010). Notes carry their owner and are only found by them.
+    """
+    KINDS = ('course', 'module', 'lesson', 'file', 'note')
+
+    kind = models.CharField(max_length=16)
+    object_id = models.IntegerField()
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, null=True, blank=True, related_name='search_documents')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='search_documents')
+    title = models.TextField(blank=True, default='')
+    body = models.TextField(blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'object_id'], name='search_document_object_uniq'),
+        ]
+
+    def __str__(self):
+        return f'SearchDocument({self.kind}:{self.object_id})'
+
 def ensure_config_row_exists():
     """
     Ensure the single Config row exists in the database (id=1).
@@ -418,52 +673,3 @@ def get_user_download_path(user):
 def ensure_directory_exists(directory: Path) -> Path:
     directory.mkdir(parents=True, exist_ok=True)
     return directory
-
-def remaining_path_length(path: Path) -> int:
-    max_length = 260
-    current_length = len(str(path.resolve()))
-    return max_length - current_length
-
-def build_user_path(user, course, module, lesson, file, order_dict=None):
-    if order_dict is None:
-        order_dict = {}
-    # Get base download path
-    base_path = get_user_download_path(user)
-    ensure_directory_exists(base_path)
-    # Order prefix: always 3 digits, zero-padded, with '. '
-    def order_prefix(obj):
-        order = getattr(obj, 'order', None)
-        if order is None:
-            return '000. '
-        return f"{int(order):03d}. "
-    # Name logic
-    def get_name(obj, content_type, is_filename=False):
-        if user.is_authenticated:
-            uf = UserFormattedName.objects.filter(user=user, content_type=content_type, object_id=obj.internal_id).first()  # type: ignore[attr-defined]
-            if uf:
-                return uf.formatted_name
-        return getattr(obj, 'formatted_name', '') or getattr(obj, 'name', '')
-    # Max lengths
-    MAX_COURSE_NAME = 64
-    MAX_MODULE_NAME = 64
-    MAX_LESSON_NAME = 64
-    MAX_FILE_NAME = 80
-    # Compose each segment
-    course_name = sanitize_and_truncate_path_component(
-        get_name(course, 'course'), MAX_COURSE_NAME, False, order_prefix(course))
-    module_name = sanitize_and_truncate_path_component(
-        get_name(module, 'module'), MAX_MODULE_NAME, False, order_prefix(module))
-    lesson_name = sanitize_and_truncate_path_component(
-        get_name(lesson, 'lesson'), MAX_LESSON_NAME, False, order_prefix(lesson))
-    ext = getattr(file, 'file_type', '')
-    file_name = sanitize_and_truncate_path_component(
-        get_name(file, 'file', True), MAX_FILE_NAME, True, order_prefix(file), f'.{ext}' if ext else '')
-    # Build path
-    path = base_path / course_name / module_name / lesson_name / file_name
-    # Ensure path length
-    if remaining_path_length(path) < 0:
-        # Truncate file_name further if needed
-        excess = abs(remaining_path_length(path))
-        file_name = file_name[:-excess]
-        path = base_path / course_name / module_name / lesson_name / file_name
-    return path
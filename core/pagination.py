@@ -0,0 +1,62 @@
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.utils.functional import cached_property
+from rest_framework.pagination import CursorPagination
+
+
+class CatalogCursorPagination(CursorPagination):
+    """Keyset pagination over the indexed primary key of the catalog tables"""
+    ordering = 'internal_id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+ESTIMATE_THRESHOLD = 100_000  # rows; smaller tables are counted exactly
+COUNT_CAP = 100_000  # filtered changelists count at most this many rows
+
+
+def estimated_row_count(model):
+    """The planner's row estimate for `model`'s table, or None where the backend keeps none"""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        try:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [table])
+            elif connection.vendor == 'mysql':
+                cursor.execute('SELECT table_rows FROM information_schema.tables '
+                               'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+            elif connection.vendor == 'sqlite':
+                # Filled in by ANALYZE; every row of a table starts with its row count
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            else:
+                return None
+        except DatabaseError:
+            # SQLite before the first ANALYZE: no sqlite_stat1 table
+            return None
+        row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    try:
+        estimate = int(str(row[0]).split()[0])
+    except ValueError:
+        return None
+    # Postgres reports -1 for tables that were never vacuumed or analyzed
+    return estimate if estimate >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin paginator for the big catalog tables: an unfiltered changelist uses
+    the table's row estimate instead of COUNT(*) once the table is large, and
+    a filtered one stops counting at COUNT_CAP rows.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_row_count(queryset.model)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return queryset.order_by()[:COUNT_CAP].count()
@@ -0,0 +1,128 @@
+from pathlib import Path
+
+from .models import (
+    Module, Lesson, File, UserFormattedName, MAX_PATH, MAX_COURSE_NAME, MAX_MODULE_NAME, MAX_LESSON_NAME,
+    MAX_FILE_NAME, sanitize_and_truncate_path_component, get_user_download_path, ensure_directory_exists,
+)
+
+_NODE_FIELDS = ('internal_id', 'name', 'formatted_name', 'order')
+
+
+def _order_prefix(order):
+    # Always 3 digits, zero-padded, with '. '
+    if order is None:
+        return '000. '
+    return f"{int(order):03d}. "
+
+
+def _numbered(prefix, counter, extension, max_len):
+    # '<prefix><n><extension>' cut to max_len, giving up the prefix first and then the extension
+    number = str(counter)
+    if len(number) + len(extension) > max_len:
+        extension = ''
+    return f'{prefix[:max(max_len - len(number) - len(extension), 0)]}{number}{extension}'
+
+
+class PathPlanner:
+    """
+    Plans the output path of every file of a course in one pass.
+
+    Layout: <download root>/<course>/<module>/<lesson>/<file>, each component
+    the user's formatted-name override, the formatted name or the name, with a
+    3-digit order prefix, sanitised and cut to its MAX_* length. File names
+    are shortened further so the whole path stays within MAX_PATH. Sibling
+    names that collide after sanitising/truncation get a ' (n)' suffix, so two
+    files never map to the same path. The download root, the overrides and
+    the catalog are each loaded once.
+    """
+
+    def __init__(self, user, course, base_path=None):
+        self.user = user
+        self.course = course
+        self.base_path = Path(base_path) if base_path else get_user_download_path(user)
+        self._overrides = self._load_overrides()
+
+    def _load_overrides(self):
+        if not self.user.is_authenticated:
+            return {}
+        rows = UserFormattedName.objects.filter(user=self.user).values_list(  # type: ignore[attr-defined]
+            'content_type', 'object_id', 'formatted_name')
+        return {(content_type, object_id): name for content_type, object_id, name in rows}
+
+    def _display_name(self, node, content_type):
+        override = self._overrides.get((content_type, node['internal_id']))
+        if override:
+            return override
+        return node.get('formatted_name') or node.get('name') or ''
+
+    def _component(self, node, content_type, max_len, taken, is_filename=False, ext=''):
+        name = self._display_name(node, content_type)
+        prefix = _order_prefix(node.get('order'))
+        extension = f'.{ext}' if ext else ''
+        component = sanitize_and_truncate_path_component(name, max_len, is_filename, prefix, extension)
+        counter = 2
+        # Case-insensitive, as Windows and macOS filesystems are
+        while component.lower() in taken:
+            suffix = f' ({counter}){extension}'
+            candidate = sanitize_and_truncate_path_component(name, max_len, is_filename, prefix, suffix)
+            if not candidate.endswith(suffix):
+                # Too little room left for the name to carry the suffix
+                candidate = _numbered(prefix, counter, extension, max_len)
+            component = candidate
+            counter += 1
+        taken.add(component.lower())
+        return component
+
+    def plan(self, file_ids=None, create_base=True):
+        """
+        Return a mapping ``file internal_id -> Path`` for the course.
+        `file_ids` restricts the result, but collisions are still resolved
+        against every sibling so the paths are stable between calls.
+        """
+        if create_base:
+            ensure_directory_exists(self.base_path)
+        base_length = len(str(self.base_path.resolve()))
+        course_node = {
+            'internal_id': self.course.internal_id, 'name': self.course.name,
+            'formatted_name': self.course.formatted_name, 'order': getattr(self.course, 'order', None),
+        }
+        course_name = self._component(course_node, 'course', MAX_COURSE_NAME, set())
+
+        modules = Module.objects.filter(course=self.course).order_by(  # type: ignore[attr-defined]
+            'order', 'internal_id').values(*_NODE_FIELDS)
+        lessons = Lesson.objects.filter(module__course=self.course).order_by(  # type: ignore[attr-defined]
+            'order', 'internal_id').values(*_NODE_FIELDS, 'module_id')
+        files = File.objects.filter(lesson__module__course=self.course).order_by(  # type: ignore[attr-defined]
+            'order', 'internal_id').values(*_NODE_FIELDS, 'lesson_id', 'file_type')
+
+        module_dirs = {}
+        taken = set()
+        for module in modules:
+            module_dirs[module['internal_id']] = self._component(module, 'module', MAX_MODULE_NAME, taken)
+
+        lesson_dirs = {}
+        taken_by_module = {}
+        for lesson in lessons:
+            module_dir = module_dirs.get(lesson['module_id'])
+            if module_dir is None:
+                continue
+            taken = taken_by_module.setdefault(lesson['module_id'], set())
+            lesson_dirs[lesson['internal_id']] = (
+                module_dir, self._component(lesson, 'lesson', MAX_LESSON_NAME, taken))
+
+        wanted = set(file_ids) if file_ids is not None else None
+        planned = {}
+        taken_by_lesson = {}
+        for file in files:
+            dirs = lesson_dirs.get(file['lesson_id'])
+            if dirs is None:
+                continue
+            module_dir, lesson_dir = dirs
+            # Keep the whole path under MAX_PATH by shortening the file name, never the folders
+            used = base_length + len(course_name) + len(module_dir) + len(lesson_dir) + 4
+            max_len = min(MAX_FILE_NAME, MAX_PATH - used)
+            taken = taken_by_lesson.setdefault(file['lesson_id'], set())
+            file_name = self._component(file, 'file', max_len, taken, True, file.get('file_type') or '')
+            if wanted is None or file['internal_id'] in wanted:
+                planned[file['internal_id']] = self.base_path / course_name / module_dir / lesson_dir / file_name
+        return planned
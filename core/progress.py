@@ -0,0 +1,268 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+DEFAULT_ADDR = '127.0.0.1:47600'
+DEFAULT_MAX_HZ = 4.0  # deltas per second per subscriber
+PUBLISH_INTERVAL = 0.25  # seconds; workers coalesce byte counts this long
+MAX_DATAGRAM = 60000
+STATE_TTL = 600  # seconds finished files stay in the hub's snapshot
+
+
+def progress_addr():
+    """(host, port) of the local progress bus, from settings.KATOMART_PROGRESS_ADDR; None disables it"""
+    value = getattr(settings, 'KATOMART_PROGRESS_ADDR', DEFAULT_ADDR)
+    if not value:
+        return None
+    host, _, port = str(value).rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class ProgressPublisher:
+    """
+    Sends download progress from a worker process to the progress hub as UDP
+    datagrams on localhost: fire-and-forget, so a worker never waits on (or
+    fails because of) nobody listening. Byte counts are coalesced per file and
+    sent every `interval` seconds with the rate since the last send; state
+    changes go out with the next send, in order.
+    """
+
+    def __init__(self, addr=None, interval=PUBLISH_INTERVAL):
+        self.addr = addr or progress_addr()
+        self.interval = interval
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if self.addr else None
+        self._lock = threading.Lock()
+        self._progress = {}  # file id -> event
+        self._states = []
+        self._last = {}  # file id -> (bytes, monotonic time) at the last send
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._socket is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='katomart-progress', daemon=True)
+            self._thread.start()
+        return self
+
+    def progress(self, file_id, done, total, **meta):
+        with self._lock:
+            self._progress[file_id] = {'type': 'file', 'file': file_id, 'bytes': done, 'total': total, **meta}
+
+    def state(self, file_id, state, **meta):
+        """A state transition (running, done, failed, released); never coalesced away"""
+        with self._lock:
+            self._states.append({'type': 'state', 'file': file_id, 'state': state, **meta})
+            if state != 'running':
+                self._last.pop(file_id, None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            progress, self._progress = self._progress, {}
+            states, self._states = self._states, []
+        if self._socket is None or not (progress or states):
+            return
+        now = time.monotonic()
+        events = []
+        for file_id, event in progress.items():
+            last_bytes, last_time = self._last.get(file_id, (event['bytes'], now))
+            event['rate'] = round(max(event['bytes'] - last_bytes, 0) / (now - last_time), 1) if now > last_time else 0.0
+            self._last[file_id] = (event['bytes'], now)
+            events.append(event)
+        events.extend(states)
+        for datagram in _pack(events):
+            try:
+                self._socket.sendto(datagram, self.addr)
+            except OSError:
+                # Nobody listening, or the buffer is full: progress is best effort
+                pass
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._socket is not None:
+            self._socket.close()
+
+
+def _pack(events):
+    """JSON arrays that each fit in one datagram"""
+    batch, size = [], 2
+    for event in events:
+        encoded = json.dumps(event, separators=(',', ':'))
+        if batch and size + len(encoded) + 1 > MAX_DATAGRAM:
+            yield ('[' + ','.join(batch) + ']').encode()
+            batch, size = [], 2
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        yield ('[' + ','.join(batch) + ']').encode()
+
+
+class _Subscriber:
+    def __init__(self, user_id, course_id):
+        self.user_id = user_id  # None: sees everything (superuser)
+        self.course_id = course_id
+        self.pending = {}  # (type, id) -> latest event
+        self.states = []
+        self.ready = asyncio.Event()
+
+    def wants(self, event):
+        if self.user_id is not None and event.get('user') != self.user_id:
+            return False
+        return self.course_id is None or event.get('course') == self.course_id
+
+
+class ProgressHub:
+    """
+    The receiving end, living in the ASGI process: one UDP socket bound to the
+    progress address, the latest state of every active file (so new
+    subscribers start with a snapshot), and per-subscriber pending deltas,
+    coalesced by file and course until the subscriber's next tick.
+    """
+
+    def __init__(self, addr=None):
+        self.addr = addr or progress_addr()
+        self.files = {}  # file id -> latest merged event
+        self._subscribers = set()
+        self._transport = None
+        self._starting = None
+
+    async def start(self):
+        if self._transport is not None:
+            return
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._bind())
+        await asyncio.shield(self._starting)
+
+    async def _bind(self):
+        hub = self
+
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                try:
+                    events = json.loads(data)
+                except ValueError:
+                    return
+                hub.receive(events if isinstance(events, list) else [events])
+
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(Protocol, local_addr=self.addr)
+
+    def receive(self, events):
+        now = time.monotonic()
+        dirty_courses = set()
+        for event in events:
+            file_id = event.get('file')
+            if file_id is None:
+                continue
+            current = self.files.setdefault(file_id, {'file': file_id})
+            current.update({key: value for key, value in event.items() if key != 'type'})
+            current['seen'] = now
+            if event.get('type') == 'state':
+                current['rate'] = 0.0
+            dirty_courses.add(current.get('course'))
+            for subscriber in self._subscribers:
+                if not subscriber.wants(current):
+                    continue
+                if event.get('type') == 'state':
+                    subscriber.states.append({key: value for key, value in event.items() if key != 'user'})
+                subscriber.pending[('file', file_id)] = self._public(current)
+                subscriber.ready.set()
+        for course_id in dirty_courses - {None}:
+            summaries = {}
+            for subscriber in self._subscribers:
+                if subscriber.course_id not in (None, course_id):
+                    continue
+                if subscriber.user_id not in summaries:
+                    summaries[subscriber.user_id] = self.course_summary(course_id, subscriber.user_id)
+                if summaries[subscriber.user_id]['files']:
+                    subscriber.pending[('course', course_id)] = summaries[subscriber.user_id]
+                    subscriber.ready.set()
+        self._expire(now)
+
+    @staticmethod
+    def _public(event):
+        return {'type': 'file', **{key: value for key, value in event.items() if key not in ('seen', 'user')}}
+
+    def course_summary(self, course_id, user_id=None):
+        """Totals over the course's active files (only `user_id`'s, if given)"""
+        files = [event for event in self.files.values()
+                 if event.get('course') == course_id and (user_id is None or event.get('user') == user_id)]
+        states = defaultdict(int)
+        for event in files:
+            states[event.get('state', 'running')] += 1
+        return {
+            'type': 'course', 'course': course_id, 'files': len(files),
+            'bytes': sum(event.get('bytes') or 0 for event in files),
+            'total': sum(event.get('total') or 0 for event in files),
+            'rate': round(sum(event.get('rate') or 0 for event in files if event.get('state', 'running') == 'running'), 1),
+            'states': dict(states),
+        }
+
+    def _expire(self, now):
+        for file_id in [file_id for file_id, event in self.files.items()
+                        if event.get('state') not in (None, 'running') and now - event['seen'] > STATE_TTL]:
+            del self.files[file_id]
+
+    def snapshot(self, subscriber):
+        return [self._public(event) for event in self.files.values() if subscriber.wants(event)]
+
+    def subscribe(self, user_id=None, course_id=None):
+        subscriber = _Subscriber(user_id, course_id)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    @staticmethod
+    def take(subscriber):
+        """The subscriber's coalesced deltas since the last call: (state transitions, latest file/course events)"""
+        states, subscriber.states = subscriber.states, []
+        pending, subscriber.pending = subscriber.pending, {}
+        subscriber.ready.clear()
+        return states, list(pending.values())
+
+
+_hub = None
+
+
+def get_progress_hub():
+    global _hub
+    if _hub is None:
+        _hub = ProgressHub()
+    return _hub
+
+
+def sse_event(name, data):
+    return f'event: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+async def progress_events(hub, subscriber, max_hz=DEFAULT_MAX_HZ, keepalive=15):
+    """SSE frames for one subscriber: a snapshot, then at most `max_hz` delta frames per second"""
+    interval = 1 / max_hz if max_hz > 0 else 0
+    try:
+        yield sse_event('snapshot', {'files': hub.snapshot(subscriber)})
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.ready.wait(), timeout=keepalive)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            states, latest = hub.take(subscriber)
+            yield sse_event('progress', {'states': states, 'latest': latest})
+            if interval:
+                # Everything arriving meanwhile is merged into the next frame
+                await asyncio.sleep(interval)
+    finally:
+        hub.unsubscribe(subscriber)
@@ -0,0 +1,277 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import F
+
+# Requests per second and bucket size for platforms/kinds without their own entry in
+# Platform.extra_data['rate_limits'] ({"<url_kind>" or "*": {"rate": 2, "burst": 5}})
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 5
+RATE_LIMITS_KEY = 'rate_limits'
+FLUSH_EVERY = 50  # pending visits
+FLUSH_INTERVAL = 10  # seconds
+RATELIMIT_DB_ENV = 'KATOMART_RATELIMIT_DB'  # set by run_workers for its children when settings don't
+
+
+class VisitationLimitReached(Exception):
+    """The PlatformURL has used up its visitation_limit; visiting it again risks the account"""
+
+
+class MemoryStore:
+    """Buckets and visit counters of one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # key -> (tokens, updated)
+        self._counters = {}  # url id -> [used, pending]
+
+    def take(self, key, rate, burst, url_id=None, limit=None, used=None):
+        """
+        Try to take a token (and count a visit of `url_id`). Returns 0 on success or the
+        seconds to wait before trying again; raises VisitationLimitReached at the cap.
+        `used` seeds the visit counter the first time `url_id` is seen.
+        """
+        with self._lock:
+            counter = None
+            if url_id is not None:
+                counter = self._counters.setdefault(url_id, [used or 0, 0])
+                if limit is not None and counter[0] >= limit:
+                    raise VisitationLimitReached(url_id)
+            now = time.monotonic()
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            if counter is not None:
+                counter[0] += 1
+                counter[1] += 1
+            return 0
+
+    def known(self, url_id):
+        with self._lock:
+            return url_id in self._counters
+
+    def drain(self):
+        """Hand over the visits not yet written to the database: {url id: count}"""
+        with self._lock:
+            pending = {url_id: counter[1] for url_id, counter in self._counters.items() if counter[1]}
+            for url_id in pending:
+                self._counters[url_id][1] = 0
+            return pending
+
+    def pending(self):
+        with self._lock:
+            return sum(counter[1] for counter in self._counters.values())
+
+    def forget(self, url_id):
+        # Called when the row changes (e.g. the count was reset in the admin); pending visits are kept
+        with self._lock:
+            counter = self._counters.get(url_id)
+            if counter is not None and not counter[1]:
+                del self._counters[url_id]
+
+
+class SQLiteStore(MemoryStore):
+    """
+    Buckets and counters in a small SQLite file shared by every worker process on
+    the host, so the rate and the visitation cap hold across processes. Each
+    take() is one short IMMEDIATE transaction on that file, not on the main database.
+    """
+
+    def __init__(self, path, timeout=30):
+        super().__init__()
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS counters (url_id TEXT PRIMARY KEY, used INTEGER, pending INTEGER)')
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+        return _Transaction(db)
+
+    def take(self, key, rate, burst, url_id=None, limit=None, used=None):
+        key = '|'.join(str(part) for part in key)
+        with self._connect() as db:
+            if url_id is not None:
+                db.execute('INSERT OR IGNORE INTO counters VALUES (?, ?, 0)', (url_id, used or 0))
+                if limit is not None and db.execute(
+                        'SELECT used FROM counters WHERE url_id = ?', (url_id,)).fetchone()[0] >= limit:
+                    raise VisitationLimitReached(url_id)
+            # Wall clock, not monotonic: the timestamps are compared across processes
+            now = time.time()
+            row = db.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(now - updated, 0) * rate)
+            if tokens < 1:
+                db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens, now))
+                return (1 - tokens) / rate
+            db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)', (key, tokens - 1, now))
+            if url_id is not None:
+                db.execute('UPDATE counters SET used = used + 1, pending = pending + 1 WHERE url_id = ?', (url_id,))
+            return 0
+
+    def known(self, url_id):
+        with self._connect() as db:
+            return db.execute('SELECT 1 FROM counters WHERE url_id = ?', (url_id,)).fetchone() is not None
+
+    def drain(self):
+        with self._connect() as db:
+            pending = dict(db.execute('SELECT url_id, pending FROM counters WHERE pending > 0').fetchall())
+            db.execute('UPDATE counters SET pending = 0 WHERE pending > 0')
+            return pending
+
+    def pending(self):
+        with self._connect() as db:
+            return db.execute('SELECT COALESCE(SUM(pending), 0) FROM counters').fetchone()[0]
+
+    def forget(self, url_id):
+        with self._connect() as db:
+            db.execute('DELETE FROM counters WHERE url_id = ? AND pending = 0', (url_id,))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a block, so read-modify-write is atomic across processes"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, *exc_info):
+        self.db.execute('ROLLBACK' if exc_type and exc_type is not VisitationLimitReached else 'COMMIT')
+
+
+class RateLimiter:
+    """
+    Token bucket per (platform id, url kind), plus PlatformURL.visitation_limit as a
+    hard cap per URL. Visits are counted in memory (or in the shared SQLiteStore)
+    and added to PlatformURL.visitation_count in batches with F() expressions, so
+    counting never costs a save per request.
+    """
+
+    def __init__(self, store=None, default_rate=None, default_burst=None,
+                 flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL):
+        self.store = store or MemoryStore()
+        self.default_rate = default_rate or getattr(settings, 'KATOMART_DEFAULT_RATE', DEFAULT_RATE)
+        self.default_burst = default_burst or getattr(settings, 'KATOMART_DEFAULT_BURST', DEFAULT_BURST)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._rates = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def _limits(self, platform_id):
+        with self._lock:
+            limits = self._rates.get(platform_id)
+        if limits is None:
+            from .models import Platform
+            extra = Platform.objects.filter(pk=platform_id).values_list('extra_data', flat=True).first()  # type: ignore[attr-defined]
+            limits = (extra or {}).get(RATE_LIMITS_KEY) or {}
+            with self._lock:
+                self._rates[platform_id] = limits
+        return limits
+
+    def has_limit(self, platform_id, url_kind):
+        """Whether the platform configures a rate for `url_kind` (or '*') itself"""
+        limits = self._limits(platform_id)
+        return bool(limits.get(url_kind) or limits.get('*'))
+
+    def _rate(self, platform_id, url_kind):
+        limits = self._limits(platform_id)
+        config = limits.get(url_kind) or limits.get('*') or {}
+        return float(config.get('rate') or self.default_rate), float(config.get('burst') or self.default_burst)
+
+    def acquire(self, platform_url=None, platform_id=None, url_kind=None, block=True, timeout=None):
+        """
+        Wait for a token for `platform_url` (a PlatformURL or CompiledURL) or for
+        (`platform_id`, `url_kind`) and count the visit. Returns the seconds
+        waited; returns None if `block` is False (or `timeout` expired) and no
+        token was free. Raises VisitationLimitReached once the URL is capped.
+        """
+        url_id = limit = used = None
+        if platform_url is not None:
+            platform_id, url_kind = platform_url.platform_id, platform_url.url_kind
+            url_id = platform_url.pk
+            if platform_url.has_visitation_limit and platform_url.visitation_limit is not None:
+                limit = platform_url.visitation_limit
+            used = getattr(platform_url, 'visitation_count', 0)
+            if not self.store.known(url_id):
+                # The row may be stale; start from the database's count
+                from .models import PlatformURL
+                used = PlatformURL.objects.filter(pk=url_id).values_list(  # type: ignore[attr-defined]
+                    'visitation_count', flat=True).first() or 0
+        rate, burst = self._rate(platform_id, url_kind or '')
+        started = time.monotonic()
+        while True:
+            wait = self.store.take((platform_id, url_kind or ''), rate, burst, url_id, limit, used)
+            if not wait:
+                break
+            if not block or (timeout is not None and time.monotonic() - started + wait > timeout):
+                return None
+            time.sleep(wait)
+        self._maybe_flush()
+        return time.monotonic() - started
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval or self.store.pending() >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write pending visits to PlatformURL.visitation_count; one UPDATE per distinct increment"""
+        from .models import PlatformURL
+        with self._flush_lock:
+            self._last_flush = time.monotonic()
+            pending = self.store.drain()
+            by_increment = defaultdict(list)
+            for url_id, count in pending.items():
+                by_increment[count].append(url_id)
+            for count, url_ids in by_increment.items():
+                PlatformURL.objects.filter(pk__in=url_ids).update(  # type: ignore[attr-defined]
+                    visitation_count=F('visitation_count') + count)
+            return sum(pending.values())
+
+    def invalidate(self, platform_id=None, url_id=None):
+        """Forget cached rates (platform changed) or a URL's counter (row edited)"""
+        if platform_id is not None:
+            with self._lock:
+                self._rates.pop(platform_id, None)
+        if url_id is not None:
+            self.store.forget(url_id)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    The process-wide RateLimiter. With settings.KATOMART_RATELIMIT_DB (or the
+    $KATOMART_RATELIMIT_DB run_workers sets for several processes) naming a
+    file, buckets and counters are shared by every process on the host.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            path = getattr(settings, 'KATOMART_RATELIMIT_DB', None) or os.environ.get(RATELIMIT_DB_ENV)
+            _limiter = RateLimiter(store=SQLiteStore(path) if path else None)
+        return _limiter
+
+
+def invalidate_rate_limiter(platform_id=None, url_id=None):
+    if _limiter is not None:
+        _limiter.invalidate(platform_id=platform_id, url_id=url_id)
@@ -0,0 +1,216 @@
+import json
+import string
+import threading
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+_EMPTY = MappingProxyType({})
+_formatter = string.Formatter()
+
+
+class URLNotRegistered(LookupError):
+    """No active PlatformURL for that (platform id, url kind)"""
+
+
+def parse_f_string_params(text):
+    """
+    PlatformURL.f_string_params -> ({name: default}, declared names). Accepts a JSON
+    object of defaults, a JSON list of names, or "name, name=default" text.
+    """
+    text = (text or '').strip()
+    if not text:
+        return {}, ()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return {str(k): v for k, v in data.items()}, tuple(data)
+    if isinstance(data, list):
+        return {}, tuple(str(name) for name in data)
+    defaults, names = {}, []
+    for part in text.replace('\n', ',').split(','):
+        name, sep, default = part.partition('=')
+        name = name.strip()
+        if not name:
+            continue
+        names.append(name)
+        if sep:
+            defaults[name] = default.strip()
+    return defaults, tuple(names)
+
+
+def parse_headers(text):
+    """PlatformURL.specific_headers -> dict; a JSON object or "Name: value" lines"""
+    text = (text or '').strip()
+    if not text:
+        return {}
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return {str(k): str(v) for k, v in data.items()}
+    headers = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(':')
+        if sep and name.strip():
+            headers[name.strip()] = value.strip()
+    return headers
+
+
+@dataclass(frozen=True)
+class CompiledURL:
+    """An active PlatformURL with its template and headers parsed once"""
+    id: str
+    platform_id: str
+    url_kind: str
+    template: str
+    parts: tuple = ()  # (literal, field name, format spec, conversion) from string.Formatter.parse
+    fields: frozenset = frozenset()
+    defaults: MappingProxyType = field(default_factory=lambda: _EMPTY)
+    headers: MappingProxyType = field(default_factory=lambda: _EMPTY)
+    accepts_raw_request: bool = False
+    visitation_limit: int | None = None
+
+    @classmethod
+    def from_row(cls, row, base_url=None):
+        template = row.url or ''
+        if base_url and template and '://' not in template:
+            template = urljoin(base_url.rstrip('/') + '/', template.lstrip('/'))
+        defaults, names = parse_f_string_params(row.f_string_params) if row.has_f_string else ({}, ())
+        parts = ()
+        if row.has_f_string:
+            parts = tuple(_formatter.parse(template))
+        fields = frozenset(name for _, name, _, _ in parts if name) | frozenset(names)
+        headers = parse_headers(row.specific_headers) if row.needs_specific_headers else {}
+        return cls(
+            id=row.pk, platform_id=row.platform_id, url_kind=row.url_kind or '', template=template,
+            parts=parts, fields=fields, defaults=MappingProxyType(defaults),
+            headers=MappingProxyType(headers), accepts_raw_request=row.accepts_raw_request,
+            visitation_limit=row.visitation_limit if row.has_visitation_limit else None)
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def has_visitation_limit(self):
+        return self.visitation_limit is not None
+
+    def build(self, **params):
+        """The URL with `params` (over the row's defaults) substituted into the template"""
+        if not self.parts:
+            return self.template
+        values = {**self.defaults, **params} if self.defaults else params
+        out = []
+        for literal, name, spec, conversion in self.parts:
+            out.append(literal)
+            if name is None:
+                continue
+            try:
+                value = values[name]
+            except KeyError:
+                raise KeyError(f'{self.id}: missing URL parameter {name!r}') from None
+            if conversion:
+                value = _formatter.convert_field(value, conversion)
+            out.append(format(value, spec) if spec else str(value))
+        return ''.join(out)
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    urls: MappingProxyType  # (platform id, url kind) -> tuple of CompiledURL
+    by_id: MappingProxyType
+    platforms: frozenset
+    loaded_at: float = field(default_factory=time.monotonic)
+
+
+class PlatformRegistry:
+    """
+    Every active Platform/PlatformURL compiled into immutable objects, indexed by
+    (platform id, url kind). Loaded once and swapped wholesale on reload, so
+    lookups take no lock and never touch the database. Dropped on
+    post_save/post_delete (see core.signals) and after KATOMART_REGISTRY_TTL
+    seconds, which covers edits made by other processes.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'KATOMART_REGISTRY_TTL', 300)
+        self._snapshot = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from .models import PlatformURL
+        rows = PlatformURL.objects.filter(  # type: ignore[attr-defined]
+            is_active=True, platform__active=True).select_related('platform').order_by('platform_id', 'pk')
+        urls, by_id, platforms = {}, {}, set()
+        for row in rows:
+            compiled = CompiledURL.from_row(row, row.platform.base_url)
+            urls.setdefault((compiled.platform_id, compiled.url_kind), []).append(compiled)
+            by_id[compiled.id] = compiled
+            platforms.add(compiled.platform_id)
+        return _Snapshot(MappingProxyType({key: tuple(value) for key, value in urls.items()}),
+                         MappingProxyType(by_id), frozenset(platforms))
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or time.monotonic() - snapshot.loaded_at >= self.ttl:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or time.monotonic() - snapshot.loaded_at >= self.ttl:
+                    generation = self._generation
+                    snapshot = self._load()
+                    # An invalidate() during the load means the rows may have changed under it
+                    if generation == self._generation:
+                        self._snapshot = snapshot
+        return snapshot
+
+    def invalidate(self):
+        self._generation += 1
+        self._snapshot = None
+
+    def get(self, platform_id, url_kind):
+        """The first active URL of that kind; raises URLNotRegistered"""
+        found = self.snapshot().urls.get((platform_id, url_kind or ''))
+        if not found:
+            raise URLNotRegistered(f'{platform_id}/{url_kind}')
+        return found[0]
+
+    def get_all(self, platform_id, url_kind):
+        return self.snapshot().urls.get((platform_id, url_kind or ''), ())
+
+    def by_id(self, url_id):
+        try:
+            return self.snapshot().by_id[url_id]
+        except KeyError:
+            raise URLNotRegistered(url_id) from None
+
+    def url(self, platform_id, url_kind, **params):
+        return self.get(platform_id, url_kind).build(**params)
+
+    def headers(self, platform_id, url_kind):
+        return self.get(platform_id, url_kind).headers
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_platform_registry():
+    """The process-wide PlatformRegistry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = PlatformRegistry()
+        return _registry
+
+
+def invalidate_platform_registry():
+    if _registry is not None:
+        _registry.invalidate()
@@ -0,0 +1,196 @@
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from .models import ContentRollupMixin, Course, File, Lesson, Module
+
+ROLLUP_FIELDS = ContentRollupMixin.ROLLUP_FIELDS
+# File fields (as given to update()/bulk_update()) that change what a file contributes
+FILE_FIELDS = {'lesson', 'lesson_id', 'is_downloaded', 'file_size', 'has_drm', 'duration'}
+CHUNK_SIZE = 500
+
+_FILE_AGGREGATES = {
+    'file_count': Count('pk'),
+    'downloaded_count': Count('pk', filter=Q(is_downloaded=True)),
+    'total_bytes': Sum('file_size'),
+    'downloaded_bytes': Sum('file_size', filter=Q(is_downloaded=True)),
+    'drm_count': Count('pk', filter=Q(has_drm=True)),
+    'total_duration': Sum('duration'),
+}
+
+_pending = threading.local()
+
+
+def touches_rollups(fields):
+    return not FILE_FIELDS.isdisjoint(fields) and not in_bulk_update()
+
+
+@contextmanager
+def bulk_update_scope():
+    """The update() Django's bulk_update() runs underneath leaves the rollups to bulk_update()"""
+    _pending.bulk_depth = getattr(_pending, 'bulk_depth', 0) + 1
+    try:
+        yield
+    finally:
+        _pending.bulk_depth -= 1
+
+
+def in_bulk_update():
+    return getattr(_pending, 'bulk_depth', 0) > 0
+
+
+def on_commit_once(func):
+    """transaction.on_commit(func), unless func is already waiting for the current transaction to commit"""
+    connection = transaction.get_connection()
+    # Rolling back (to a savepoint) drops the registration from run_on_commit, so the next call registers again
+    if connection.in_atomic_block and any(registered is func for _, registered, _ in connection.run_on_commit):
+        return
+    transaction.on_commit(func)
+
+
+def contribution(values):
+    """What one file (a dict of File.ROLLUP_TRACKED_FIELDS) adds to its module and course"""
+    size = values.get('file_size') or 0
+    downloaded = bool(values.get('is_downloaded'))
+    return Counter({
+        'file_count': 1, 'downloaded_count': int(downloaded), 'total_bytes': size,
+        'downloaded_bytes': size if downloaded else 0, 'drm_count': int(bool(values.get('has_drm'))),
+        'total_duration': values.get('duration') or 0,
+    })
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def _increment(model, pk, delta):
+    model.objects.filter(pk=pk).update(**{name: F(name) + value for name, value in delta.items()})  # type: ignore[attr-defined]
+
+
+def apply_deltas(lesson_deltas):
+    """Add {lesson id: Counter} to the rollups of the lessons' modules and courses, one UPDATE per row"""
+    lesson_deltas = {lesson_id: delta for lesson_id, delta in lesson_deltas.items()
+                     if lesson_id is not None and any(delta.values())}
+    if not lesson_deltas:
+        return
+    module_deltas, course_deltas = defaultdict(Counter), defaultdict(Counter)
+    for lesson_id, module_id, course_id in Lesson.objects.filter(  # type: ignore[attr-defined]
+            pk__in=list(lesson_deltas)).values_list('internal_id', 'module_id', 'module__course_id'):
+        if module_id is not None:
+            module_deltas[module_id].update(lesson_deltas[lesson_id])
+        if course_id is not None:
+            course_deltas[course_id].update(lesson_deltas[lesson_id])
+    for model, deltas in ((Module, module_deltas), (Course, course_deltas)):
+        for pk, delta in deltas.items():
+            delta = {name: value for name, value in delta.items() if value}
+            if delta:
+                _increment(model, pk, delta)
+
+
+def file_saved(instance, created, update_fields=None):
+    """post_save for File: send the difference to what the row was loaded with"""
+    current = {name: getattr(instance, name) for name in File.ROLLUP_TRACKED_FIELDS}
+    loaded = getattr(instance, '_rollup_loaded', None)
+    if created:
+        apply_deltas({instance.lesson_id: contribution(current)})
+    elif loaded is None or len(loaded) < len(File.ROLLUP_TRACKED_FIELDS):
+        # Built by hand or loaded with only(): no baseline to diff against
+        schedule_refresh(lesson_ids=[instance.lesson_id])
+    else:
+        if update_fields is not None:
+            written = {name for name in File.ROLLUP_TRACKED_FIELDS if name.removesuffix('_id') in update_fields
+                       or name in update_fields}
+            current = {name: current[name] if name in written else loaded[name] for name in current}
+        if current == loaded:
+            return
+        deltas = defaultdict(Counter)
+        deltas[loaded['lesson_id']].subtract(contribution(loaded))
+        deltas[current['lesson_id']].update(contribution(current))
+        apply_deltas(deltas)
+    instance._rollup_loaded = current
+
+
+def parent_moved(instance, field):
+    """post_save for Lesson/Module: moving one to another parent moves its totals along. Returns whether it moved"""
+    loaded = getattr(instance, '_rollup_loaded', None) or {}
+    old, new = loaded.get(field), getattr(instance, field)
+    moved = field in loaded and old != new
+    if moved:
+        ids = {'module_ids' if field == 'module_id' else 'course_ids': [old, new]}
+        schedule_refresh(**ids)
+    instance._rollup_loaded = {field: new}
+    return moved
+
+
+def schedule_refresh(lesson_ids=(), module_ids=(), course_ids=()):
+    """
+    Recompute the rollups of these rows once the current transaction commits
+    (right away outside one). Ids pile up until then, so a cascade deleting
+    thousands of files costs one recompute per module, not one per file.
+    """
+    pending = getattr(_pending, 'ids', None)
+    if pending is None:
+        pending = _pending.ids = {'lessons': set(), 'modules': set(), 'courses': set()}
+    pending['lessons'].update(lesson_ids)
+    pending['modules'].update(module_ids)
+    pending['courses'].update(course_ids)
+    # Ids left behind by a rolled back transaction are refreshed with the next batch, which is harmless
+    on_commit_once(flush_pending)
+
+
+def flush_pending():
+    pending, _pending.ids = getattr(_pending, 'ids', None), None
+    if not pending:
+        return
+    lesson_ids = pending['lessons'] - {None}
+    module_ids = pending['modules'] - {None}
+    for chunk in _chunks(lesson_ids):
+        module_ids.update(Lesson.objects.filter(pk__in=chunk).values_list('module_id', flat=True))  # type: ignore[attr-defined]
+    refresh_modules(module_ids - {None}, course_ids=pending['courses'])
+
+
+def _totals(row):
+    return {name: row.get(name) or 0 for name in ROLLUP_FIELDS}
+
+
+def refresh_modules(module_ids, course_ids=()):
+    """Recompute the rollups of these modules from their files, then of their (and `course_ids`') courses"""
+    course_ids = set(course_ids) - {None}
+    for chunk in _chunks(module_ids):
+        totals = {row['lesson__module_id']: _totals(row) for row in File.objects.filter(  # type: ignore[attr-defined]
+            lesson__module_id__in=chunk).order_by().values('lesson__module_id').annotate(**_FILE_AGGREGATES)}
+        modules = []
+        for module_id, course_id in Module.objects.filter(pk__in=chunk).values_list('internal_id', 'course_id'):  # type: ignore[attr-defined]
+            modules.append(Module(pk=module_id, **totals.get(module_id, _totals({}))))
+            course_ids.add(course_id)
+        Module.objects.bulk_update(modules, ROLLUP_FIELDS)  # type: ignore[attr-defined]
+    refresh_courses(course_ids - {None})
+
+
+def refresh_courses(course_ids):
+    """Recompute the rollups of these courses from their modules' rollups"""
+    aggregates = {f'sum_{name}': Sum(name) for name in ROLLUP_FIELDS}
+    for chunk in _chunks(course_ids):
+        totals = {}
+        for row in Module.objects.filter(course_id__in=chunk).order_by().values('course_id').annotate(**aggregates):  # type: ignore[attr-defined]
+            totals[row['course_id']] = {name: row[f'sum_{name}'] or 0 for name in ROLLUP_FIELDS}
+        courses = [Course(pk=course_id, **totals.get(course_id, _totals({})))
+                   for course_id in Course.objects.filter(pk__in=chunk).values_list('pk', flat=True)]  # type: ignore[attr-defined]
+        Course.objects.bulk_update(courses, ROLLUP_FIELDS)  # type: ignore[attr-defined]
+
+
+def refresh_course_tree(course_ids=None):
+    """Recompute every module and course (or those of `course_ids`) from scratch; returns (modules, courses)"""
+    modules = Module.objects.all()  # type: ignore[attr-defined]
+    courses = Course.objects.all()  # type: ignore[attr-defined]
+    if course_ids is not None:
+        modules, courses = modules.filter(course_id__in=course_ids), courses.filter(pk__in=course_ids)
+    module_ids = list(modules.values_list('pk', flat=True))
+    course_ids = list(courses.values_list('pk', flat=True))
+    refresh_modules(module_ids, course_ids=course_ids)
+    return len(module_ids), len(course_ids)
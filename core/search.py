@@ -0,0 +1,263 @@
+import html
+import re
+import threading
+import time
+
+from django.apps import apps
+from django.db import connection, transaction
+from django.db.models import Q
+
+from .models import Course, File, Lesson, Module, SearchDocument
+from .rollups import on_commit_once
+
+FTS_TABLE = 'core_search_fts'
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+CHUNK_SIZE = 500
+SNIPPET_TOKENS = 16
+# Highlight markers that can't occur in catalog text; escaped output gets <mark> in their place
+_MARK_START, _MARK_END = '\ue000', '\ue001'
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Fields whose change means re-indexing the object (for save(update_fields=...))
+INDEXED_FIELDS = {
+    'course': {'name', 'description', 'teacher'},
+    'module': {'name', 'description', 'course', 'course_id'},
+    'lesson': {'name', 'description', 'module', 'module_id'},
+    'file': {'name', 'description', 'lesson', 'lesson_id'},
+    'note': {'text', 'file', 'file_id', 'user', 'user_id'},
+}
+
+_pending = threading.local()
+_fts_available = None
+
+
+def _join(*parts):
+    return '\n'.join(part for part in parts if part)
+
+
+def _note_model():
+    return apps.get_model('cognitahz', 'VideoNote')
+
+
+def _documents(kind, ids):
+    """SearchDocuments (unsaved) for these objects of `kind`, one query each"""
+    if kind == 'course':
+        rows = Course.objects.filter(pk__in=ids).values_list('pk', 'name', 'teacher', 'description')  # type: ignore[attr-defined]
+        return [SearchDocument(kind=kind, object_id=pk, course_id=pk, title=name or '', body=_join(teacher, description))
+                for pk, name, teacher, description in rows]
+    if kind == 'note':
+        rows = _note_model().objects.filter(pk__in=ids).values_list(
+            'pk', 'file__lesson__module__course_id', 'user_id', 'file__name', 'text')
+        return [SearchDocument(kind=kind, object_id=pk, course_id=course_id, user_id=user_id, title=file_name or '',
+                               body=text or '')
+                for pk, course_id, user_id, file_name, text in rows]
+    model, course_path = {
+        'module': (Module, 'course_id'),
+        'lesson': (Lesson, 'module__course_id'),
+        'file': (File, 'lesson__module__course_id'),
+    }[kind]
+    rows = model.objects.filter(pk__in=ids).values_list('pk', course_path, 'name', 'description')  # type: ignore[attr-defined]
+    return [SearchDocument(kind=kind, object_id=pk, course_id=course_id, title=name or '', body=description or '')
+            for pk, course_id, name, description in rows]
+
+
+def index_objects(kind, ids):
+    """Upsert the documents of these objects and drop those of objects that no longer exist"""
+    ids = sorted(set(ids) - {None})
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        documents = _documents(kind, chunk)
+        SearchDocument.objects.bulk_create(  # type: ignore[attr-defined]
+            documents, update_conflicts=True, unique_fields=['kind', 'object_id'],
+            update_fields=['course', 'user', 'title', 'body', 'updated_at'])
+        gone = set(chunk) - {document.object_id for document in documents}
+        if gone:
+            SearchDocument.objects.filter(kind=kind, object_id__in=gone).delete()  # type: ignore[attr-defined]
+
+
+def index_course(course_id):
+    """(Re)index a course and everything below it, e.g. after a catalog sync"""
+    index_objects('course', [course_id])
+    index_objects('module', Module.objects.filter(course_id=course_id).values_list('pk', flat=True))  # type: ignore[attr-defined]
+    index_objects('lesson', Lesson.objects.filter(  # type: ignore[attr-defined]
+        module__course_id=course_id).values_list('pk', flat=True))
+    index_objects('file', File.objects.filter(  # type: ignore[attr-defined]
+        lesson__module__course_id=course_id).values_list('pk', flat=True))
+    index_objects('note', _note_model().objects.filter(
+        file__lesson__module__course_id=course_id).values_list('pk', flat=True))
+
+
+def schedule_index(kind=None, ids=(), course_ids=()):
+    """
+    Index these objects (or whole courses) once the current transaction
+    commits, right away outside one. Saves and deletes pile up until then,
+    so a bulk change costs one query per kind instead of one per row.
+    """
+    pending = getattr(_pending, 'ids', None)
+    if pending is None:
+        pending = _pending.ids = {'courses': set(), **{name: set() for name in SearchDocument.KINDS}}
+    if kind is not None:
+        pending[kind].update(ids)
+    pending['courses'].update(course_ids)
+    on_commit_once(flush_pending)
+
+
+def flush_pending():
+    pending, _pending.ids = getattr(_pending, 'ids', None), None
+    if not pending:
+        return
+    for course_id in pending.pop('courses') - {None}:
+        index_course(course_id)
+    if pending['file']:
+        # Notes show their file's name and course
+        pending['note'].update(_note_model().objects.filter(file_id__in=pending['file']).values_list('pk', flat=True))
+    for kind, ids in pending.items():
+        if ids:
+            index_objects(kind, ids)
+
+
+def touches_index(kind, fields):
+    return not INDEXED_FIELDS[kind].isdisjoint(fields)
+
+
+def objects_updated(kind, ids, fields):
+    """QuerySet.update(): re-index the changed rows, and whole courses when modules or lessons moved into them"""
+    schedule_index(kind, ids)
+    parent = {'module': 'course', 'lesson': 'module'}.get(kind)
+    if parent is None or (parent not in fields and f'{parent}_id' not in fields):
+        return
+    model, course_path = (Module, 'course_id') if kind == 'module' else (Lesson, 'module__course_id')
+    for start in range(0, len(ids), CHUNK_SIZE):
+        schedule_index(course_ids=model.objects.filter(  # type: ignore[attr-defined]
+            pk__in=ids[start:start + CHUNK_SIZE]).values_list(course_path, flat=True))
+
+
+def object_saved(kind, instance, update_fields=None, moved=False):
+    """post_save: re-index the object, and its descendants when it moved to another course"""
+    if update_fields is not None and INDEXED_FIELDS[kind].isdisjoint(update_fields):
+        return
+    schedule_index(kind, [instance.pk])
+    if moved:
+        course_id = instance.course_id if kind == 'module' else instance.module.course_id
+        schedule_index(course_ids=[course_id])
+
+
+def object_deleted(kind, instance):
+    schedule_index(kind, [instance.pk])
+
+
+def rebuild_index():
+    """Index the whole catalog and all notes from scratch; returns the number of documents"""
+    with transaction.atomic():
+        SearchDocument.objects.all().delete()  # type: ignore[attr-defined]
+        for kind, model in (('course', Course), ('module', Module), ('lesson', Lesson), ('file', File),
+                            ('note', _note_model())):
+            index_objects(kind, model.objects.values_list('pk', flat=True))
+        if fts_available():
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+    return SearchDocument.objects.count()  # type: ignore[attr-defined]
+
+
+def fts_available():
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def _terms(query):
+    return _TOKEN_RE.findall(query)[:16]
+
+
+def _search_sqlite(terms, user_id, limit):
+    # Every term is a quoted prefix match, so partial words typed so far already hit.
+    # ORDER BY rank with a LIMIT lets FTS5 sort internally and build snippets only for the rows returned
+    match = ' '.join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+    sql = f"""
+        SELECT d.id, d.kind, d.object_id, d.course_id, d.title, hits.snippet, hits.rank
+        FROM (
+            SELECT rowid, rank, snippet({FTS_TABLE}, -1, %s, %s, '…', {SNIPPET_TOKENS}) AS snippet
+            FROM {FTS_TABLE}
+            WHERE {FTS_TABLE} MATCH %s AND (user_id IS NULL OR user_id = %s)
+            ORDER BY rank LIMIT %s
+        ) hits JOIN core_searchdocument d ON d.id = hits.rowid
+        ORDER BY hits.rank
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [_MARK_START, _MARK_END, match, user_id, limit])
+        # bm25() is lower for better matches; flip it so higher scores rank first everywhere
+        return [(*row[:6], -row[6]) for row in cursor.fetchall()]
+
+
+def _search_postgres(terms, user_id, limit):
+    tsquery = ' & '.join(f"{term}:*" for term in terms)
+    options = f'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords={SNIPPET_TOKENS}, MinWords=4, ShortWord=2'
+    sql = """
+        SELECT d.id, d.kind, d.object_id, d.course_id, d.title,
+               ts_headline('simple', d.title || E'\\n' || d.body, q, %s), hits.score
+        FROM (
+            SELECT id, ts_rank(search_vector, q) AS score
+            FROM core_searchdocument, to_tsquery('simple', %s) q
+            WHERE search_vector @@ q AND (user_id IS NULL OR user_id = %s)
+            ORDER BY score DESC LIMIT %s
+        ) hits JOIN core_searchdocument d ON d.id = hits.id, to_tsquery('simple', %s) q
+        ORDER BY hits.score DESC
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [options, tsquery, user_id, limit, tsquery])
+        return cursor.fetchall()
+
+
+def _search_fallback(terms, user_id, limit):
+    documents = SearchDocument.objects.filter(Q(user=None) | Q(user_id=user_id))  # type: ignore[attr-defined]
+    for term in terms:
+        documents = documents.filter(Q(title__icontains=term) | Q(body__icontains=term))
+    rows = []
+    for document in documents.order_by('kind', 'object_id')[:limit]:
+        text = _join(document.title, document.body)
+        position = max(text.lower().find(terms[0].lower()), 0)
+        rows.append((document.pk, document.kind, document.object_id, document.course_id, document.title,
+                     text[max(position - 40, 0):position + 160], 0.0))
+    return rows
+
+
+def _highlight(snippet):
+    return html.escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def search(query, user=None, limit=DEFAULT_LIMIT):
+    """
+    Ranked full-text search over the catalog and the user's video notes.
+    Returns {'query', 'took_ms', 'results': [{'course', 'score', 'hits'}]}:
+    hits grouped by course, courses in the order of their best hit, snippets
+    HTML-escaped with the matches in <mark>.
+    """
+    started = time.perf_counter()
+    terms = _terms(query or '')
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    user_id = getattr(user, 'pk', None)
+    if not terms:
+        rows = []
+    elif fts_available():
+        rows = _search_sqlite(terms, user_id, limit)
+    elif connection.vendor == 'postgresql':
+        rows = _search_postgres(terms, user_id, limit)
+    else:
+        rows = _search_fallback(terms, user_id, limit)
+
+    groups = {}
+    course_names = dict(Course.objects.filter(  # type: ignore[attr-defined]
+        pk__in={row[3] for row in rows if row[3] is not None}).values_list('pk', 'name'))
+    for _, kind, object_id, course_id, title, snippet, score in rows:
+        group = groups.get(course_id)
+        if group is None:
+            group = groups[course_id] = {
+                'course': {'id': course_id, 'name': course_names.get(course_id)} if course_id is not None else None,
+                'score': round(score, 4), 'hits': [],
+            }
+        group['hits'].append({'kind': kind, 'id': object_id, 'title': title, 'snippet': _highlight(snippet),
+                              'score': round(score, 4)})
+    return {'query': query, 'took_ms': round((time.perf_counter() - started) * 1000, 2),
+            'results': list(groups.values())}
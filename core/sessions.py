@@ -0,0 +1,349 @@
+import http.client
+import json
+import os
+import ssl
+import threading
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.utils import timezone
+
+from .crypto import encrypt_many
+
+try:  # Optional: HTTP/2 needs httpx with the h2 extra
+    import httpx
+except ImportError:
+    httpx = None
+
+USER_AGENT = 'katomart/1.0'
+DEFAULT_REFRESH_MARGIN = 300  # seconds before expires_at a token is refreshed
+DEFAULT_IDLE_TIMEOUT = 300  # seconds an unused session is kept
+REFRESH_RETRY_SECONDS = 30
+MAX_IDLE_CONNECTIONS = 4  # per host, stdlib transport
+
+# platform id -> callable(session, credentials) returning a dict with any of token,
+# refresh_token, session_cookie, token_type and expires_at (datetime) or expires_in (seconds)
+_refreshers = {}
+
+
+def register_token_refresher(platform_id, func=None):
+    """Register how tokens of a platform are refreshed; usable as a decorator"""
+    if func is None:
+        return lambda func: register_token_refresher(platform_id, func)
+    _refreshers[platform_id] = func
+    return func
+
+
+class SessionError(Exception):
+    pass
+
+
+@dataclass
+class SessionResponse:
+    status: int
+    headers: dict
+    content: bytes
+    url: str
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class _ConnectionPool:
+    """Keep-alive http.client connections per (scheme, host), stdlib only (HTTP/1.1)"""
+    http2 = False
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._ssl = ssl.create_default_context()
+
+    def _connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self._ssl)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def request(self, method, url, headers, body):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target += f'?{parts.query}'
+        for attempt in range(2):
+            with self._lock:
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+            reused = conn is not None
+            conn = conn or self._connect(*key)
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                response = conn.getresponse()
+                content = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused and attempt == 0:
+                    # The server dropped the idle keep-alive connection; try once on a fresh one
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    idle = self._idle.setdefault(key, [])
+                    if len(idle) < MAX_IDLE_CONNECTIONS:
+                        idle.append(conn)
+                        conn = None
+                if conn is not None:
+                    conn.close()
+            return response.status, dict(response.headers.items()), content
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+class _HttpxPool:
+    """httpx client with HTTP/2, used when httpx and h2 are installed"""
+    http2 = True
+
+    def __init__(self, timeout):
+        self.client = httpx.Client(http2=True, timeout=timeout)
+
+    def request(self, method, url, headers, body):
+        response = self.client.request(method, url, headers=headers, content=body)
+        return response.status_code, dict(response.headers.items()), response.content
+
+    def close(self):
+        self.client.close()
+
+
+def _make_transport(timeout, http2=True):
+    if http2 and httpx is not None:
+        try:
+            return _HttpxPool(timeout)
+        except ImportError:
+            # httpx without the h2 package
+            pass
+    return _ConnectionPool(timeout)
+
+
+class PlatformSession:
+    """
+    One keep-alive HTTP client for one PlatformAuth, with its credentials
+    decrypted once. Tokens are refreshed in the background `refresh_margin`
+    seconds before expires_at, so requests in flight keep using the current
+    token; only a request made after the token expired waits for the refresh.
+    New tokens are written back encrypted with a plain UPDATE.
+    """
+
+    def __init__(self, auth, credentials, passphrase, timeout=30, refresh_margin=None, http2=True):
+        self.auth_id = auth.pk
+        self.platform_id = auth.platform_id
+        self.token_type = auth.token_type
+        self.expires_at = auth.expires_at
+        self.credentials = dict(credentials)
+        self.transport = _make_transport(timeout, http2)
+        self.refresh_margin = refresh_margin if refresh_margin is not None else getattr(
+            settings, 'KATOMART_TOKEN_REFRESH_MARGIN', DEFAULT_REFRESH_MARGIN)
+        self.last_used = time.monotonic()
+        self._passphrase = passphrase
+        self._refresh_lock = threading.Lock()
+        self._refreshing = None  # thread running a refresh
+        self._refresh_error = None
+        self._retry_refresh_at = 0.0  # background refreshes back off after a failure
+
+    @property
+    def http2(self):
+        return self.transport.http2
+
+    def auth_headers(self):
+        """Authorization/Cookie headers for the current credentials, as they are"""
+        headers = {}
+        token = self.credentials.get('token')
+        if token:
+            headers['Authorization'] = f'{self.token_type or "Bearer"} {token}'
+        if self.credentials.get('session_cookie'):
+            headers['Cookie'] = self.credentials['session_cookie']
+        return headers
+
+    def fresh_auth_headers(self):
+        """auth_headers() after refreshing a token that is expired or about to be; for downloads"""
+        self.last_used = time.monotonic()
+        self._ensure_fresh()
+        return self.auth_headers()
+
+    def reauthenticate(self):
+        """Refresh after the server rejected the token (401); False when the platform has no refresher"""
+        if self.platform_id not in _refreshers:
+            return False
+        self.refresh(wait=True)
+        return True
+
+    def request(self, method, url, headers=None, body=None, authenticate=True):
+        """Send a request over the pooled connection; returns a SessionResponse"""
+        self.last_used = time.monotonic()
+        if authenticate:
+            self._ensure_fresh()
+        all_headers = {'User-Agent': USER_AGENT, **(self.auth_headers() if authenticate else {}), **(headers or {})}
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            all_headers.setdefault('Content-Type', 'application/json')
+        status, response_headers, content = self.transport.request(method, url, all_headers, body)
+        if status == 401 and authenticate and self.reauthenticate():
+            # Rejected early (revoked, clock skew): refresh once and retry
+            all_headers.update(self.auth_headers())
+            status, response_headers, content = self.transport.request(method, url, all_headers, body)
+        return SessionResponse(status, response_headers, content, url)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    # -- token refresh
+
+    def _ensure_fresh(self):
+        if self.expires_at is None or self.platform_id not in _refreshers:
+            return
+        left = (self.expires_at - timezone.now()).total_seconds()
+        if left <= 0:
+            self.refresh(wait=True)
+        elif left <= self.refresh_margin and time.monotonic() >= self._retry_refresh_at:
+            self.refresh(wait=False)
+
+    def refresh(self, wait=True):
+        """Refresh the token once for all callers; `wait` blocks until it is done"""
+        with self._refresh_lock:
+            thread = self._refreshing
+            if thread is None:
+                thread = self._refreshing = threading.Thread(
+                    target=self._refresh, name=f'katomart-refresh-{self.auth_id}', daemon=True)
+                thread.start()
+        if wait:
+            thread.join()
+            if self._refresh_error is not None:
+                raise SessionError(f'Token refresh failed for PlatformAuth {self.auth_id}: {self._refresh_error}')
+
+    def _refresh(self):
+        from django.db import connection
+        try:
+            self._refresh_error = None
+            update = _refreshers[self.platform_id](self, dict(self.credentials)) or {}
+            self._apply(update)
+        except Exception as exc:  # noqa: BLE001 - surfaced to waiting callers
+            self._refresh_error = exc
+            self._retry_refresh_at = time.monotonic() + REFRESH_RETRY_SECONDS
+        finally:
+            connection.close()
+            with self._refresh_lock:
+                self._refreshing = None
+
+    def _apply(self, update):
+        from .models import PlatformAuth
+        expires_at = update.get('expires_at')
+        if expires_at is None and update.get('expires_in') is not None:
+            expires_at = timezone.now() + timedelta(seconds=float(update['expires_in']))
+        secrets = [name for name in ('token', 'refresh_token', 'session_cookie') if update.get(name)]
+        # Swap the credentials in one assignment; requests read them without a lock
+        self.credentials = {**self.credentials, **{name: update[name] for name in secrets}}
+        if update.get('token_type'):
+            self.token_type = update['token_type']
+        self.expires_at = expires_at
+        values = {'expires_at': expires_at}
+        if update.get('token_type'):
+            values['token_type'] = update['token_type']
+        encrypted = encrypt_many([update[name] for name in secrets], self._passphrase)
+        values.update({f'{name}_encrypted': value for name, value in zip(secrets, encrypted)})
+        # update() rather than save(): nothing else on the row is touched and no signals fire
+        PlatformAuth.objects.filter(pk=self.auth_id).update(updated_at=timezone.now(), **values)  # type: ignore[attr-defined]
+
+    def close(self):
+        self.transport.close()
+
+
+class SessionPool:
+    """
+    PlatformSessions keyed by PlatformAuth pk, created on first use and closed
+    after `idle_timeout` seconds without requests. Credentials are decrypted
+    with `passphrase` (default: $KATOMART_PASSPHRASE) once per session.
+    """
+
+    def __init__(self, passphrase=None, idle_timeout=DEFAULT_IDLE_TIMEOUT, **session_options):
+        self.passphrase = passphrase or os.environ.get('KATOMART_PASSPHRASE')
+        self.idle_timeout = idle_timeout
+        self.session_options = session_options
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, auth):
+        """The session of `auth` (a PlatformAuth or its pk)"""
+        from .models import PlatformAuth
+        auth_id = getattr(auth, 'pk', auth)
+        self._evict_idle()
+        with self._lock:
+            session = self._sessions.get(auth_id)
+        if session is not None:
+            return session
+        if not self.passphrase:
+            raise SessionError('A passphrase is required to decrypt credentials (KATOMART_PASSPHRASE)')
+        if not isinstance(auth, PlatformAuth):
+            auth = PlatformAuth.objects.get(pk=auth_id)  # type: ignore[attr-defined]
+        # Decrypting (a key derivation) happens outside the lock; a lost race just discards one session
+        credentials = auth.get_credentials(self.passphrase)
+        created = PlatformSession(auth, credentials, self.passphrase, **self.session_options)
+        with self._lock:
+            session = self._sessions.setdefault(auth_id, created)
+        if session is not created:
+            created.close()
+        return session
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [auth_id for auth_id, session in self._sessions.items()
+                    if now - session.last_used >= self.idle_timeout and session._refreshing is None]
+            stale = [self._sessions.pop(auth_id) for auth_id in idle]
+        for session in stale:
+            session.close()
+
+    def evict(self, auth_id):
+        """Drop a session, e.g. because its credentials were edited"""
+        with self._lock:
+            session = self._sessions.pop(auth_id, None)
+        if session is not None:
+            session.close()
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """The process-wide SessionPool"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool()
+        return _pool
+
+
+def evict_session(auth_id):
+    if _pool is not None:
+        _pool.evict(auth_id)
@@ -0,0 +1,73 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Course, File, Lesson, Module, Platform, PlatformAuth, PlatformURL, SystemConfig
+from .ratelimit import invalidate_rate_limiter
+from .rollups import file_saved, parent_moved, schedule_refresh
+from .search import object_deleted, object_saved
+from .registry import invalidate_platform_registry
+from .sessions import evict_session
+
+
+@receiver([post_save, post_delete], sender=SystemConfig)
+def invalidate_system_config_cache(sender, **kwargs):
+    SystemConfig.invalidate_solo_cache()
+
+
+@receiver([post_save, post_delete], sender=Platform)
+def invalidate_platform_caches(sender, instance, **kwargs):
+    invalidate_rate_limiter(platform_id=instance.pk)
+    invalidate_platform_registry()
+
+
+@receiver([post_save, post_delete], sender=PlatformURL)
+def invalidate_platform_url_caches(sender, instance, **kwargs):
+    invalidate_rate_limiter(url_id=instance.pk)
+    invalidate_platform_registry()
+
+
+@receiver([post_save, post_delete], sender=PlatformAuth)
+def evict_platform_session(sender, instance, **kwargs):
+    # Token refreshes write with update() and don't get here; edited credentials do
+    evict_session(instance.pk)
+
+
+@receiver(post_save, sender=Course)
+def update_search_on_course_save(sender, instance, update_fields=None, **kwargs):
+    object_saved('course', instance, update_fields)
+
+
+@receiver(post_save, sender=File)
+def update_rollups_on_file_save(sender, instance, created, update_fields=None, **kwargs):
+    file_saved(instance, created, update_fields)
+    object_saved('file', instance, update_fields)
+
+
+@receiver(post_delete, sender=File)
+def update_rollups_on_file_delete(sender, instance, **kwargs):
+    schedule_refresh(lesson_ids=[instance.lesson_id])
+    object_deleted('file', instance)
+
+
+@receiver(post_save, sender=Lesson)
+def update_rollups_on_lesson_save(sender, instance, update_fields=None, **kwargs):
+    moved = parent_moved(instance, 'module_id')
+    object_saved('lesson', instance, update_fields, moved=moved)
+
+
+@receiver(post_delete, sender=Lesson)
+def update_rollups_on_lesson_delete(sender, instance, **kwargs):
+    schedule_refresh(module_ids=[instance.module_id])
+    object_deleted('lesson', instance)
+
+
+@receiver(post_save, sender=Module)
+def update_rollups_on_module_save(sender, instance, update_fields=None, **kwargs):
+    moved = parent_moved(instance, 'course_id')
+    object_saved('module', instance, update_fields, moved=moved)
+
+
+@receiver(post_delete, sender=Module)
+def update_rollups_on_module_delete(sender, instance, **kwargs):
+    schedule_refresh(course_ids=[instance.course_id])
+    object_deleted('module', instance)
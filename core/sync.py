@@ -0,0 +1,148 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Module, Lesson, File
+from .rollups import schedule_refresh
+from .search import schedule_index
+
+# Fields owned by katomart itself; a scraped catalog never overwrites them
+_LOCAL_FIELDS = {
+    'internal_id', 'katomart_id', 'external_id', 'created_at', 'updated_at',
+    'formatted_name', 'should_download', 'is_downloaded', 'download_date', 'download_type', 'is_decrypted',
+}
+
+# (model, parent FK attname, children key in the scraped tree)
+SYNC_LEVELS = (
+    (Module, 'course_id', 'lessons'),
+    (Lesson, 'module_id', 'files'),
+    (File, 'lesson_id', None),
+)
+
+BULK_BATCH_SIZE = 500
+
+
+def _syncable_fields(model):
+    return {
+        field.name: field for field in model._meta.concrete_fields
+        if not field.is_relation and field.name not in _LOCAL_FIELDS
+    }
+
+
+def _clean_node(model, fields, node, position, children_key):
+    if not isinstance(node, dict):
+        raise ValueError(f'{model.__name__} entries must be objects, got {type(node).__name__}')
+    external_id = node.get('external_id')
+    if external_id in (None, ''):
+        raise ValueError(f'{model.__name__} entry at position {position} has no external_id')
+    values = {}
+    for key, value in node.items():
+        if key in ('external_id', children_key):
+            continue
+        field = fields.get(key)
+        if field is None:
+            raise ValueError(f'Unknown or read-only {model.__name__} field: {key}')
+        try:
+            values[key] = field.to_python(value)
+        except DjangoValidationError as exc:
+            raise ValueError(f'{model.__name__} {external_id}: invalid {key}: {"; ".join(exc.messages)}')
+    # Listed content is active unless the platform says otherwise; keep the listing order
+    values.setdefault('is_active', True)
+    if 'order' in fields:
+        values.setdefault('order', position)
+    return str(external_id), values
+
+
+def _sync_level(model, parent_attname, children_key, existing, incoming, now):
+    """
+    Upsert one level of the tree.
+    `incoming` is a list of (parent_id, node) pairs, `existing` maps external_id to the
+    current rows of the course. Returns the per-level counts and external_id -> row.
+    """
+    fields = _syncable_fields(model)
+    to_create, to_update, seen = [], [], {}
+    changed_fields = set()
+    for position, (parent_id, node) in enumerate(incoming):
+        external_id, values = _clean_node(model, fields, node, position, children_key)
+        if external_id in seen:
+            raise ValueError(f'Duplicate {model.__name__} external_id: {external_id}')
+        values[parent_attname] = parent_id
+        obj = existing.get(external_id)
+        if obj is None:
+            obj = model(external_id=external_id, **values)
+            to_create.append(obj)
+        else:
+            dirty = [name for name, value in values.items() if getattr(obj, name) != value]
+            if dirty:
+                for name in dirty:
+                    setattr(obj, name, values[name])
+                changed_fields.update(dirty)
+                to_update.append(obj)
+        seen[external_id] = (obj, node)
+
+    to_deactivate = [obj for external_id, obj in existing.items() if external_id not in seen and obj.is_active]
+    for obj in to_deactivate:
+        obj.is_active = False
+    if to_deactivate:
+        changed_fields.add('is_active')
+    for obj in to_update + to_deactivate:
+        obj.updated_at = now
+
+    model.objects.bulk_create(to_create, batch_size=BULK_BATCH_SIZE)  # type: ignore[attr-defined]
+    if any(obj.pk is None for obj in to_create):
+        # Backends without INSERT ... RETURNING: look the new primary keys up
+        pks = dict(model.objects.filter(  # type: ignore[attr-defined]
+            external_id__in=[obj.external_id for obj in to_create],
+            **{f'{parent_attname}__in': {getattr(obj, parent_attname) for obj in to_create}},
+        ).values_list('external_id', 'pk'))
+        for obj in to_create:
+            obj.pk = pks[obj.external_id]
+    if to_update or to_deactivate:
+        model.objects.bulk_update(  # type: ignore[attr-defined]
+            to_update + to_deactivate, sorted(changed_fields | {'updated_at'}), batch_size=BULK_BATCH_SIZE)
+
+    counts = {'created': len(to_create), 'updated': len(to_update), 'deactivated': len(to_deactivate)}
+    return counts, seen
+
+
+def sync_course_tree(course, tree):
+    """
+    Apply a scraped catalog to `course` in a single transaction.
+
+    `tree` is ``{"modules": [{"external_id": ..., "lessons": [{..., "files": [...]}]}]}``.
+    Rows are matched on external_id within the course (so content moved between
+    modules is re-parented), missing rows are deactivated rather than deleted and
+    download state is never touched. Raises ValueError on malformed input.
+    """
+    if not isinstance(tree, dict) or not isinstance(tree.get('modules', []), list):
+        raise ValueError('Expected an object with a "modules" list')
+
+    existing_by_level = (
+        Module.objects.filter(course=course),  # type: ignore[attr-defined]
+        Lesson.objects.filter(module__course=course),  # type: ignore[attr-defined]
+        File.objects.filter(lesson__module__course=course),  # type: ignore[attr-defined]
+    )
+    now = timezone.now()
+    result = {}
+    with transaction.atomic():  # type: ignore
+        incoming = [(course.pk, node) for node in tree.get('modules', [])]
+        for (model, parent_attname, children_key), queryset in zip(SYNC_LEVELS, existing_by_level):
+            existing = {obj.external_id: obj for obj in queryset.exclude(external_id__isnull=True)}
+            counts, seen = _sync_level(model, parent_attname, children_key, existing, incoming, now)
+            result[model._meta.model_name + 's'] = counts
+            if children_key is None:
+                break
+            incoming = []
+            for obj, node in seen.values():
+                children = node.get(children_key, [])
+                if not isinstance(children, list):
+                    raise ValueError(f'{model.__name__} {obj.external_id}: "{children_key}" must be a list')
+                incoming += [(obj.pk, child) for child in children]
+        course.is_content_listed = True
+        course.content_list_date = int(now.timestamp())
+        course.save(update_fields=['is_content_listed', 'content_list_date', 'updated_at'])
+        # Lessons may have been re-parented with bulk_update, which sends no signals
+        schedule_refresh(module_ids=Module.objects.filter(course=course).values_list('pk', flat=True),  # type: ignore[attr-defined]
+                         course_ids=[course.pk])
+        schedule_index(course_ids=[course.pk])
+    return result
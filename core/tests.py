@@ -1,3 +1,1587 @@
-from django.test import TestCase
+import asyncio
+import functools
+import http.client
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.migrations.executor import MigrationExecutor
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import admin as core_admin
+from . import crypto, progress, ratelimit, rollups, search, sessions
+from .downloader import DownloadPipeline, download_files, streams
+from .downloader.base import DownloadRequest, DownloadResult, DownloadStateWriter
+from .downloader.http import HttpDownloader
+from .downloader.tasks import TaskQueue, enqueue_files
+from .downloader.workers import AsyncWorker
+from .downloader.manifests import (
+    ManifestError, VariantPolicy, parse_hls_master, parse_hls_media, parse_mpd, sniff,
+)
+from .models import (
+    Course, DownloadTask, File, Lesson, Module, Platform, PlatformAuth, PlatformURL, SystemConfig, WorkerHeartbeat,
+)
+from .pagination import EstimatedCountPaginator
+from .paths import PathPlanner
+
+MAX_CHANGELIST_QUERIES = 12
+
+
+class AdminChangelistQueryTests(TestCase):
+    """Catalog changelists cost a bounded number of queries, however many rows the page shows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin_user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin')
+        cls.platforms = [Platform.objects.create(id=f'platform-{n}', name=f'Platform {n}') for n in range(3)]  # type: ignore[attr-defined]
+
+    def setUp(self):
+        core_admin._filter_cache.clear()
+        self.client.force_login(self.admin_user)
+
+    def add_files(self, count):
+        for n in range(count):
+            course = Course.objects.create(name=f'Course {n}', platform=self.platforms[n % 3])  # type: ignore[attr-defined]
+            module = Module.objects.create(course=course, name=f'Module {n}')  # type: ignore[attr-defined]
+            lesson = Lesson.objects.create(module=module, name=f'Lesson {n}')  # type: ignore[attr-defined]
+            File.objects.create(lesson=lesson, name=f'File {n}', file_type=('mp4', 'pdf')[n % 2])  # type: ignore[attr-defined]
+
+    def changelist_queries(self, model):
+        url = reverse(f'admin:core_{model._meta.model_name}_changelist')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_files(5)
+        models = (Course, Module, Lesson, File)
+        for model in models:
+            self.changelist_queries(model)  # fills the filter choice cache
+        few = {model: self.changelist_queries(model) for model in models}
+        self.add_files(40)
+        for model, expected in few.items():
+            queries = self.changelist_queries(model)
+            self.assertEqual(queries, expected, model.__name__)
+            self.assertLessEqual(queries, MAX_CHANGELIST_QUERIES, model.__name__)
+
+    def test_filter_choices_are_cached(self):
+        self.add_files(4)
+        first = self.changelist_queries(File)
+        self.assertLess(self.changelist_queries(File), first)
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def test_filtered_count_is_capped(self):
+        for n in range(5):
+            Course.objects.create(name=f'Course {n}')  # type: ignore[attr-defined]
+        queryset = Course.objects.filter(name__startswith='Course')  # type: ignore[attr-defined]
+        self.assertEqual(EstimatedCountPaginator(queryset.order_by('pk'), 2).count, 5)
+        with mock.patch('core.pagination.COUNT_CAP', 3):
+            self.assertEqual(EstimatedCountPaginator(queryset.order_by('pk'), 2).count, 3)
+
+    def test_unfiltered_count_uses_the_estimate(self):
+        Course.objects.create(name='Course')  # type: ignore[attr-defined]
+        with mock.patch('core.pagination.estimated_row_count', return_value=250_000):
+            self.assertEqual(EstimatedCountPaginator(Course.objects.order_by('pk'), 100).count, 250_000)  # type: ignore[attr-defined]
+            self.assertEqual(EstimatedCountPaginator(Course.objects.filter(name='Course').order_by('pk'), 100).count, 1)  # type: ignore[attr-defined]
+
+
+class _RangeHandler(SimpleHTTPRequestHandler):
+    """
+    Static files with single-range support; the server's `ranges` flag turns it
+    off like some CDNs, and its `token` makes it answer 401 to other bearers.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, so connection reuse shows in `server.connections`
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.seen.append((self.path, self.headers.get('Range')))
+        if self.server.token and self.headers.get('Authorization') != f'Bearer {self.server.token}':
+            return self.send_error(401)
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        data = Path(path).read_bytes()
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if match and self.server.ranges:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(data)}')
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class LocalServerMixin:
+    """A throwaway HTTP server over a temp directory, for the download backends"""
+
+    def start_server(self, ranges=True):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, True)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(_RangeHandler, directory=str(self.root)))
+        server.ranges = ranges
+        server.seen = []
+        server.connections = 0
+        server.token = None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+        return f'http://127.0.0.1:{server.server_address[1]}'
+
+    def serve(self, name, data):
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data.encode() if isinstance(data, str) else data)
+        return path
+
+
+HLS_MASTER = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="en",URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="pt",DEFAULT=YES,URI="audio/pt.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e",AUDIO="aud"
+360p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,AUDIO="aud"
+720p/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,RESOLUTION=1920x1080,AUDIO="aud"
+1080p/index.m3u8
+"""
+
+HLS_MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="100@0"
+#EXT-X-KEY:METHOD=AES-128,URI="../key.bin"
+#EXTINF:4.0,
+seg0.m4s
+#EXT-X-KEY:METHOD=AES-128,URI="../key.bin",IV=0x0000000000000000000000000000000A
+#EXTINF:4.0,
+seg1.m4s
+#EXT-X-KEY:METHOD=NONE
+#EXTINF:2.5,
+#EXT-X-BYTERANGE:1000@200
+all.m4s
+#EXTINF:2.5,
+#EXT-X-BYTERANGE:500
+all.m4s
+#EXT-X-ENDLIST
+"""
+
+MPD_TEMPLATE = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <BaseURL>https://cdn.example/v/</BaseURL>
+  <Period duration="PT10S">
+    <AdaptationSet contentType="video" mimeType="video/mp4">
+      <SegmentTemplate timescale="1000" initialization="$RepresentationID$/init.mp4"
+                       media="$RepresentationID$/$Number%03d$.m4s" startNumber="1">
+        <SegmentTimeline><S t="0" d="4000" r="-1"/></SegmentTimeline>
+      </SegmentTemplate>
+      <Representation id="v360" bandwidth="800000" width="640" height="360"/>
+      <Representation id="v720" bandwidth="2500000" width="1280" height="720"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4">
+      <SegmentTemplate timescale="48000" duration="192000" initialization="a/$Bandwidth$/init.mp4"
+                       media="a/$Bandwidth$/$Time$.m4s"/>
+      <Representation id="a64" bandwidth="64000"/>
+      <Representation id="a128" bandwidth="128000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+MPD_LIST_AND_BASE = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT6S">
+  <Period>
+    <AdaptationSet mimeType="video/mp4">
+      <Representation id="list" bandwidth="1000000" height="480">
+        <BaseURL>list/video.mp4</BaseURL>
+        <SegmentList timescale="10" duration="30">
+          <Initialization range="0-99"/>
+          <SegmentURL mediaRange="100-599"/>
+          <SegmentURL mediaRange="600-999"/>
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4">
+      <Representation id="base" bandwidth="96000">
+        <BaseURL>audio.mp4</BaseURL>
+        <SegmentBase indexRange="0-99"/>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+
+class ManifestParserTests(TestCase):
+    def test_sniff(self):
+        self.assertEqual(sniff('\ufeff#EXTM3U\n'), 'hls')
+        self.assertEqual(sniff(MPD_TEMPLATE), 'dash')
+        self.assertIsNone(sniff('<html>'))
+
+    def test_hls_master(self):
+        variants = parse_hls_master(HLS_MASTER, 'https://cdn.example/course/master.m3u8')
+        self.assertEqual([variant.height for variant in variants], [360, 720, 1080])
+        self.assertEqual(variants[0].uri, 'https://cdn.example/course/360p/index.m3u8')
+        self.assertEqual(variants[0].codecs, 'avc1.4d401e')
+        # The DEFAULT rendition of the audio group wins
+        self.assertEqual(variants[0].audio_uri, 'https://cdn.example/course/audio/pt.m3u8')
+        self.assertEqual(VariantPolicy(max_height=720).choose(variants).height, 720)
+        self.assertEqual(VariantPolicy(prefer='smallest').choose(variants).height, 360)
+        self.assertEqual(VariantPolicy(max_height=240).choose(variants).height, 360)
+
+    def test_hls_media_playlist_is_its_own_variant(self):
+        url = 'https://cdn.example/720p/index.m3u8'
+        self.assertEqual([variant.uri for variant in parse_hls_master(HLS_MEDIA, url)], [url])
+
+    def test_hls_media(self):
+        track = parse_hls_media(HLS_MEDIA, 'https://cdn.example/720p/index.m3u8')
+        self.assertEqual(track.init.url, 'https://cdn.example/720p/init.mp4')
+        self.assertEqual(track.init.byte_range, (0, 99))
+        self.assertEqual(len(track.segments), 4)
+        first, second, third, fourth = track.segments
+        self.assertEqual(first.key_url, 'https://cdn.example/key.bin')
+        # No IV attribute: the media sequence number is the IV
+        self.assertEqual(first.iv, (7).to_bytes(16, 'big'))
+        self.assertEqual(second.iv, (10).to_bytes(16, 'big'))
+        self.assertIsNone(third.key_url)
+        self.assertEqual(third.byte_range, (200, 1199))
+        # A range without an offset continues where the previous one ended
+        self.assertEqual(fourth.byte_range, (1200, 1699))
+        self.assertEqual(track.duration, 13.0)
+
+    def test_hls_live_and_unsupported_encryption_are_rejected(self):
+        with self.assertRaises(ManifestError):
+            parse_hls_media('#EXTM3U\n#EXTINF:4,\na.ts\n', 'https://cdn.example/live.m3u8')
+        with self.assertRaises(ManifestError):
+            parse_hls_media('#EXTM3U\n#EXT-X-KEY:METHOD=SAMPLE-AES,URI="k"\n#EXTINF:4,\na.ts\n#EXT-X-ENDLIST\n',
+                            'https://cdn.example/a.m3u8')
+
+    def test_dash_segment_template(self):
+        variants = parse_mpd(MPD_TEMPLATE, 'https://cdn.example/manifest.mpd')
+        self.assertEqual([variant.height for variant in variants], [360, 720])
+        video, audio = VariantPolicy().choose(variants).tracks
+        self.assertEqual(video.init.url, 'https://cdn.example/v/v720/init.mp4')
+        # r="-1" repeats up to the end of the period
+        self.assertEqual([segment.url.rsplit('/', 1)[1] for segment in video.segments], ['001.m4s', '002.m4s', '003.m4s'])
+        # The best audio rendition is paired with every video one
+        self.assertEqual(audio.init.url, 'https://cdn.example/v/a/128000/init.mp4')
+        self.assertEqual([segment.url.rsplit('/', 1)[1] for segment in audio.segments],
+                         ['0.m4s', '192000.m4s', '384000.m4s'])
+        self.assertAlmostEqual(audio.duration, 10.0)
+
+    def test_dash_segment_list_and_segment_base(self):
+        (variant,) = parse_mpd(MPD_LIST_AND_BASE, 'https://cdn.example/m/manifest.mpd')
+        video, audio = variant.tracks
+        self.assertEqual(video.init.url, 'https://cdn.example/m/list/video.mp4')
+        self.assertEqual(video.init.byte_range, (0, 99))
+        self.assertEqual([segment.byte_range for segment in video.segments], [(100, 599), (600, 999)])
+        self.assertEqual(video.segments[0].duration, 3.0)
+        # SegmentBase: the whole representation is one segment
+        self.assertEqual([segment.url for segment in audio.segments], ['https://cdn.example/m/audio.mp4'])
+        self.assertIsNone(audio.segments[0].byte_range)
+
+    def test_dash_live_is_rejected(self):
+        with self.assertRaises(ManifestError):
+            parse_mpd('<MPD type="dynamic"><Period/></MPD>', 'https://cdn.example/live.mpd')
+
+
+def _concat_mux(track_files, output, extension):
+    """Stand-in for ffmpeg: the "muxed" file is the tracks back to back"""
+    with open(output, 'wb') as out:
+        for track_file in track_files:
+            out.write(Path(track_file).read_bytes())
+
+
+class StreamDownloaderTests(LocalServerMixin, TestCase):
+    def setUp(self):
+        self.out = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.out, True)
+
+    def download(self, url, name='video.mp4'):
+        progress = []
+        with mock.patch.object(streams.StreamDownloader, '_mux', staticmethod(_concat_mux)), \
+                mock.patch.object(streams, 'CHUNK_SIZE', 7):
+            # A tiny chunk size makes every segment span several reads
+            with streams.StreamDownloader(ffmpeg_path='ffmpeg', retries=0) as backend:
+                (result,) = backend.download([DownloadRequest(1, url, self.out / name)],
+                                             progress=lambda *args: progress.append(args[1]))
+        self.assertTrue(result.ok, result.error)
+        return result, progress
+
+    def encrypt(self, data, key, iv):
+        padder = padding.PKCS7(128).padder()
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+        return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+    def test_hls_with_aes_and_byte_ranges(self):
+        for ranges in (True, False):
+            with self.subTest(ranges=ranges):
+                base = self.start_server(ranges=ranges)
+                key = os.urandom(16)
+                self.serve('key.bin', key)
+                self.serve('720p/init.mp4', b'I' * 100 + b'junk')
+                plain = [os.urandom(301), os.urandom(64)]
+                self.serve('720p/seg0.m4s', self.encrypt(plain[0], key, (7).to_bytes(16, 'big')))
+                self.serve('720p/seg1.m4s', self.encrypt(plain[1], key, (10).to_bytes(16, 'big')))
+                blob = os.urandom(1700)
+                self.serve('720p/all.m4s', blob)
+                self.serve('720p/index.m3u8', HLS_MEDIA)
+                self.serve('master.m3u8', '#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1,RESOLUTION=1280x720\n720p/index.m3u8\n')
+
+                result, progress = self.download(f'{base}/master.m3u8', f'hls-{ranges}.mp4')
+                expected = b'I' * 100 + plain[0] + plain[1] + blob[200:1700]
+                self.assertEqual(result.path.read_bytes(), expected)
+                self.assertEqual(result.duration, 13)
+                self.assertEqual(progress[-1] if progress else None, len(expected))
+                self.assertFalse(result.path.with_name(result.path.name + '.parts').exists())
+
+    def test_dash_segment_base_is_streamed_to_disk(self):
+        base = self.start_server()
+        media = os.urandom(50_000)
+        self.serve('audio.mp4', media)
+        self.serve('manifest.mpd', MPD_LIST_AND_BASE.replace(
+            '<AdaptationSet mimeType="video/mp4">', '<AdaptationSet mimeType="text/vtt">'))
+        reads = []
+        original_read = http.client.HTTPResponse.read
+
+        def read(response, amt=None):
+            reads.append(amt)
+            return original_read(response, amt)
+        with mock.patch.object(http.client.HTTPResponse, 'read', read):
+            result, _ = self.download(f'{base}/manifest.mpd', 'audio.m4a')
+        self.assertEqual(result.path.read_bytes(), media)
+        # Read in chunks, never whole
+        self.assertEqual(set(reads), {7})
+        self.assertEqual(result.duration, 6)
+
+
+class HttpDownloaderTests(LocalServerMixin, TestCase):
+    def setUp(self):
+        self.base = self.start_server()
+        self.data = os.urandom(10_000)
+        self.serve('file.bin', self.data)
+        self.out = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.out, True)
+
+    def download(self, name='file.bin', **options):
+        options = {'segment_size': 1000, 'retries': 0, 'per_host_connections': 2, **options}
+        with HttpDownloader(**options) as backend:
+            (result,) = backend.download([DownloadRequest(1, f'{self.base}/{name}', self.out / name)])
+        return result
+
+    def segment_requests(self):
+        return [header for _, header in self.server.seen if header != 'bytes=0-0']
+
+    def test_segmented_download_reuses_connections(self):
+        result = self.download()
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.path.read_bytes(), self.data)
+        self.assertEqual(len(self.segment_requests()), 10)
+        # Probe and ten segments over at most per_host_connections connections
+        self.assertLessEqual(self.server.connections, 2)
+
+    def test_empty_remote_file(self):
+        # Even byte 0 is out of range: the probe gets 416 with Content-Range: bytes */0
+        self.serve('empty.bin', b'')
+        result = self.download('empty.bin')
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.path.read_bytes(), b'')
+        self.assertEqual((result.bytes_written, result.file_size), (0, 0))
+        self.assertEqual(self.server.seen, [('/empty.bin', 'bytes=0-0')])
+        self.assertFalse(result.path.with_name('empty.bin.part').exists())
+
+    def test_resume_from_part_json(self):
+        path = self.out / 'file.bin'
+        path.with_name('file.bin.part').write_bytes(self.data[:4000] + bytes(6000))
+        path.with_name('file.bin.part.json').write_text(json.dumps(
+            {'size': 10_000, 'validator': None, 'done': [[start, start + 999] for start in range(0, 4000, 1000)]}))
+        result = self.download()
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(path.read_bytes(), self.data)
+        self.assertEqual(result.bytes_written, 10_000)
+        self.assertEqual(sorted(self.segment_requests()),
+                         sorted(f'bytes={start}-{start + 999}' for start in range(4000, 10_000, 1000)))
+        self.assertFalse(path.with_name('file.bin.part.json').exists())
+
+    def test_changed_remote_file_restarts(self):
+        path = self.out / 'file.bin'
+        path.with_name('file.bin.part').write_bytes(bytes(10_000))
+        path.with_name('file.bin.part.json').write_text(json.dumps({'size': 9_999, 'validator': None, 'done': [[0, 999]]}))
+        result = self.download()
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(path.read_bytes(), self.data)
+        self.assertEqual(len(self.segment_requests()), 10)
+
+    def test_server_without_range_support(self):
+        self.server.ranges = False
+        result = self.download()
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.path.read_bytes(), self.data)
+        # The probe answered 200, so the file came in one plain GET
+        self.assertEqual(self.segment_requests(), [None])
+        self.assertFalse(result.path.with_name('file.bin.part.json').exists())
+
+    def test_client_errors_are_not_retried(self):
+        result = self.download('missing.bin', retries=3)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error, 'HTTP 404')
+        self.assertEqual(len(self.server.seen), 1)
+
+
+class DownloadStateWriterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        course = Course.objects.create(name='Course', platform=platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=course, name='Module')  # type: ignore[attr-defined]
+        lesson = Lesson.objects.create(module=module, name='Lesson')  # type: ignore[attr-defined]
+        cls.files = [File.objects.create(lesson=lesson, name=f'File {n}', extra_data={'url': f'u{n}'})  # type: ignore[attr-defined]
+                     for n in range(40)]
+
+    def flush_queries(self, files):
+        writer = DownloadStateWriter(batch_size=1000)
+        for n, file in enumerate(files):
+            if n % 4 == 3:
+                writer.add(DownloadResult(file.pk, Path('x'), False, error=f'boom {n}'))
+            else:
+                writer.add(DownloadResult(file.pk, Path('x'), True, file_size=n, duration=n if n % 2 else None))
+        with CaptureQueriesContext(connection) as context:
+            writer.flush()
+        return len(context.captured_queries)
+
+    def test_flushes_every_batch_size(self):
+        writer = DownloadStateWriter(batch_size=3)
+        with CaptureQueriesContext(connection) as context:
+            for file in self.files[:2]:
+                writer.add(DownloadResult(file.pk, Path('x'), True))
+            self.assertEqual(len(context.captured_queries), 0)
+            writer.add(DownloadResult(self.files[2].pk, Path('x'), True))
+            self.assertGreater(len(context.captured_queries), 0)
+        self.assertEqual(File.objects.filter(is_downloaded=True).count(), 3)  # type: ignore[attr-defined]
+
+    def test_writes_results_in_a_bounded_number_of_queries(self):
+        self.assertEqual(self.flush_queries(self.files[:8]), self.flush_queries(self.files[8:]))
+        for n, file in enumerate(File.objects.order_by('pk')):  # type: ignore[attr-defined]
+            local = n if n < 8 else n - 8
+            if local % 4 == 3:
+                self.assertFalse(file.is_downloaded)
+                self.assertEqual(file.extra_data, {'url': f'u{n}', 'download_error': f'boom {local}'})
+            else:
+                self.assertTrue(file.is_downloaded)
+                self.assertIsNotNone(file.download_date)
+                self.assertEqual(file.file_size, local)
+                self.assertEqual(file.duration, local if local % 2 else None)
+
+
+class SessionHeadersTests(LocalServerMixin, TransactionTestCase):
+    """
+    Downloads authenticate with the PlatformSession of the course's PlatformAuth.
+    Transactional: the token is refreshed and written back from another thread.
+    """
+
+    def setUp(self):
+        self.base = self.start_server()
+        self.server.token = 'new-token'
+        self.out = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.out, True)
+        config = SystemConfig.get_solo()
+        config.download_path = str(self.out)
+        config.save()
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.auth = PlatformAuth(platform=platform, username='user', token_type='Bearer')
+        self.auth.set_credentials('secret', token='old-token', passphrase='passphrase')
+        self.auth.save()
+        course = Course.objects.create(name='Course', platform=platform, auth=self.auth)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=course, name='Module')  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(module=module, name='Lesson')  # type: ignore[attr-defined]
+        self.refreshes = []
+        pool = sessions.SessionPool(passphrase='passphrase')
+        self.addCleanup(pool.close)
+        for patcher in (mock.patch.object(sessions, '_pool', pool),
+                        mock.patch.dict(sessions._refreshers, {'platform': self.refresh})):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def refresh(self, session, credentials):
+        self.refreshes.append(credentials['token'])
+        return {'token': 'new-token', 'expires_in': 3600}
+
+    def test_rejected_token_is_refreshed_once_and_written_back(self):
+        data = os.urandom(3000)
+        self.serve('file.bin', data)
+        file = File.objects.create(lesson=self.lesson, name='File', file_type='bin',  # type: ignore[attr-defined]
+                                   extra_data={'url': f'{self.base}/file.bin'})
+        with HttpDownloader(segment_size=1000, retries=0) as backend:
+            (result,) = download_files(File.objects.filter(pk=file.pk), AnonymousUser(), backend)  # type: ignore[attr-defined]
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.path.read_bytes(), data)
+        self.assertEqual(self.refreshes, ['old-token'])
+        self.auth.refresh_from_db()
+        self.assertEqual(self.auth.get_credentials('passphrase')['token'], 'new-token')
+
+    def test_stream_backend_uses_the_session(self):
+        self.serve('video/index.m3u8', '#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXTINF:4,\nseg0.ts\n#EXT-X-ENDLIST\n')
+        self.serve('video/seg0.ts', b'segment')
+        session = sessions.get_session_pool().get(self.auth.pk)
+        request = DownloadRequest(1, f'{self.base}/video/index.m3u8', self.out / 'video.mp4', session=session)
+        with mock.patch.object(streams.StreamDownloader, '_mux', staticmethod(_concat_mux)), \
+                streams.StreamDownloader(ffmpeg_path='ffmpeg', retries=0) as backend:
+            (result,) = backend.download([request])
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.path.read_bytes(), b'segment')
+        self.assertEqual(self.refreshes, ['old-token'])
+
+
+class PathPlannerTests(TestCase):
+    def setUp(self):
+        self.out = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.out, True)
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.course = Course.objects.create(name='Course', platform=platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=self.course, name='Module', order=1)  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(module=module, name='Lesson', order=2)  # type: ignore[attr-defined]
+
+    def plan(self):
+        return PathPlanner(AnonymousUser(), self.course, base_path=self.out).plan()
+
+    def test_layout_and_collisions(self):
+        files = [File.objects.create(lesson=self.lesson, name=name, order=3, file_type='mp4')  # type: ignore[attr-defined]
+                 for name in ('Intro?', 'Intro', 'intro')]
+        planned = self.plan()
+        lesson_dir = self.out / '000. Course' / '001. Module' / '002. Lesson'
+        self.assertEqual([planned[file.pk] for file in files], [
+            lesson_dir / '003. Intro.mp4', lesson_dir / '003. Intro (2).mp4', lesson_dir / '003. intro (3).mp4'])
+
+    def test_numbered_fallback_fits_the_path_limit(self):
+        files = [File.objects.create(lesson=self.lesson, name='x' * 100, order=3, file_type='mp4')  # type: ignore[attr-defined]
+                 for _ in range(12)]
+        folders = len(str(self.out.resolve())) + len('000. Course') + len('001. Module') + len('002. Lesson') + 4
+        with mock.patch('core.paths.MAX_PATH', folders + 8):
+            planned = self.plan()
+        names = [planned[file.pk].name for file in files]
+        self.assertEqual(len({name.lower() for name in names}), 12)
+        self.assertTrue(all(len(name) <= 8 and name.endswith('.mp4') for name in names), names)
+        self.assertEqual(names[1:3], ['0032.mp4', '0033.mp4'])
+        self.assertEqual(names[11], '0012.mp4')
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _take_visits(path, url_id, attempts, results):
+    store = ratelimit.SQLiteStore(path)
+    taken = 0
+    for _ in range(attempts):
+        try:
+            taken += store.take(('platform', 'download'), 1000, 1000, url_id, limit=12, used=0) == 0
+        except ratelimit.VisitationLimitReached:
+            pass
+    results.put(taken)
+
+
+class RateLimiterTests(TestCase):
+    def setUp(self):
+        self.platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+
+    def test_tokens_refill_at_the_rate(self):
+        clock = Clock()
+        store = ratelimit.MemoryStore()
+        with mock.patch.object(ratelimit.time, 'monotonic', clock):
+            self.assertEqual([store.take('key', 2, 2) for _ in range(2)], [0, 0])
+            self.assertAlmostEqual(store.take('key', 2, 2), 0.5)
+            clock.now += 0.25
+            self.assertAlmostEqual(store.take('key', 2, 2), 0.25)
+            clock.now += 0.25
+            self.assertEqual(store.take('key', 2, 2), 0)
+            # Never more than the burst, however long the bucket sat idle
+            clock.now += 60
+            self.assertEqual([store.take('key', 2, 2) for _ in range(2)], [0, 0])
+            self.assertGreater(store.take('key', 2, 2), 0)
+
+    def test_visitation_cap_is_counted_and_flushed(self):
+        url = PlatformURL.objects.create(  # type: ignore[attr-defined]
+            id='download', platform=self.platform, url_kind='download', has_visitation_limit=True,
+            visitation_limit=3, visitation_count=1)
+        limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(), default_rate=1000, default_burst=1000)
+        limiter.acquire(url)
+        limiter.acquire(url)
+        with self.assertRaises(ratelimit.VisitationLimitReached):
+            limiter.acquire(url)
+        self.assertEqual(limiter.flush(), 2)
+        url.refresh_from_db()
+        self.assertEqual(url.visitation_count, 3)
+
+    def test_sqlite_store_caps_visits_across_processes(self):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            self.skipTest('needs fork')
+        path = Path(tempfile.mkdtemp()) / 'ratelimit.sqlite3'
+        self.addCleanup(shutil.rmtree, path.parent, True)
+        ratelimit.SQLiteStore(path)
+        results = context.Queue()
+        processes = [context.Process(target=_take_visits, args=(str(path), 'url', 10, results)) for _ in range(3)]
+        for process in processes:
+            process.start()
+        taken = [results.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+        self.assertEqual(sum(taken), 12)
+        self.assertEqual(ratelimit.SQLiteStore(path).drain(), {'url': 12})
+
+    def test_run_workers_shares_the_store_between_processes(self):
+        seen = []
+
+        class Process:
+            def __init__(self, target, args, name):
+                seen.append(os.environ.get(ratelimit.RATELIMIT_DB_ENV))
+                self.exitcode = 0
+
+            def start(self):
+                pass
+
+            def is_alive(self):
+                return False
+
+            def join(self):
+                pass
+
+        context = mock.Mock(Process=Process)
+        with mock.patch('multiprocessing.get_context', return_value=context), mock.patch('signal.signal'), \
+                mock.patch.dict(os.environ, {}, clear=False):
+            os.environ.pop(ratelimit.RATELIMIT_DB_ENV, None)
+            call_command('run_workers', processes=2, stdout=io.StringIO())
+            self.assertNotIn(ratelimit.RATELIMIT_DB_ENV, os.environ)
+            call_command('run_workers', processes=1, stdout=io.StringIO())
+        self.assertEqual(len(seen), 3)
+        self.assertTrue(seen[0] and seen[0] == seen[1])
+        self.assertFalse(os.path.exists(seen[0]))
+        self.assertIsNone(seen[2])
+
+    def test_capped_task_is_deferred_without_using_an_attempt(self):
+        user = get_user_model().objects.create_user('owner')
+        course = Course.objects.create(name='Course', platform=self.platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=course, name='Module')  # type: ignore[attr-defined]
+        lesson = Lesson.objects.create(module=module, name='Lesson')  # type: ignore[attr-defined]
+        file = File.objects.create(lesson=lesson, name='File')  # type: ignore[attr-defined]
+        enqueue_files(user, [file])
+        worker = AsyncWorker()
+        worker._publisher = mock.Mock()
+        (task,) = worker.queue.claim()
+        request = DownloadRequest(file.pk, 'http://127.0.0.1/file', Path('file'))
+        with mock.patch.object(AsyncWorker, '_throttle', side_effect=ratelimit.VisitationLimitReached('download')):
+            with self.assertRaises(ratelimit.VisitationLimitReached):
+                worker._download(request, 'platform')
+        worker._defer(task, 'download')
+        task.refresh_from_db()
+        self.assertEqual((task.state, task.attempts, task.lease_owner), ('pending', 0, None))
+        self.assertGreater(task.available_at, timezone.now())
+        self.assertIn('Visitation limit reached', task.last_error)
+        worker._publisher.state.assert_called_once_with(
+            file.pk, 'deferred', error='Visitation limit reached for PlatformURL download')
+        self.assertEqual(worker.queue.claim(), [])
+
+
+class QueuedFilesMixin:
+    """Three files of one course, queued as one download job"""
+    file_count = 3
+
+    def setUp(self):
+        super().setUp()
+        self.user = get_user_model().objects.create_user('owner')
+        self.platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.course = Course.objects.create(name='Course', platform=self.platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=self.course, name='Module')  # type: ignore[attr-defined]
+        lesson = Lesson.objects.create(module=module, name='Lesson')  # type: ignore[attr-defined]
+        self.files = [File.objects.create(lesson=lesson, name=f'File {n}', file_size=100)  # type: ignore[attr-defined]
+                      for n in range(self.file_count)]
+        self.job = enqueue_files(self.user, self.files, course=self.course)
+
+    def make_available(self, **filters):
+        """Skip retry backoff and let leases run out, as if the clock had moved on"""
+        past = timezone.now() - timedelta(seconds=1)
+        DownloadTask.objects.filter(**filters).update(available_at=past, lease_expires=past)  # type: ignore[attr-defined]
+
+
+class TaskQueueTests(QueuedFilesMixin, TestCase):
+    def test_claims_never_lease_a_task_twice(self):
+        first, second = TaskQueue(owner='first'), TaskQueue(owner='second')
+        claimed = first.claim(limit=2)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual({(task.state, task.lease_owner, task.attempts) for task in claimed}, {('running', 'first', 1)})
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.state, 'running')
+        taken = second.claim()
+        self.assertEqual(len(taken), 1)
+        self.assertFalse({task.pk for task in claimed} & {task.pk for task in taken})
+        self.assertEqual((first.claim(), second.claim()), ([], []))
+
+    def test_task_won_by_another_worker_mid_claim_is_not_claimed(self):
+        first, second = TaskQueue(owner='first'), TaskQueue(owner='second')
+        claimable = TaskQueue._claimable
+
+        def candidates_then_race(queue, *args):
+            # `first` picks its candidates, then `second` claims them all before first's UPDATE runs
+            ids = list(claimable(queue, *args).values_list('pk', flat=True))
+            if queue is first and not taken:
+                taken.extend(second.claim())
+            return claimable(queue, *args).filter(pk__in=ids)
+
+        taken = []
+        with mock.patch.object(TaskQueue, '_claimable', autospec=True, side_effect=candidates_then_race):
+            self.assertEqual(first.claim(), [])
+        self.assertEqual(len(taken), 3)
+        self.assertEqual(set(self.job.tasks.values_list('lease_owner', 'attempts')), {('second', 1)})
+
+    def test_expired_lease_is_taken_over(self):
+        crashed, survivor = TaskQueue(owner='crashed'), TaskQueue(owner='survivor')
+        task = crashed.claim(limit=1)[0]
+        self.assertEqual(crashed.heartbeat([task.pk], {task.pk: 40}), {task.pk})
+        self.assertEqual(survivor.claim(limit=1)[0].pk, self.job.tasks.exclude(pk=task.pk)[0].pk)
+
+        self.make_available(pk=task.pk)
+        (taken,) = survivor.claim(limit=1)
+        self.assertEqual((taken.pk, taken.lease_owner, taken.attempts, taken.bytes_done), (task.pk, 'survivor', 2, 40))
+        # The old owner finds out at its next heartbeat and can no longer finish or fail the task
+        self.assertEqual(crashed.heartbeat([task.pk]), set())
+        self.assertFalse(crashed.complete(task))
+        self.assertFalse(crashed.fail(task, 'late'))
+        self.assertTrue(survivor.complete(taken, bytes_done=100))
+        taken.refresh_from_db()
+        self.assertEqual((taken.state, taken.lease_owner, taken.bytes_done), ('done', None, 100))
+
+    def test_failures_back_off_until_the_task_fails(self):
+        queue = TaskQueue(owner='worker', max_attempts=3)
+        delays = []
+        for attempt in range(1, 4):
+            (task,) = queue.claim(limit=1, job_ids=[self.job.pk])
+            self.assertEqual(task.attempts, attempt)
+            started = timezone.now()
+            self.assertTrue(queue.fail(task, f'error {attempt}'))
+            task.refresh_from_db()
+            self.assertEqual(task.last_error, f'error {attempt}')
+            self.assertIsNone(task.lease_owner)
+            if task.state == 'pending':
+                delays.append(round((task.available_at - started).total_seconds()))
+                # Not claimable again until the backoff is over
+                self.assertNotIn(task.pk, [other.pk for other in queue.claim(limit=5)])
+                queue.release(DownloadTask.objects.filter(lease_owner='worker'))  # type: ignore[attr-defined]
+                self.make_available(pk=task.pk)
+        self.assertEqual(delays, [30, 60])
+        self.assertEqual(task.state, 'failed')
+        self.assertEqual(task.attempts, 3)
+
+    def test_fail_without_retry_fails_for_good(self):
+        queue = TaskQueue(owner='worker')
+        (task,) = queue.claim(limit=1)
+        queue.fail(task, 'File has no source URL', retry=False)
+        task.refresh_from_db()
+        self.assertEqual((task.state, task.attempts), ('failed', 1))
+
+    def test_release_does_not_count_the_attempt(self):
+        queue = TaskQueue(owner='worker')
+        tasks = queue.claim()
+        self.assertEqual(queue.release(tasks), 3)
+        self.assertEqual(set(self.job.tasks.values_list('state', 'attempts', 'lease_owner', 'lease_expires')),
+                         {('pending', 0, None, None)})
+        # Released tasks can be claimed again straight away
+        self.assertEqual({task.attempts for task in TaskQueue(owner='next').claim()}, {1})
+        self.assertEqual(queue.release(tasks), 0)
+
+
+class RecordingPublisher:
+    """Stands in for ProgressPublisher, keeping what the worker publishes"""
+
+    def __init__(self):
+        self.events = []
+        self.released = threading.Event()
+        self.closed = False
+
+    def start(self):
+        return self
+
+    def progress(self, file_id, done, total, **meta):
+        self.events.append(('progress', file_id, done, meta))
+
+    def state(self, file_id, state, **meta):
+        self.events.append((state, file_id, meta))
+        if state == 'released':
+            self.released.set()
+
+    def close(self):
+        self.closed = True
+
+    def states(self, state):
+        return sorted(event[1] for event in self.events if event[0] == state)
+
+
+class StubBackend:
+    """A download backend that hands each request to `transfer(request, progress)`"""
+
+    def __init__(self, transfer):
+        self.transfer = transfer
+        self.closed = False
+
+    def download(self, requests, progress=None):
+        for request in requests:
+            yield self.transfer(request, progress)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncWorkerTests(QueuedFilesMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        File.objects.update(extra_data={'url': 'http://127.0.0.1/file'})  # type: ignore[attr-defined]
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        config = SystemConfig.get_solo()
+        config.download_path = root
+        config.save()
+        self.publisher = RecordingPublisher()
+
+    def run_worker(self, transfer, **options):
+        """Run an AsyncWorker over the stub backend; `transfer` may call `self.stop()` from its thread"""
+        options = {'concurrency': 1, 'idle_sleep': 0.05, 'lease_seconds': 3, 'drain_timeout': 5, **options}
+        self.worker = worker = AsyncWorker(**options)
+        self.backend = StubBackend(transfer)
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            self.stop = lambda: loop.call_soon_threadsafe(worker._stopping.set)
+            await worker.run()
+
+        with mock.patch('core.downloader.workers.ProgressPublisher', return_value=self.publisher), \
+                mock.patch('core.downloader.workers.get_backend', return_value=self.backend):
+            asyncio.run(main())
+        return worker
+
+    def finish(self, request, progress):
+        progress(request.file_id, 40, 100)
+        progress(request.file_id, 100, 100)
+        return DownloadResult(request.file_id, request.path, True, bytes_written=100)
+
+    def stop_after(self, count, transfer):
+        done = []
+
+        def stopping(request, progress):
+            result = transfer(request, progress)
+            done.append(request.file_id)
+            if len(done) == count:
+                self.stop()
+            return result
+        return stopping
+
+    def test_progress_and_state_events_are_published(self):
+        worker = self.run_worker(self.stop_after(3, self.finish))
+        file_ids = sorted(file.pk for file in self.files)
+        self.assertEqual(set(self.job.tasks.values_list('state', 'bytes_done', 'lease_owner')), {('done', 100, None)})
+        self.assertEqual(self.publisher.states('running'), file_ids)
+        self.assertEqual(self.publisher.states('done'), file_ids)
+        meta = {'course': self.course.pk, 'job': self.job.pk, 'user': self.user.pk}
+        self.assertIn(('progress', file_ids[0], 40, meta), self.publisher.events)
+        self.assertIn(('done', file_ids[0], {'bytes': 100, **meta}), self.publisher.events)
+        self.assertTrue(self.publisher.closed)
+        self.assertTrue(self.backend.closed)
+        self.assertFalse(worker.abandoned)
+        self.assertEqual(File.objects.filter(is_downloaded=True).count(), 3)  # type: ignore[attr-defined]
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.state, 'done')
+        heartbeat = WorkerHeartbeat.objects.get(worker_id=worker.queue.owner)  # type: ignore[attr-defined]
+        self.assertEqual((heartbeat.state, heartbeat.tasks_done), ('stopped', 3))
+
+    def test_lost_task_is_not_completed(self):
+        lost_file = self.files[0].pk
+
+        def taken_over(request, progress):
+            if request.file_id == lost_file:
+                # Another worker takes the task over; the next heartbeat notices
+                DownloadTask.objects.filter(file_id=lost_file).update(lease_owner='other')  # type: ignore[attr-defined]
+                for _ in range(100):
+                    if self.worker._lost:
+                        break
+                    time.sleep(0.05)
+            return self.finish(request, progress)
+
+        worker = self.run_worker(self.stop_after(3, taken_over))
+        lost = DownloadTask.objects.get(file_id=lost_file)  # type: ignore[attr-defined]
+        self.assertEqual(worker._lost, {lost.pk})
+        self.assertEqual((lost.state, lost.lease_owner, lost.attempts), ('running', 'other', 1))
+        self.assertNotIn(lost_file, self.publisher.states('done'))
+        self.assertEqual(len(self.publisher.states('done')), 2)
+        self.assertEqual(worker._stats['tasks_done'], 2)
+
+    def test_shutdown_releases_running_tasks(self):
+        def stuck(request, progress):
+            progress(request.file_id, 10, 100)
+            self.stop()
+            self.publisher.released.wait(10)
+            return self.finish(request, progress)
+
+        worker = self.run_worker(stuck, concurrency=2, drain_timeout=0.2)
+        self.assertTrue(worker.abandoned)
+        self.assertEqual(len(self.publisher.states('released')), 2)
+        self.assertEqual(self.publisher.states('done'), [])
+        self.assertFalse(self.backend.closed)
+        self.assertEqual(set(self.job.tasks.values_list('state', 'attempts', 'lease_owner')), {('pending', 0, None)})
+        heartbeat = WorkerHeartbeat.objects.get(worker_id=worker.queue.owner)  # type: ignore[attr-defined]
+        self.assertEqual((heartbeat.state, heartbeat.active_tasks), ('stopped', 0))
+
+
+class ProgressTests(TestCase):
+    """Workers' progress datagrams, and what the hub hands each subscriber of the SSE stream"""
+
+    def receiver(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def test_publisher_coalesces_bytes_and_keeps_states(self):
+        sock = self.receiver()
+        publisher = progress.ProgressPublisher(addr=sock.getsockname())
+        self.addCleanup(publisher.close)
+        clock = Clock()
+        with mock.patch.object(progress.time, 'monotonic', clock):
+            publisher.state(1, 'running', user=7)
+            publisher.progress(1, 10, 100, user=7)
+            publisher.progress(1, 50, 100, user=7)
+            publisher.progress(2, 5, 10)
+            publisher.flush()
+            clock.now += 2
+            publisher.progress(1, 90, 100, user=7)
+            publisher.flush()
+            publisher.state(1, 'done', user=7)
+            publisher.flush()
+            publisher.flush()
+        first, second, third = [json.loads(sock.recv(65536)) for _ in range(3)]
+        self.assertEqual(first, [
+            {'type': 'file', 'file': 1, 'bytes': 50, 'total': 100, 'user': 7, 'rate': 0.0},
+            {'type': 'file', 'file': 2, 'bytes': 5, 'total': 10, 'rate': 0.0},
+            {'type': 'state', 'file': 1, 'state': 'running', 'user': 7},
+        ])
+        # 40 bytes over the 2 seconds since the last send
+        self.assertEqual(second, [{'type': 'file', 'file': 1, 'bytes': 90, 'total': 100, 'user': 7, 'rate': 20.0}])
+        self.assertEqual(third, [{'type': 'state', 'file': 1, 'state': 'done', 'user': 7}])
+        # Nothing new: nothing sent, and a finished file's rate starts over
+        with self.assertRaises(TimeoutError):
+            sock.settimeout(0.1)
+            sock.recv(65536)
+        self.assertNotIn(1, publisher._last)
+
+    def test_pack_splits_into_datagrams(self):
+        events = [{'type': 'file', 'file': n, 'name': 'x' * 50} for n in range(20)]
+        with mock.patch.object(progress, 'MAX_DATAGRAM', 300):
+            datagrams = list(progress._pack(events))
+        self.assertGreater(len(datagrams), 1)
+        self.assertTrue(all(len(datagram) <= 300 for datagram in datagrams))
+        self.assertEqual([event for datagram in datagrams for event in json.loads(datagram)], events)
+
+    def test_subscribers_only_get_their_own_jobs(self):
+        hub = progress.ProgressHub(addr=('127.0.0.1', 0))
+        mine, theirs = hub.subscribe(user_id=1), hub.subscribe(user_id=2)
+        one_course, everything = hub.subscribe(user_id=1, course_id=20), hub.subscribe()
+        hub.receive([
+            {'type': 'state', 'file': 1, 'state': 'running', 'user': 1, 'course': 10},
+            {'type': 'file', 'file': 1, 'bytes': 10, 'total': 100, 'rate': 5.0, 'user': 1, 'course': 10},
+            {'type': 'file', 'file': 1, 'bytes': 30, 'total': 100, 'rate': 5.0, 'user': 1, 'course': 10},
+            {'type': 'file', 'file': 2, 'bytes': 7, 'total': 70, 'rate': 1.0, 'user': 2, 'course': 10},
+            {'type': 'file', 'file': 3, 'bytes': 1, 'total': 2, 'rate': 0.5, 'user': 1, 'course': 20},
+        ])
+
+        def latest(subscriber):
+            states, events = hub.take(subscriber)
+            return states, {(event['type'], event.get('file', event['course'])): event for event in events}
+
+        states, events = latest(mine)
+        self.assertEqual(states, [{'type': 'state', 'file': 1, 'state': 'running', 'course': 10}])
+        self.assertEqual(set(events), {('file', 1), ('file', 3), ('course', 10), ('course', 20)})
+        self.assertEqual(events[('file', 1)]['bytes'], 30)
+        self.assertNotIn('user', events[('file', 1)])
+        # Course totals only count the subscriber's own files
+        self.assertEqual((events[('course', 10)]['files'], events[('course', 10)]['bytes']), (1, 30))
+
+        states, events = latest(theirs)
+        self.assertEqual(states, [])
+        self.assertEqual(set(events), {('file', 2), ('course', 10)})
+        self.assertEqual((events[('course', 10)]['files'], events[('course', 10)]['bytes']), (1, 7))
+
+        self.assertEqual(set(latest(one_course)[1]), {('file', 3), ('course', 20)})
+        _, events = latest(everything)
+        self.assertEqual(set(events), {('file', 1), ('file', 2), ('file', 3), ('course', 10), ('course', 20)})
+        self.assertEqual(events[('course', 10)]['files'], 2)
+
+        self.assertEqual(hub.take(mine), ([], []))
+        self.assertEqual({event['file'] for event in hub.snapshot(theirs)}, {2})
+
+    def test_finished_files_expire(self):
+        hub = progress.ProgressHub(addr=('127.0.0.1', 0))
+        clock = Clock()
+        with mock.patch.object(progress.time, 'monotonic', clock):
+            hub.receive([{'type': 'state', 'file': 1, 'state': 'done', 'course': 10},
+                         {'type': 'file', 'file': 2, 'bytes': 1, 'course': 10}])
+            clock.now += progress.STATE_TTL + 1
+            hub.receive([{'type': 'file', 'file': 3, 'bytes': 1, 'course': 10}])
+        # Running files stay however quiet they are
+        self.assertEqual(set(hub.files), {2, 3})
+
+    def test_stream_frames_are_rate_capped(self):
+        hub = progress.ProgressHub(addr=('127.0.0.1', 0))
+        subscriber = hub.subscribe(user_id=1)
+        hub.receive([{'type': 'file', 'file': 1, 'bytes': 1, 'user': 1, 'course': 10}])
+        pauses = []
+
+        async def sleep(seconds):
+            pauses.append(seconds)
+            # Everything arriving during the pause lands in the next frame
+            hub.receive([{'type': 'file', 'file': 1, 'bytes': n, 'user': 1, 'course': 10} for n in (2, 3, 4)])
+
+        async def frames():
+            events = progress.progress_events(hub, subscriber, max_hz=4)
+            try:
+                return [await anext(events) for _ in range(3)]
+            finally:
+                await events.aclose()
+
+        with mock.patch.object(progress.asyncio, 'sleep', sleep):
+            snapshot, first, second = asyncio.run(frames())
+        self.assertIn('"bytes":1', snapshot)
+        self.assertEqual(pauses, [0.25])
+        data = json.loads(second.split('data: ', 1)[1])
+        self.assertEqual([event['bytes'] for event in data['latest'] if event['type'] == 'file'], [4])
+        self.assertNotIn(subscriber, hub._subscribers)
+
+    def test_wsgi_request_gets_501(self):
+        user = get_user_model().objects.create_user('viewer')
+        self.client.force_login(user)
+        response = self.client.get(reverse('progress-stream'))
+        self.assertEqual(response.status_code, 501)
+        self.assertIn('ASGI', response.json()['detail'])
+
+
+class RollupTests(TransactionTestCase):
+    """Course/Module totals follow every way files are written, once the transaction commits"""
+
+    def setUp(self):
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.course = Course.objects.create(name='Course', platform=platform)  # type: ignore[attr-defined]
+        self.other_course = Course.objects.create(name='Other', platform=platform)  # type: ignore[attr-defined]
+        self.module = Module.objects.create(course=self.course, name='Module')  # type: ignore[attr-defined]
+        self.other_module = Module.objects.create(course=self.other_course, name='Other')  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(module=self.module, name='Lesson')  # type: ignore[attr-defined]
+        self.other_lesson = Lesson.objects.create(module=self.other_module, name='Other')  # type: ignore[attr-defined]
+
+    def add_files(self, count, lesson=None, **fields):
+        return [File.objects.create(lesson=lesson or self.lesson, name=f'File {n}', **fields)  # type: ignore[attr-defined]
+                for n in range(count)]
+
+    def totals(self, obj):
+        return type(obj).objects.values(  # type: ignore[attr-defined]
+            'file_count', 'downloaded_count', 'total_bytes', 'downloaded_bytes', 'drm_count', 'total_duration',
+        ).get(pk=obj.pk)
+
+    def assertCounts(self, obj, file_count, downloaded_count=0, total_bytes=0, downloaded_bytes=0):
+        totals = self.totals(obj)
+        self.assertEqual(
+            (totals['file_count'], totals['downloaded_count'], totals['total_bytes'], totals['downloaded_bytes']),
+            (file_count, downloaded_count, total_bytes, downloaded_bytes), obj)
+
+    def flushes_registered(self):
+        return sum(func is rollups.flush_pending for _, func, _ in connection.run_on_commit)
+
+    def test_save(self):
+        file, = self.add_files(1, file_size=100, has_drm=True, duration=60)
+        self.assertEqual(self.totals(self.module), {
+            'file_count': 1, 'downloaded_count': 0, 'total_bytes': 100, 'downloaded_bytes': 0,
+            'drm_count': 1, 'total_duration': 60})
+        file.is_downloaded = True
+        file.save()
+        self.assertCounts(self.module, 1, 1, 100, 100)
+        self.assertCounts(self.course, 1, 1, 100, 100)
+        file.lesson = self.other_lesson
+        file.save(update_fields=['lesson'])
+        self.assertCounts(self.course, 0)
+        self.assertCounts(self.other_module, 1, 1, 100, 100)
+        self.assertCounts(self.other_course, 1, 1, 100, 100)
+
+    def test_bulk_create(self):
+        with transaction.atomic():
+            File.objects.bulk_create([File(lesson=self.lesson, name=f'File {n}', file_size=10)  # type: ignore[attr-defined]
+                                      for n in range(3)])
+            File.objects.bulk_create([File(lesson=self.other_lesson, name='Other', file_size=5)])  # type: ignore[attr-defined]
+            self.assertCounts(self.module, 0)
+            # One recompute for the whole transaction
+            self.assertEqual(self.flushes_registered(), 1)
+        self.assertCounts(self.module, 3, 0, 30)
+        self.assertCounts(self.course, 3, 0, 30)
+        self.assertCounts(self.other_course, 1, 0, 5)
+
+    def test_bulk_update(self):
+        files = self.add_files(4, file_size=10)
+        for file in files:
+            file.is_downloaded = True
+        files[0].lesson = self.other_lesson
+        with mock.patch.object(rollups, 'schedule_refresh', wraps=rollups.schedule_refresh) as schedule:
+            File.objects.bulk_update(files, ['is_downloaded', 'lesson'], batch_size=2)  # type: ignore[attr-defined]
+        # Not once more for each update() bulk_update() runs per batch
+        schedule.assert_called_once()
+        self.assertCounts(self.course, 3, 3, 30, 30)
+        self.assertCounts(self.other_course, 1, 1, 10, 10)
+
+    def test_queryset_update(self):
+        self.add_files(3, file_size=10)
+        File.objects.filter(lesson=self.lesson).update(is_downloaded=True)  # type: ignore[attr-defined]
+        self.assertCounts(self.course, 3, 3, 30, 30)
+        File.objects.filter(name='File 0').update(lesson=self.other_lesson)  # type: ignore[attr-defined]
+        self.assertCounts(self.module, 2, 2, 20, 20)
+        self.assertCounts(self.other_course, 1, 1, 10, 10)
+        File.objects.filter(lesson=self.lesson).update(file_size=F('file_size') * 2)  # type: ignore[attr-defined]
+        self.assertCounts(self.course, 2, 2, 40, 40)
+
+    def test_delete(self):
+        first, *_ = self.add_files(3, file_size=10)
+        first.delete()
+        self.assertCounts(self.course, 2, 0, 20)
+        File.objects.filter(lesson=self.lesson).delete()  # type: ignore[attr-defined]
+        self.assertCounts(self.course, 0)
+        self.add_files(2, lesson=self.other_lesson, file_size=10)
+        self.other_lesson.delete()
+        self.assertCounts(self.other_course, 0)
+
+    def test_parent_moves(self):
+        self.add_files(2, file_size=10)
+        self.lesson.module = self.other_module
+        self.lesson.save()
+        self.assertCounts(self.module, 0)
+        self.assertCounts(self.course, 0)
+        self.assertCounts(self.other_course, 2, 0, 20)
+        self.other_module.course = self.course
+        self.other_module.save()
+        self.assertCounts(self.course, 2, 0, 20)
+        self.assertCounts(self.other_course, 0)
+
+    def test_recompute_rollups(self):
+        self.add_files(2, file_size=10, is_downloaded=True)
+        self.add_files(1, lesson=self.other_lesson, file_size=7)
+        # Drift, as raw SQL or an older release would leave it
+        Module.objects.update(file_count=99, total_bytes=0)  # type: ignore[attr-defined]
+        Course.objects.update(downloaded_count=99)  # type: ignore[attr-defined]
+        call_command('recompute_rollups', course=[self.course.pk], stdout=io.StringIO())
+        self.assertCounts(self.course, 2, 2, 20, 20)
+        self.assertEqual(self.totals(self.other_module)['file_count'], 99)
+        out = io.StringIO()
+        call_command('recompute_rollups', stdout=out)
+        self.assertIn('Recomputed 2 modules and 2 courses', out.getvalue())
+        self.assertCounts(self.other_module, 1, 0, 7)
+        self.assertCounts(self.other_course, 1, 0, 7)
+
+
+class SearchTests(TransactionTestCase):
+    def setUp(self):
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.course = Course.objects.create(  # type: ignore[attr-defined]
+            name='Python Basics', teacher='Ada', platform=platform)
+        self.other_course = Course.objects.create(name='Cooking', platform=platform)  # type: ignore[attr-defined]
+        self.module = Module.objects.create(course=self.course, name='Decorators')  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(  # type: ignore[attr-defined]
+            module=self.module, name='Generators', description='Functions that <b>yield</b> values')
+        self.file = File.objects.create(lesson=self.lesson, name='slides')  # type: ignore[attr-defined]
+        self.user = get_user_model().objects.create_user('owner')
+        self.other = get_user_model().objects.create_user('other')
+
+    def hits(self, query, user=None):
+        return {(hit['kind'], hit['id']) for group in search.search(query, user)['results'] for hit in group['hits']}
+
+    def test_prefix_matching_over_fts(self):
+        self.assertTrue(search.fts_available())
+        self.assertEqual(self.hits('pyth'), {('course', self.course.pk)})
+        self.assertEqual(self.hits('decorat'), {('module', self.module.pk)})
+        # Every term has to match
+        self.assertEqual(self.hits('gen yie'), {('lesson', self.lesson.pk)})
+        self.assertEqual(self.hits('gen cooking'), set())
+        (group,) = search.search('ada')['results']
+        self.assertEqual(group['course'], {'id': self.course.pk, 'name': 'Python Basics'})
+
+    def test_snippets_are_escaped(self):
+        (group,) = search.search('yield')['results']
+        snippet = group['hits'][0]['snippet']
+        self.assertIn('&lt;b&gt;<mark>yield</mark>&lt;/b&gt;', snippet)
+        self.assertNotIn('<b>', snippet)
+
+    def test_notes_are_private(self):
+        VideoNote = apps.get_model('cognitahz', 'VideoNote')
+        note = VideoNote.objects.create(file=self.file, user=self.user, time=1.0, text='remember closures')
+        self.assertEqual(self.hits('closures', self.user), {('note', note.pk)})
+        self.assertEqual(self.hits('closures', self.other), set())
+        self.assertEqual(self.hits('closures'), set())
+        # Notes show their file's name, and follow it when it is renamed
+        File.objects.filter(pk=self.file.pk).update(name='handout')  # type: ignore[attr-defined]
+        self.assertEqual(self.hits('handout', self.user), {('file', self.file.pk), ('note', note.pk)})
+
+    def test_queryset_updates_are_indexed(self):
+        Course.objects.filter(name='Python Basics').update(name='Rust Mastery')  # type: ignore[attr-defined]
+        self.assertEqual(self.hits('rust'), {('course', self.course.pk)})
+        self.assertEqual(self.hits('python'), set())
+        # A moved module takes its lessons and files to the other course's results
+        Module.objects.filter(pk=self.module.pk).update(course=self.other_course)  # type: ignore[attr-defined]
+        (group,) = search.search('generators')['results']
+        self.assertEqual(group['course']['id'], self.other_course.pk)
+        self.file.name = 'worksheet'
+        File.objects.bulk_update([self.file], ['name'])  # type: ignore[attr-defined]
+        self.assertEqual(self.hits('worksheet'), {('file', self.file.pk)})
+        self.assertEqual(search.rebuild_index(), 5)
+        self.assertEqual(self.hits('worksheet'), {('file', self.file.pk)})
+
+    def test_migration_indexes_existing_content(self):
+        executor = MigrationExecutor(connection)
+        self.addCleanup(lambda: MigrationExecutor(connection).migrate(
+            MigrationExecutor(connection).loader.graph.leaf_nodes()))
+        executor.migrate([('core', '0009_content_rollups')])
+        self.assertNotIn('core_searchdocument', connection.introspection.table_names())
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('core', '0010_search_document')])
+        self.assertEqual(self.hits('pyth'), {('course', self.course.pk)})
+        self.assertEqual(self.hits('generators'), {('lesson', self.lesson.pk)})
+
+
+FAST_KDF = {'algorithm': 'scrypt', 'n': 2 ** 10, 'r': 8, 'p': 1}
+
+
+@override_settings(KATOMART_KDF=FAST_KDF)
+class CryptoTests(TestCase):
+    passphrase = 'correct horse'
+
+    def setUp(self):
+        crypto.wipe_key_cache()
+        self.addCleanup(crypto.wipe_key_cache)
+
+    def count_derivations(self):
+        patcher = mock.patch.object(crypto, '_derive_key', wraps=crypto._derive_key)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_envelope_round_trip(self):
+        token = crypto.encrypt_value('secret', self.passphrase)
+        self.assertTrue(token.startswith('k1$scrypt:1024:8:1$'))
+        self.assertFalse(crypto.is_legacy_token(token))
+        self.assertEqual(crypto.decrypt_value(token, self.passphrase), 'secret')
+        # A fresh salt per write
+        self.assertNotEqual(crypto.parse_envelope(token)[1],
+                            crypto.parse_envelope(crypto.encrypt_value('secret', self.passphrase))[1])
+        with override_settings(KATOMART_KDF={'algorithm': 'pbkdf2', 'iterations': 1000}):
+            token = crypto.encrypt_value('secret', self.passphrase)
+        self.assertTrue(token.startswith('k1$pbkdf2:1000$'))
+        # The envelope carries its own KDF parameters, whatever the settings say now
+        self.assertEqual(crypto.decrypt_value(token, self.passphrase), 'secret')
+
+    def test_legacy_tokens_still_decrypt(self):
+        token = crypto.get_fernet(self.passphrase).encrypt(b'secret').decode()
+        self.assertTrue(crypto.is_legacy_token(token))
+        self.assertEqual(crypto.decrypt_value(token, self.passphrase), 'secret')
+        self.assertEqual(crypto.decrypt_many([token], self.passphrase), ['secret'])
+
+    def test_tampering_is_detected(self):
+        token = crypto.encrypt_value('secret', self.passphrase)
+        spec, salt, payload = crypto.parse_envelope(token)
+        flipped = payload[:-10] + ('A' if payload[-10] != 'A' else 'B') + payload[-9:]
+        tampered = [
+            token.rpartition('$')[0] + '$' + flipped,
+            f'k1${spec}${crypto._b64encode(bytes(16))}${payload}',  # another salt
+            'k1$scrypt:1024:8:1',
+        ]
+        for bad in tampered:
+            with self.assertRaises(InvalidToken):
+                crypto.decrypt_value(bad, self.passphrase)
+        with self.assertRaises(InvalidToken):
+            crypto.decrypt_value(token, 'wrong')
+        legacy = crypto.get_fernet(self.passphrase).encrypt(b'secret').decode()
+        with self.assertRaises(InvalidToken):
+            crypto.decrypt_value(legacy, 'wrong')
+        self.assertEqual(crypto.decrypt_many([*tampered, token, None, ''], self.passphrase),
+                         [None, None, None, 'secret', None, None])
+
+    def test_key_cache(self):
+        cache = crypto.DerivedKeyCache(maxsize=2, ttl=10)
+        key = crypto.DerivedKeyCache.cache_key('spec', b'salt', self.passphrase)
+        self.assertNotIn(self.passphrase.encode(), b''.join(part for part in key if isinstance(part, bytes)))
+        clock = Clock()
+        with mock.patch.object(crypto.time, 'monotonic', clock):
+            cache.put('a', 1)
+            cache.put('b', 2)
+            self.assertEqual(cache.get('a'), 1)
+            cache.put('c', 3)
+            # 'b' was the least recently used
+            self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+            clock.now += 10
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(len(cache), 1)
+        cache.wipe()
+        self.assertEqual(len(cache), 0)
+
+    def test_decrypt_many_derives_each_salt_once(self):
+        records = [crypto.encrypt_many(['user', None, f'cookie {n}'], self.passphrase) for n in range(3)]
+        legacy = crypto.get_fernet(self.passphrase).encrypt(b'old').decode()
+        self.assertEqual(len({crypto.parse_envelope(token)[1] for token in records[0] if token}), 1)
+        crypto.wipe_key_cache()
+        derive = self.count_derivations()
+        tokens = [token for record in records for token in record] + [legacy]
+        self.assertEqual(crypto.decrypt_many(tokens, self.passphrase), [
+            'user', None, 'cookie 0', 'user', None, 'cookie 1', 'user', None, 'cookie 2', 'old'])
+        self.assertEqual(derive.call_count, 3)
+        crypto.decrypt_many(tokens, self.passphrase)
+        self.assertEqual(derive.call_count, 3)
+
+    def test_reencrypt_credentials(self):
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        legacy = crypto.get_fernet(self.passphrase)
+        auths = {name: PlatformAuth(platform=platform, username=name) for name in ('legacy', 'old', 'current', 'other')}
+        auths['legacy'].password_encrypted = legacy.encrypt(b'pw legacy').decode()
+        auths['legacy'].token_encrypted = legacy.encrypt(b'token legacy').decode()
+        with override_settings(KATOMART_KDF={'algorithm': 'pbkdf2', 'iterations': 1000}):
+            auths['old'].set_credentials('pw old', token='token old', passphrase=self.passphrase)
+            auths['other'].set_credentials('pw other', passphrase='another passphrase')
+        auths['current'].set_credentials('pw current', passphrase=self.passphrase)
+        for auth in auths.values():
+            auth.save()
+        current_password = auths['current'].password_encrypted
+
+        def reencrypt(*args):
+            out = io.StringIO()
+            call_command('reencrypt_credentials', *args, passphrase=self.passphrase, stdout=out)
+            return out.getvalue()
+
+        output = reencrypt('--dry-run')
+        self.assertIn('Would re-encrypt 2 of 3 outdated accounts.', output)
+        self.assertIn(f'1 accounts could not be decrypted with this passphrase: {auths["other"].pk}', output)
+        self.assertTrue(PlatformAuth.objects.get(username='legacy').password_encrypted.startswith('gAAAA'))  # type: ignore[attr-defined]
+
+        self.assertIn('Re-encrypted 2 of 3 outdated accounts.', reencrypt())
+        rows = {auth.username: auth for auth in PlatformAuth.objects.all()}  # type: ignore[attr-defined]
+        credentials = PlatformAuth.get_credentials_many(rows.values(), self.passphrase)
+        for name, token in (('legacy', 'token legacy'), ('old', 'token old')):
+            self.assertTrue(rows[name].password_encrypted.startswith('k1$scrypt:1024:8:1$'))
+            self.assertEqual(credentials[rows[name].pk],
+                             {'password': f'pw {name}', 'token': token, 'session_cookie': None, 'refresh_token': None})
+        self.assertEqual(rows['current'].password_encrypted, current_password)
+        self.assertTrue(rows['other'].password_encrypted.startswith('k1$pbkdf2:1000$'))
+
+        # Nothing left to do but the account this passphrase can't open
+        self.assertIn('Re-encrypted 0 of 1 outdated accounts.', reencrypt())
+        again = {auth.username: auth.password_encrypted for auth in PlatformAuth.objects.all()}  # type: ignore[attr-defined]
+        self.assertEqual(again, {name: auth.password_encrypted for name, auth in rows.items()})
+
+
+# Stand-ins for mp4decrypt and ffmpeg: the output path comes last, and each run is logged
+_STUB_TOOL = '''#!{python}
+import sys
+from pathlib import Path
+source, target = Path(sys.argv[sys.argv.index('-i') + 1] if '-i' in sys.argv else sys.argv[-2]), Path(sys.argv[-1])
+data = source.read_bytes()
+if {fail!r} in data:
+    sys.exit('{name} failed on ' + source.name)
+with open({log!r}, 'a') as log:
+    log.write('{name} ' + source.name + '\\n')
+target.write_bytes({transform})
+'''
+
+
+class DownloadPipelineTests(TransactionTestCase):
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root, True)
+        config = SystemConfig.get_solo()
+        config.download_path = str(self.root / 'downloads')
+        config.save()
+        self.user = get_user_model().objects.create_user('owner')
+        platform = Platform.objects.create(id='platform', name='Platform')  # type: ignore[attr-defined]
+        self.course = Course.objects.create(name='Course', platform=platform)  # type: ignore[attr-defined]
+        module = Module.objects.create(course=self.course, name='Module')  # type: ignore[attr-defined]
+        self.lesson = Lesson.objects.create(module=module, name='Lesson')  # type: ignore[attr-defined]
+        self.log = self.root / 'log'
+        self.log.touch()
+        self.mp4decrypt = self.tool('decrypt', b'corrupt', "data.replace(b'encrypted', b'decrypted!')")
+        self.ffmpeg = self.tool('remux', b'broken', "data + b' remuxed'")
+        self.served = {}
+
+    def tool(self, name, fail, transform):
+        path = self.root / name
+        path.write_text(_STUB_TOOL.format(python=sys.executable, name=name, fail=fail, log=str(self.log),
+                                          transform=transform))
+        path.chmod(0o755)
+        return str(path)
+
+    def add_file(self, name, data, drm=False, keys=True):
+        extra = {'url': f'http://127.0.0.1/{name}'}
+        if drm and keys:
+            extra['drm_keys'] = {'0123-ABCD': 'FF00'}
+        file = File.objects.create(  # type: ignore[attr-defined]
+            lesson=self.lesson, name=name, file_type='mp4', has_drm=drm, extra_data=extra)
+        self.served[file.pk] = data
+        return file
+
+    def transfer(self, request, progress):
+        data = self.served[request.file_id]
+        if data is None:
+            return DownloadResult(request.file_id, request.path, False, error='HTTP 404')
+        request.path.parent.mkdir(parents=True, exist_ok=True)
+        request.path.write_bytes(data)
+        with open(self.log, 'a') as log:
+            log.write(f'download {request.path.name}\n')
+        return DownloadResult(request.file_id, request.path, True, bytes_written=len(data), file_size=len(data))
+
+    def run_pipeline(self, files, **options):
+        pipeline = DownloadPipeline(self.user, StubBackend(self.transfer), mp4decrypt_path=self.mp4decrypt,
+                                    ffmpeg_path=self.ffmpeg, download_drm=True, **options)
+        results = {result.file_id: result for result in pipeline.run(files)}
+        self.steps = {}
+        for line in self.log.read_text().splitlines():
+            step, name = line.split(' ', 1)
+            self.steps.setdefault(name, []).append(step)
+        return results
+
+    def steps_of(self, result):
+        return self.steps.get(result.path.name, [])
+
+    def test_stages_run_in_order_and_write_back_state(self):
+        plain = self.add_file('plain', b'plain bytes')
+        drm = self.add_file('drm', b'encrypted bytes', drm=True)
+        keyless = self.add_file('keyless', b'encrypted bytes', drm=True, keys=False)
+        missing = self.add_file('missing', None)
+        results = self.run_pipeline(File.objects.all(), remux=True)  # type: ignore[attr-defined]
+
+        self.assertEqual(self.steps_of(results[plain.pk]), ['download', 'remux'])
+        self.assertEqual(self.steps_of(results[drm.pk]), ['download', 'decrypt', 'remux'])
+        self.assertEqual(results[drm.pk].path.read_bytes(), b'decrypted! bytes remuxed')
+        self.assertTrue(results[plain.pk].ok and results[drm.pk].ok)
+        # Failures stop a file where they happen
+        self.assertEqual(self.steps_of(results[keyless.pk]), ['download'])
+        self.assertFalse(results[keyless.pk].ok)
+        self.assertIn('No decryption keys', results[keyless.pk].error)
+        self.assertEqual(self.steps_of(results[missing.pk]), [])
+        self.assertEqual(results[missing.pk].error, 'HTTP 404')
+
+        files = {file.pk: file for file in File.objects.all()}  # type: ignore[attr-defined]
+        self.assertEqual((files[plain.pk].is_downloaded, files[plain.pk].file_size), (True, 11))
+        # A DRM file's size is the decrypted one
+        self.assertEqual((files[drm.pk].is_downloaded, files[drm.pk].is_decrypted, files[drm.pk].file_size),
+                         (True, True, len(b'decrypted! bytes')))
+        self.assertEqual((files[keyless.pk].is_downloaded, files[keyless.pk].is_decrypted), (True, False))
+        self.assertIn('No decryption keys', files[keyless.pk].extra_data['decrypt_error'])
+        self.assertFalse(files[missing.pk].is_downloaded)
+        self.assertEqual(files[missing.pk].extra_data['download_error'], 'HTTP 404')
+
+    def test_failed_decrypt_keeps_the_encrypted_file(self):
+        file = self.add_file('corrupt', b'corrupt encrypted bytes', drm=True)
+        (result,) = self.run_pipeline([file]).values()
+        self.assertFalse(result.ok)
+        self.assertIn('decrypt failed on', result.error)
+        self.assertEqual(result.path.read_bytes(), b'corrupt encrypted bytes')
+        self.assertEqual(sorted(path.name for path in result.path.parent.iterdir()), [result.path.name])
+        file.refresh_from_db()
+        self.assertEqual((file.is_downloaded, file.is_decrypted), (True, False))
+
+    def test_failed_remux_keeps_the_file(self):
+        file = self.add_file('broken', b'broken bytes')
+        (result,) = self.run_pipeline([file], remux=True).values()
+        self.assertTrue(result.ok)
+        self.assertEqual(result.path.read_bytes(), b'broken bytes')
+        file.refresh_from_db()
+        self.assertTrue(file.is_downloaded)
+        self.assertIn('remux failed on', file.extra_data['remux_error'])
+
+    def test_interrupted_run_resumes_at_decrypt(self):
+        done = self.add_file('done', b'plain bytes')
+        drm = self.add_file('drm', b'never downloaded again', drm=True)
+        self.run_pipeline([done])
+        path = PathPlanner(self.user, self.course).plan()[drm.pk]
+        path.write_bytes(b'encrypted leftover')
+        File.objects.filter(pk=drm.pk).update(is_downloaded=True)  # type: ignore[attr-defined]
+        self.log.write_text('')
+        results = self.run_pipeline(File.objects.all())  # type: ignore[attr-defined]
+        # Finished files are skipped; the leftover only needs decrypting
+        self.assertEqual(list(results), [drm.pk])
+        self.assertEqual(self.steps, {results[drm.pk].path.name: ['decrypt']})
+        self.assertEqual(results[drm.pk].path.read_bytes(), b'decrypted! leftover')
+
+
+class CatalogConstraintMigrationTests(TransactionTestCase):
+    """0003 adds course_platform_external_uniq to databases that may already break it"""
+    before = [('core', '0002_systemconfig_application_key')]
+    after = [('core', '0003_catalog_indexes')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_duplicate_courses_are_detached(self):
+        apps = self.migrate(self.before)
+        Platform = apps.get_model('core', 'Platform')
+        Course = apps.get_model('core', 'Course')
+        platform = Platform.objects.create(id='platform', name='Platform')
+        other = Platform.objects.create(id='other', name='Other')
+        first, second, third = [Course.objects.create(platform=platform, external_id='42', name=f'Course {n}')
+                                for n in range(3)]
+        elsewhere = Course.objects.create(platform=other, external_id='42', name='Elsewhere')
+
+        Course = self.migrate(self.after).get_model('core', 'Course')
+        courses = {course.pk: course for course in Course.objects.all()}
+        self.assertEqual(courses[first.pk].external_id, '42')
+        self.assertEqual(courses[elsewhere.pk].external_id, '42')
+        for course in (second, third):
+            self.assertIsNone(courses[course.pk].external_id)
+            self.assertEqual(courses[course.pk].extra_data, {'duplicate_external_id': '42'})
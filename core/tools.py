@@ -0,0 +1,94 @@
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+# Each entry lists groups of alternative binaries that must all be found; the last group is
+# the tool itself. The drivers are only useful when their browser is installed.
+TOOL_REQUIREMENTS = {
+    'ffmpeg': [('ffmpeg',)],
+    'bento4': [('mp4decrypt',)],
+    'aria2c': [('aria2c',)],
+    'geckodriver': [('firefox',), ('geckodriver',)],
+    'chromedriver': [('chrome', 'google-chrome'), ('chromedriver',)],
+    'mkvtoolnix': [('mkvmerge',)],
+    'rclone': [('rclone',)],
+}
+
+# Arguments that make a tool print its version
+VERSION_ARGS = {
+    'ffmpeg': ['-version'],
+    'bento4': [],
+    'aria2c': ['--version'],
+    'mkvtoolnix': ['--version'],
+    'rclone': ['version'],
+}
+
+DEFAULT_PROBE_TTL = 300  # seconds
+VERSION_TIMEOUT = 5  # seconds
+_VERSION_RE = re.compile(r'\d+(?:\.\d+)+')
+
+_lock = threading.Lock()
+_cache = {'probed_at': None, 'tools': None}
+
+
+def _which_any(candidates):
+    for candidate in candidates:
+        path = shutil.which(candidate)
+        if path:
+            return path
+    return None
+
+
+def _read_version(path, args):
+    try:
+        completed = subprocess.run(
+            [path, *args], capture_output=True, text=True, timeout=VERSION_TIMEOUT, check=False)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    # mp4decrypt only prints its version as part of the usage text, on a non-zero exit
+    output = completed.stdout or completed.stderr or ''
+    for line in output.splitlines():
+        if 'version' in line.lower() or _VERSION_RE.search(line):
+            match = _VERSION_RE.search(line)
+            return match.group(0) if match else line.strip()[:64]
+    return None
+
+
+def _run_probe():
+    tools = {}
+    for name, requirements in TOOL_REQUIREMENTS.items():
+        path = None
+        for candidates in requirements:
+            path = _which_any(candidates)
+            if not path:
+                break
+        version_args = VERSION_ARGS.get(name)
+        version = _read_version(path, version_args) if path and version_args is not None else None
+        tools[name] = {'path': path or '', 'version': version}
+    return tools
+
+
+def probe_tools(force=False):
+    """
+    Locate the external tools (and their versions) katomart can use.
+    The result is cached for KATOMART_TOOL_PROBE_TTL seconds; pass force=True
+    (or call invalidate_tool_cache) after installing or removing a tool.
+    """
+    ttl = getattr(settings, 'KATOMART_TOOL_PROBE_TTL', DEFAULT_PROBE_TTL)
+    with _lock:
+        probed_at = _cache['probed_at']
+        if not force and probed_at is not None and time.monotonic() - probed_at < ttl:
+            return _cache['tools']
+        _cache['tools'] = _run_probe()
+        _cache['probed_at'] = time.monotonic()
+        return _cache['tools']
+
+
+def invalidate_tool_cache():
+    with _lock:
+        _cache['probed_at'] = None
+        _cache['tools'] = None
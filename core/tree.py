@@ -0,0 +1,90 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Prefetch
+
+from .models import Course, Module, Lesson, File
+
+# Child relation emitted under each level of the tree
+TREE_LEVELS = (
+    (Course, 'modules'),
+    (Module, 'lessons'),
+    (Lesson, 'files'),
+    (File, None),
+)
+
+_encoder = DjangoJSONEncoder()
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def course_tree_queryset():
+    """
+    Courses with the whole Module -> Lesson -> File hierarchy prefetched.
+    Always costs four queries no matter how big the course is.
+    """
+    files = File.objects.order_by('order', 'internal_id')  # type: ignore[attr-defined]
+    lessons = Lesson.objects.order_by('order', 'internal_id').prefetch_related(  # type: ignore[attr-defined]
+        Prefetch('files', queryset=files))
+    modules = Module.objects.order_by('order', 'internal_id').prefetch_related(  # type: ignore[attr-defined]
+        Prefetch('lessons', queryset=lessons))
+    return Course.objects.prefetch_related(Prefetch('modules', queryset=modules))  # type: ignore[attr-defined]
+
+
+def parse_fields_param(value):
+    """
+    Turn ``?fields=name,order`` into a set of field names, or None when absent.
+    The primary key is always kept so clients can address the nodes.
+    """
+    if not value:
+        return None
+    fields = {field.strip() for field in value.split(',') if field.strip()}
+    fields.add('internal_id')
+    return fields
+
+
+def _node_fields(model, fields):
+    concrete = [field for field in model._meta.concrete_fields]
+    if fields is None:
+        return concrete
+    return [field for field in concrete if field.name in fields]
+
+
+def _node_payload(obj, model_fields):
+    # Same keys as the flat ModelSerializers: FKs are emitted as their pk
+    return {field.name: getattr(obj, field.attname) for field in model_fields}
+
+
+def iter_course_tree_json(course, fields=None):
+    """
+    Yield the JSON document for a prefetched course piece by piece, so the
+    response never needs the whole tree in memory as a single string.
+    """
+    level_fields = [_node_fields(model, fields) for model, _ in TREE_LEVELS]
+
+    def emit(obj, depth):
+        _, children_attr = TREE_LEVELS[depth]
+        payload = _encoder.encode(_node_payload(obj, level_fields[depth]))
+        if children_attr is None:
+            yield payload
+            return
+        # Splice the children list into the encoded object before its closing brace
+        prefix = payload[:-1] + (', ' if len(payload) > 2 else '')
+        yield f'{prefix}{json.dumps(children_attr)}: ['
+        for index, child in enumerate(getattr(obj, children_attr).all()):
+            if index:
+                yield ', '
+            yield from emit(child, depth + 1)
+        yield ']}'
+
+    buffer = []
+    size = 0
+    for piece in emit(course, 0):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
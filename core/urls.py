@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import LoginView, CourseViewSet, ModuleViewSet, LessonViewSet, FileViewSet, SystemConfigViewSet, PlatformAuthViewSet, UserFormattedNameViewSet, UserConfigViewSet, change_language
+from .views import LoginView, CourseViewSet, ModuleViewSet, LessonViewSet, FileViewSet, SystemConfigViewSet, PlatformAuthViewSet, UserFormattedNameViewSet, UserConfigViewSet, change_language, progress_stream, SearchView
 
 router = DefaultRouter()
 router.register(r'courses', CourseViewSet)
@@ -14,6 +14,8 @@ router.register(r'userconfig', UserConfigViewSet)
 
 urlpatterns = [
     path('api/login/', LoginView.as_view(), name='api-login'),
+    path('api/progress/stream/', progress_stream, name='progress-stream'),
+    path('api/search/', SearchView.as_view(), name='api-search'),
     path('api/', include(router.urls)),
     path('language/<str:language_code>/', change_language, name='change_language'),
 ] 
\ No newline at end of file
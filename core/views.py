@@ -1,8 +1,11 @@
+from django.apps import apps
 from django.shortcuts import render, redirect
 from django.utils import translation
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -14,6 +17,12 @@ from .models import Course, Module, Lesson, File, SystemConfig, PlatformAuth, Us
 from .serializers import CourseSerializer, ModuleSerializer, LessonSerializer, FileSerializer, SystemConfigSerializer, PlatformAuthSerializer, UserFormattedNameSerializer, UserConfigSerializer
 from django.contrib.auth import get_user_model
 from django.views import View
+from rest_framework.exceptions import ValidationError
+from .pagination import CatalogCursorPagination
+from .progress import DEFAULT_MAX_HZ, get_progress_hub, progress_events
+from .search import DEFAULT_LIMIT, search
+from .sync import sync_course_tree
+from .tree import course_tree_queryset, iter_course_tree_json, parse_fields_param
 
 User = get_user_model()
 
@@ -49,25 +58,102 @@ class LoginView(APIView):
             return Response({'success': True})
         return Response({'success': False, 'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
-class CourseViewSet(viewsets.ModelViewSet):
+_TRUE_VALUES = {'1', 'true', 'yes', 'on'}
+_FALSE_VALUES = {'0', 'false', 'no', 'off'}
+
+def parse_bool_param(name, value):
+    lowered = value.strip().lower()
+    if lowered in _TRUE_VALUES:
+        return True
+    if lowered in _FALSE_VALUES:
+        return False
+    raise ValidationError({name: f'Expected a boolean, got {value!r}'})
+
+def parse_int_param(name, value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValidationError({name: f'Expected an integer id, got {value!r}'})
+
+class CatalogFilterMixin:
+    """
+    Server-side filtering for the catalog viewsets.
+    `parent_filters` maps a query parameter to the lookup reaching that parent,
+    `boolean_filters` lists the flags that can be filtered with ?flag=true/false.
+    """
+    parent_filters = {}
+    boolean_filters = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()  # type: ignore[misc]
+        params = self.request.query_params  # type: ignore[attr-defined]
+        lookups = {}
+        for param, lookup in self.parent_filters.items():
+            if param in params:
+                lookups[lookup] = parse_int_param(param, params[param])
+        for param in self.boolean_filters:
+            if param in params:
+                lookups[param] = parse_bool_param(param, params[param])
+        return queryset.filter(**lookups) if lookups else queryset
+
+class CourseViewSet(CatalogFilterMixin, viewsets.ModelViewSet):
     queryset = Course.objects.all()  # type: ignore[attr-defined]
     serializer_class = CourseSerializer
     permission_classes = [permissions.IsAuthenticated]
-
-class ModuleViewSet(viewsets.ModelViewSet):
+    pagination_class = CatalogCursorPagination
+    boolean_filters = ('is_active', 'is_downloaded', 'has_drm')
+
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        """Whole Course -> Module -> Lesson -> File hierarchy in one streamed response"""
+        course = get_object_or_404(course_tree_queryset(), pk=pk)
+        self.check_object_permissions(request, course)
+        fields = parse_fields_param(request.query_params.get('fields'))
+        return StreamingHttpResponse(iter_course_tree_json(course, fields), content_type='application/json')
+
+    @action(detail=True, methods=['post'])
+    def sync(self, request, pk=None):
+        """Upsert a whole scraped Module -> Lesson -> File tree keyed by external_id"""
+        course = self.get_object()
+        try:
+            counts = sync_course_tree(course, request.data)
+        except ValueError as exc:
+            return Response({'success': False, 'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'success': True, 'counts': counts})
+
+class ModuleViewSet(CatalogFilterMixin, viewsets.ModelViewSet):
     queryset = Module.objects.all()  # type: ignore[attr-defined]
     serializer_class = ModuleSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    parent_filters = {'course': 'course_id'}
+    boolean_filters = ('is_active', 'is_downloaded', 'should_download', 'has_drm')
+
+class RecordViewMixin:
+    """Opening one object (retrieve) counts as a view of it in cognitahz's stats, when installed"""
 
-class LessonViewSet(viewsets.ModelViewSet):
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()  # type: ignore[attr-defined]
+        if apps.is_installed('cognitahz'):
+            from cognitahz.stats import record_view
+            record_view(request.user, instance)
+        return Response(self.get_serializer(instance).data)  # type: ignore[attr-defined]
+
+class LessonViewSet(RecordViewMixin, CatalogFilterMixin, viewsets.ModelViewSet):
     queryset = Lesson.objects.all()  # type: ignore[attr-defined]
     serializer_class = LessonSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    parent_filters = {'course': 'module__course_id', 'module': 'module_id'}
+    boolean_filters = ('is_active', 'is_downloaded', 'should_download', 'has_drm')
 
-class FileViewSet(viewsets.ModelViewSet):
+class FileViewSet(RecordViewMixin, CatalogFilterMixin, viewsets.ModelViewSet):
     queryset = File.objects.all()  # type: ignore[attr-defined]
     serializer_class = FileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = CatalogCursorPagination
+    parent_filters = {'course': 'lesson__module__course_id', 'module': 'lesson__module_id', 'lesson': 'lesson_id'}
+    boolean_filters = ('is_active', 'is_downloaded', 'should_download', 'has_drm', 'is_decrypted')
 
 class SystemConfigViewSet(viewsets.ModelViewSet):
     queryset = SystemConfig.objects.all()  # type: ignore[attr-defined]
@@ -108,6 +194,58 @@ class UserConfigViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
+class SearchView(APIView):
+    """
+    GET ?q= : ranked full-text search over course, module, lesson and file
+    names and descriptions plus the user's own video notes, grouped by course.
+    `?limit=` caps the number of hits (default 50, at most 200).
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This parameter is required'})
+        limit = request.query_params.get('limit')
+        try:
+            limit = int(limit) if limit else DEFAULT_LIMIT
+        except ValueError:
+            raise ValidationError({'limit': f'Expected an integer, got {limit!r}'})
+        return Response(search(query, request.user, limit))
+
 class RootAppView(View):
     def get(self, request):
         return render(request, 'root_app.html')
+
+async def progress_stream(request):
+    """
+    Server-Sent Events with the download workers' progress: a `snapshot` of the
+    active files, then `progress` frames of coalesced deltas (file bytes and
+    rate, per-course totals, state transitions) at most `?hz=` times a second.
+    `?course=` narrows it to one course; users only see their own jobs.
+    Needs an ASGI server (e.g. `uvicorn katomart.asgi:application`): a WSGI
+    server such as runserver would hold the never-ending response and its
+    thread forever, so there it answers 501.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({'detail': 'The progress stream needs an ASGI server '
+                                       '(e.g. uvicorn katomart.asgi:application)'}, status=501)
+    user = await request.auser()
+    if not user.is_authenticated:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    max_hz = float(getattr(settings, 'KATOMART_PROGRESS_MAX_HZ', DEFAULT_MAX_HZ))
+    try:
+        course_id = int(request.GET['course']) if request.GET.get('course') else None
+        hz = min(float(request.GET.get('hz') or max_hz), max_hz)
+    except ValueError:
+        return JsonResponse({'detail': 'course must be an integer id and hz a number'}, status=400)
+    hub = get_progress_hub()
+    try:
+        await hub.start()
+    except OSError as exc:
+        return JsonResponse({'detail': f'Progress bus unavailable: {exc}'}, status=503)
+    subscriber = hub.subscribe(user_id=None if user.is_superuser else user.pk, course_id=course_id)
+    response = StreamingHttpResponse(progress_events(hub, subscriber, max_hz=hz), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -28,5 +28,6 @@ urlpatterns += i18n_patterns(
     path('', __import__('core.views', fromlist=['RootAppView']).RootAppView.as_view(), name='root-app'),
     path('core/', include('core.urls')),
     path('backups/', include('backups.urls')),
+    path('cognitahz/', include('cognitahz.urls')),
     prefix_default_language=False,
 )